@@ -0,0 +1,418 @@
+import argparse
+import math
+import os
+import sys
+import numpy as np
+from colorama import Fore, Style
+from run_hge import HGE
+from latency_histogram import decode_hdr_histogram
+
+
+class ComparisonError(Exception):
+    """Exception type for the comparison of benchmark results"""
+
+
+def histogram_bins(encoded_histograms):
+    """
+    The distinct latencies (in microseconds) recorded in the histograms (like
+    those of the trials of a run), and their counts
+    """
+    histogram = decode_hdr_histogram(encoded_histograms[0])
+    for encoded in encoded_histograms[1:]:
+        histogram.add(decode_hdr_histogram(encoded))
+    bins = [
+        (item.value_iterated_to, item.count_added_in_this_iter_step)
+        for item in histogram.get_recorded_iterator()
+    ]
+    values = np.array([v for (v, _) in bins], dtype=np.float64)
+    counts = np.array([c for (_, c) in bins], dtype=np.int64)
+    return (values, counts)
+
+
+def value_at_percentile(values, counts, percentile):
+    """
+    The smallest value such that percentile % of the counts are at or below it,
+    for each row of counts (if counts is 2 dimensional)
+    """
+    cum_counts = np.cumsum(counts, axis=-1)
+    totals = cum_counts[..., -1:]
+    index = np.argmax(cum_counts >= totals * percentile / 100.0, axis=-1)
+    return values[index]
+
+
+def mann_whitney(base, new):
+    """
+    One sided Mann-Whitney U test, on the binned latencies of the two runs,
+    of the new latencies being larger than the base ones. Uses the normal
+    approximation with the correction for ties. Returns the p-value
+    """
+    (base_values, base_counts) = base
+    (new_values, new_counts) = new
+    values = np.union1d(base_values, new_values)
+    a = np.zeros(len(values))
+    b = np.zeros(len(values))
+    a[np.searchsorted(values, base_values)] = base_counts
+    b[np.searchsorted(values, new_values)] = new_counts
+    (n_a, n_b) = (a.sum(), b.sum())
+    n = n_a + n_b
+    # Number of pairs with a larger new latency, counting the ties as half
+    a_below = np.cumsum(a) - a
+    u = np.sum(b * (a_below + a / 2.0))
+    ties = a + b
+    variance = n_a * n_b / 12.0 * ((n + 1) - np.sum(ties ** 3 - ties) / (n * (n - 1)))
+    if variance <= 0:
+        return 1.0
+    z = (u - n_a * n_b / 2.0) / math.sqrt(variance)
+    return 0.5 * math.erfc(z / math.sqrt(2))
+
+
+def bootstrap_percentile_change(base, new, percentile, confidence, samples, rng):
+    """
+    The relative change in the latency at the percentile, with its bootstrap
+    confidence interval. The runs are resampled from their histograms.
+    Returns (change, low, high)
+    """
+    def resampled_percentiles(bins):
+        (values, counts) = bins
+        total = counts.sum()
+        resampled = rng.multinomial(total, counts / total, size=samples)
+        return value_at_percentile(values, resampled, percentile)
+
+    base_value = value_at_percentile(*base, percentile)
+    new_value = value_at_percentile(*new, percentile)
+    changes = resampled_percentiles(new) / resampled_percentiles(base) - 1
+    alpha = (1 - confidence) / 2
+    return (
+        new_value / base_value - 1,
+        np.quantile(changes, alpha),
+        np.quantile(changes, 1 - alpha)
+    )
+
+
+def bootstrap_mean_change(base_samples, new_samples, confidence, samples, rng):
+    """
+    The relative change in the mean of the samples, with its bootstrap
+    confidence interval. Returns (change, low, high), where the interval is
+    None if either side has less than 2 samples
+    """
+    base_samples = np.asarray(base_samples, dtype=np.float64)
+    new_samples = np.asarray(new_samples, dtype=np.float64)
+    change = new_samples.mean() / base_samples.mean() - 1
+    if len(base_samples) < 2 or len(new_samples) < 2:
+        return (change, None, None)
+    base_means = rng.choice(base_samples, size=(samples, len(base_samples))).mean(axis=1)
+    new_means = rng.choice(new_samples, size=(samples, len(new_samples))).mean(axis=1)
+    changes = new_means / base_means - 1
+    alpha = (1 - confidence) / 2
+    return (change, np.quantile(changes, alpha), np.quantile(changes, 1 - alpha))
+
+
+class ResultsComparison:
+    """
+    Compares the results of two versions (or docker images) of graphql-engine
+    stored in the results schema, for the queries benchmarked with both of
+    them on the same CPU.
+
+    For the latencies, the latest histograms of each query and request rate
+    are compared, merging the histograms of all the trials of the latest run.
+    A latency regression is reported if the latency at the given percentile
+    increased by more than the threshold, the bootstrap confidence interval of
+    the increase excludes zero, and the Mann-Whitney test finds the new
+    latencies larger. As the latencies of a run aren't independent, these
+    are optimistic; repeated runs give more reliable comparisons.
+
+    For the throughput, all the max RPS samples of each query are compared. A
+    throughput regression is reported if the mean decreased by more than the
+    threshold and the bootstrap confidence interval of the decrease excludes
+    zero, which needs at least two samples for each version.
+    """
+
+    results_query = '''
+query comparisonResults($versions: [String!]!, $scale_factor: Int!) {
+  latency: hge_bench_results(
+    where: {
+      _or: [{version: {_in: $versions}}, {docker_image: {_in: $versions}}],
+      workload_profile: {_is_null: true},
+      hdr_histogram: {_is_null: false},
+      scale_factor: {_eq: $scale_factor}
+    },
+    order_by: {time: desc}
+  ) {
+    query_name
+    requests_per_sec
+    version
+    docker_image
+    cpu_key
+    cpu_set
+    hdr_histogram
+    trial_group
+  }
+  max_rps: hge_bench_query_max_rps(
+    where: {
+      _or: [{version: {_in: $versions}}, {docker_image: {_in: $versions}}],
+      scale_factor: {_eq: $scale_factor}
+    }
+  ) {
+    query_name
+    method
+    version
+    docker_image
+    cpu_key
+    cpu_set
+    max_rps
+  }
+}'''
+
+    def __init__(
+            self, results_hge, base, new, threshold=0.05, percentile=99,
+            confidence=0.95, significance=0.05, bootstrap_samples=1000, scale_factor=1
+    ):
+        self.results_hge = results_hge
+        self.base = base
+        self.new = new
+        self.threshold = threshold
+        self.percentile = percentile
+        self.confidence = confidence
+        self.significance = significance
+        self.bootstrap_samples = bootstrap_samples
+        self.scale_factor = scale_factor
+        self.rng = np.random.default_rng(0)
+
+    def fetch_results(self):
+        variables = {
+            'versions': [self.base, self.new],
+            'scale_factor': self.scale_factor
+        }
+        return self.results_hge.graphql_q(self.results_query, variables)['data']
+
+    def version_of(self, result):
+        if result['version'] in [self.base, self.new]:
+            return result['version']
+        return result['docker_image']
+
+    def group_by_version(self, results, key):
+        """key(result) -> {version: [results]}, for the keys with results of both versions"""
+        groups = {}
+        for result in results:
+            groups.setdefault(key(result), {}).setdefault(self.version_of(result), []).append(result)
+        return {
+            k: group for (k, group) in sorted(groups.items(), key=lambda kv: str(kv[0]))
+            if self.base in group and self.new in group
+        }
+
+    def compare_latencies(self, latency_results):
+        comparisons = []
+        groups = self.group_by_version(
+            latency_results,
+            lambda r: (r['query_name'], r['requests_per_sec'], r['cpu_key'], r['cpu_set'])
+        )
+        def latest_trials(results):
+            # The results are ordered by time, latest first
+            latest = results[0]
+            if latest['trial_group'] is None:
+                return [latest]
+            return [r for r in results if r['trial_group'] == latest['trial_group']]
+
+        for ((query_name, rps, cpu_key, cpu_set), group) in groups.items():
+            base_trials = latest_trials(group[self.base])
+            new_trials = latest_trials(group[self.new])
+            base = histogram_bins([r['hdr_histogram'] for r in base_trials])
+            new = histogram_bins([r['hdr_histogram'] for r in new_trials])
+            (change, low, high) = bootstrap_percentile_change(
+                base, new, self.percentile, self.confidence, self.bootstrap_samples, self.rng)
+            p_value = mann_whitney(base, new)
+            improvement_p_value = mann_whitney(new, base)
+            if change > self.threshold and low > 0 and p_value < self.significance:
+                verdict = 'regression'
+            elif change < -self.threshold and high < 0 and improvement_p_value < self.significance:
+                verdict = 'improvement'
+            else:
+                verdict = 'no significant change'
+            comparisons.append({
+                'query_name': query_name,
+                'requests_per_sec': rps,
+                'cpu': cpu_key + (' ({})'.format(cpu_set) if cpu_set else ''),
+                'base_latency': value_at_percentile(*base, self.percentile) / 1000.0,
+                'base_trials': len(base_trials),
+                'new_latency': value_at_percentile(*new, self.percentile) / 1000.0,
+                'new_trials': len(new_trials),
+                'change': change,
+                'ci': (low, high),
+                'p_value': p_value,
+                'verdict': verdict
+            })
+        return comparisons
+
+    def compare_throughput(self, max_rps_results):
+        comparisons = []
+        groups = self.group_by_version(
+            max_rps_results,
+            lambda r: (r['query_name'], r['method'], r['cpu_key'], r['cpu_set'])
+        )
+        for ((query_name, method, cpu_key, cpu_set), group) in groups.items():
+            base_samples = [r['max_rps'] for r in group[self.base]]
+            new_samples = [r['max_rps'] for r in group[self.new]]
+            (change, low, high) = bootstrap_mean_change(
+                base_samples, new_samples, self.confidence, self.bootstrap_samples, self.rng)
+            if low is None:
+                verdict = 'insufficient samples'
+            elif change < -self.threshold and high < 0:
+                verdict = 'regression'
+            elif change > self.threshold and low > 0:
+                verdict = 'improvement'
+            else:
+                verdict = 'no significant change'
+            comparisons.append({
+                'query_name': query_name,
+                'method': method,
+                'cpu': cpu_key + (' ({})'.format(cpu_set) if cpu_set else ''),
+                'base_max_rps': np.mean(base_samples),
+                'base_samples': len(base_samples),
+                'new_max_rps': np.mean(new_samples),
+                'new_samples': len(new_samples),
+                'change': change,
+                'ci': (low, high),
+                'verdict': verdict
+            })
+        return comparisons
+
+    def run(self):
+        results = self.fetch_results()
+        self.latency_comparisons = self.compare_latencies(results['latency'])
+        self.throughput_comparisons = self.compare_throughput(results['max_rps'])
+        if not self.latency_comparisons and not self.throughput_comparisons:
+            raise ComparisonError("No results of {} and {} for the same queries on the same CPU".format(
+                self.base, self.new))
+        return self
+
+    def regressions(self):
+        return [
+            c for c in self.latency_comparisons + self.throughput_comparisons
+            if c['verdict'] == 'regression'
+        ]
+
+    def markdown_report(self):
+        def pct(x):
+            return '{:+.1f}%'.format(x * 100)
+
+        def ci(c):
+            (low, high) = c['ci']
+            if low is None:
+                return '-'
+            return '[{}, {}]'.format(pct(low), pct(high))
+
+        def verdict(c):
+            return '**{}**'.format(c['verdict']) if c['verdict'] == 'regression' else c['verdict']
+
+        confidence = '{:g}%'.format(self.confidence * 100)
+        percentile = 'p{:g}'.format(self.percentile)
+        lines = [
+            '# Performance comparison: `{}` vs `{}`'.format(self.new, self.base),
+            '',
+            'Threshold: {:g}%, confidence: {}, significance: {:g}, scale factor: {}'.format(
+                self.threshold * 100, confidence, self.significance, self.scale_factor),
+            '',
+            '## Latency ({})'.format(percentile),
+            ''
+        ]
+        if self.latency_comparisons:
+            lines += [
+                '| Query | Req/s | CPU | {p} `{b}` (ms, trials) | {p} `{n}` (ms, trials) | Change | {c} CI | Mann-Whitney p | Result |'.format(
+                    p=percentile, b=self.base, n=self.new, c=confidence),
+                '|---|---:|---|---:|---:|---:|---|---:|---|'
+            ]
+            for c in self.latency_comparisons:
+                lines.append('| {} | {} | {} | {:.2f} ({}) | {:.2f} ({}) | {} | {} | {:.3g} | {} |'.format(
+                    c['query_name'], c['requests_per_sec'], c['cpu'], c['base_latency'], c['base_trials'],
+                    c['new_latency'], c['new_trials'], pct(c['change']), ci(c), c['p_value'], verdict(c)))
+        else:
+            lines.append('No latency results to compare')
+        lines += ['', '## Throughput (max RPS)', '']
+        if self.throughput_comparisons:
+            lines += [
+                '| Query | Method | CPU | `{b}` (samples) | `{n}` (samples) | Change | {c} CI | Result |'.format(
+                    b=self.base, n=self.new, c=confidence),
+                '|---|---|---|---:|---:|---:|---|---|'
+            ]
+            for c in self.throughput_comparisons:
+                lines.append('| {} | {} | {} | {:.0f} ({}) | {:.0f} ({}) | {} | {} | {} |'.format(
+                    c['query_name'], c['method'], c['cpu'], c['base_max_rps'], c['base_samples'],
+                    c['new_max_rps'], c['new_samples'], pct(c['change']), ci(c), verdict(c)))
+        else:
+            lines.append('No throughput results to compare')
+        regressions = self.regressions()
+        lines += ['', '## Summary', '']
+        if regressions:
+            lines.append('{} regression(s) beyond {:g}%:'.format(len(regressions), self.threshold * 100))
+            lines.append('')
+            for c in regressions:
+                if 'requests_per_sec' in c:
+                    lines.append('- {} at {} req/s: {} latency {}'.format(
+                        c['query_name'], c['requests_per_sec'], percentile, pct(c['change'])))
+                else:
+                    lines.append('- {} ({}): max RPS {}'.format(c['query_name'], c['method'], pct(c['change'])))
+        else:
+            lines.append('No significant regressions')
+        return '\n'.join(lines) + '\n'
+
+
+def main(argv):
+    """
+    Compare the results of two versions, and write the markdown report.
+    Returns the exit code: 1 if there are regressions, 2 if there's nothing to compare
+    """
+    parser = argparse.ArgumentParser(
+        prog='hge_wrk_bench.py compare',
+        description='Compare the benchmark results of two versions (or docker images) of graphql-engine'
+    )
+    parser.add_argument('--base', help='Version or docker image to compare against', required=True)
+    parser.add_argument('--new', help='Version or docker image to be compared', required=True)
+    parser.add_argument('--results-hge-url', metavar='HASURA_BENCH_RESULTS_HGE_URL', help='Url of the graphql-engine with the results', required=False)
+    parser.add_argument('--results-hge-admin-secret', metavar='HASURA_BENCH_RESULTS_HGE_ADMIN_SECRET', help='Admin secret of the graphql-engine with the results', required=False)
+    parser.add_argument('--threshold', help='Relative change beyond which a significant change is a regression (default: 0.05)', type=float, default=0.05)
+    parser.add_argument('--percentile', help='Latency percentile compared (default: 99)', type=float, default=99)
+    parser.add_argument('--confidence', help='Confidence level of the intervals (default: 0.95)', type=float, default=0.95)
+    parser.add_argument('--significance', help='Significance level of the Mann-Whitney test (default: 0.05)', type=float, default=0.05)
+    parser.add_argument('--bootstrap-samples', help='Number of bootstrap resamples (default: 1000)', type=int, default=1000)
+    parser.add_argument('--scale-factor', help='Scale factor of the data of the results (default: 1)', type=int, default=1)
+    parser.add_argument('--report', help='File to which the markdown report is written (default: stdout)', required=False)
+    args = parser.parse_args(argv)
+
+    results_hge_url = args.results_hge_url or os.getenv('HASURA_BENCH_RESULTS_HGE_URL')
+    if not results_hge_url:
+        parser.error('--results-hge-url or HASURA_BENCH_RESULTS_HGE_URL is required')
+    admin_secret = args.results_hge_admin_secret or os.getenv('HASURA_BENCH_RESULTS_HGE_ADMIN_SECRET')
+    results_hge_args = ['--admin-secret', admin_secret] if admin_secret else []
+    results_hge = HGE(None, None, args=results_hge_args, log_file=None, url=results_hge_url)
+
+    comparison = ResultsComparison(
+        results_hge, args.base, args.new,
+        threshold = args.threshold,
+        percentile = args.percentile,
+        confidence = args.confidence,
+        significance = args.significance,
+        bootstrap_samples = args.bootstrap_samples,
+        scale_factor = args.scale_factor
+    )
+    try:
+        comparison.run()
+    except ComparisonError as e:
+        print(Fore.RED + str(e) + Style.RESET_ALL, file=sys.stderr)
+        return 2
+    report = comparison.markdown_report()
+    if args.report:
+        with open(args.report, 'w') as f:
+            f.write(report)
+        print("Comparison report written to", args.report)
+    else:
+        print(report)
+    regressions = comparison.regressions()
+    if regressions:
+        print(Fore.RED + "{} regression(s) found".format(len(regressions)) + Style.RESET_ALL)
+        return 1
+    print(Fore.GREEN + "No significant regressions" + Style.RESET_ALL)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,249 @@
+import time
+from collections import defaultdict
+import psycopg2
+from psycopg2.sql import SQL, Identifier
+from colorama import Fore, Style
+
+
+class DataGeneratorError(Exception):
+    """Exception type for the synthetic data generator"""
+
+
+integer_types = ['smallint', 'integer', 'bigint']
+
+text_types = ['text', 'character varying', 'character']
+
+
+def copy_text_value(value):
+    """Encode a value (as text) in the text format of COPY"""
+    if value is None:
+        return '\\N'
+    return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+class IteratorFile:
+    """
+    A read-only file over the chunks of bytes produced by an iterator, so that
+    the rows can be streamed to COPY ... FROM STDIN as they are generated
+    """
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.buffer = bytearray()
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            self.buffer += chunk
+        if size < 0:
+            size = len(self.buffer)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def readline(self, size=-1):
+        return self.read(size)
+
+
+class ScaledDataGenerator:
+    """
+    Scales the data in a schema by a factor N, by adding N-1 copies of the
+    rows of every table.
+
+    The foreign keys are kept intact by shifting the key columns of each copy:
+    an integer primary key (or unique) column of the k-th copy is offset by k
+    times the range of the column, a text one gets the suffix '-k', and a
+    foreign key column gets the same shift as the column it references. So
+    the k-th copy of a row references the k-th copy of its parent, and the
+    number of related rows per row (the fan-out) stays the same.
+
+    The original rows are streamed from a server side cursor, and the copies
+    are loaded with COPY as they are generated, in a single transaction.
+    """
+
+    # Number of rows fetched from the server side cursor at a time
+    fetch_size = 10000
+
+    def __init__(self, pg, schema, scale_factor):
+        if scale_factor < 1 or int(scale_factor) != scale_factor:
+            raise DataGeneratorError("Scale factor should be a positive integer, got " + repr(scale_factor))
+        self.pg = pg
+        self.schema = schema
+        self.scale_factor = int(scale_factor)
+
+    def generate(self):
+        if self.scale_factor == 1:
+            return
+        print(Fore.YELLOW + "Scaling the data in schema {} by {}".format(self.schema, self.scale_factor) + Style.RESET_ALL)
+        start_time = time.time()
+        read_conn = psycopg2.connect(self.pg.url)
+        write_conn = psycopg2.connect(self.pg.url)
+        try:
+            with read_conn.cursor() as cursor:
+                columns = self.get_columns(cursor)
+                fk_columns = self.get_fk_columns(cursor)
+                key_columns = self.get_key_columns(cursor)
+                shifts = self.get_shifts(cursor, columns, fk_columns, key_columns)
+                (tables, has_cycles) = self.order_tables(columns, fk_columns)
+            with write_conn:
+                with write_conn.cursor() as cursor:
+                    if has_cycles:
+                        # The rows of tables referencing each other can't be loaded
+                        # in an order satisfying the foreign keys, so don't check them
+                        cursor.execute("SET LOCAL session_replication_role = replica;")
+                    for table in tables:
+                        self.copy_table(read_conn, cursor, table, columns[table], shifts)
+                    self.update_sequences(cursor, shifts)
+        finally:
+            read_conn.close()
+            write_conn.close()
+        self.pg.invalidate_catalog()
+        print("Scaled the data in schema {} in {:.2f} seconds".format(self.schema, time.time() - start_time))
+
+    def get_columns(self, cursor):
+        """table -> [(column, data type)] of the base tables in the schema, except generated columns"""
+        cursor.execute('''
+        SELECT c.table_name, c.column_name, c.data_type
+        FROM information_schema.columns c
+          JOIN information_schema.tables t
+            ON t.table_schema = c.table_schema AND t.table_name = c.table_name
+        WHERE c.table_schema = %s AND t.table_type = 'BASE TABLE' AND c.is_generated <> 'ALWAYS'
+        ORDER BY c.table_name, c.ordinal_position;
+        ''', (self.schema,))
+        columns = defaultdict(list)
+        for (table, column, data_type) in cursor.fetchall():
+            columns[table].append((column, data_type))
+        return columns
+
+    def get_fk_columns(self, cursor):
+        """(table, column) -> (referenced table, referenced column), within the schema"""
+        cursor.execute('''
+        SELECT cl.relname, a.attname, fcl.relname, fa.attname
+        FROM pg_constraint con
+          JOIN pg_class cl ON cl.oid = con.conrelid
+          JOIN pg_class fcl ON fcl.oid = con.confrelid
+          JOIN pg_namespace n ON n.oid = cl.relnamespace
+          JOIN pg_namespace fn ON fn.oid = fcl.relnamespace
+          CROSS JOIN LATERAL unnest(con.conkey, con.confkey) AS k(attnum, fattnum)
+          JOIN pg_attribute a ON a.attrelid = con.conrelid AND a.attnum = k.attnum
+          JOIN pg_attribute fa ON fa.attrelid = con.confrelid AND fa.attnum = k.fattnum
+        WHERE con.contype = 'f' AND n.nspname = %s AND fn.nspname = %s;
+        ''', (self.schema, self.schema))
+        return {(t, c): (ft, fc) for (t, c, ft, fc) in cursor.fetchall()}
+
+    def get_key_columns(self, cursor):
+        """The (table, column) pairs in the primary keys and unique constraints"""
+        cursor.execute('''
+        SELECT cl.relname, a.attname
+        FROM pg_constraint con
+          JOIN pg_class cl ON cl.oid = con.conrelid
+          JOIN pg_namespace n ON n.oid = cl.relnamespace
+          CROSS JOIN LATERAL unnest(con.conkey) AS k(attnum)
+          JOIN pg_attribute a ON a.attrelid = con.conrelid AND a.attnum = k.attnum
+        WHERE con.contype IN ('p', 'u') AND n.nspname = %s;
+        ''', (self.schema,))
+        return set(cursor.fetchall())
+
+    def get_shifts(self, cursor, columns, fk_columns, key_columns):
+        """
+        (table, column) -> ('offset', n) or ('suffix', None), for the columns
+        which are changed in the copies
+        """
+        data_types = {
+            (table, column): data_type
+            for (table, table_columns) in columns.items()
+            for (column, data_type) in table_columns
+        }
+        shifts = {}
+        for (table, column) in sorted(key_columns):
+            if (table, column) in fk_columns:
+                continue
+            data_type = data_types.get((table, column))
+            if data_type in integer_types:
+                cursor.execute(SQL('SELECT min({c}), max({c}) FROM {s}.{t};').format(
+                    c=Identifier(column), s=Identifier(self.schema), t=Identifier(table)))
+                (low, high) = cursor.fetchone()
+                shifts[(table, column)] = ('offset', (high - low + 1) if low is not None else 0)
+            elif data_type in text_types:
+                shifts[(table, column)] = ('suffix', None)
+            else:
+                raise DataGeneratorError("Can't generate unique values for column {}.{} of type {}".format(
+                    table, column, data_type))
+
+        def referenced_shift(key, seen):
+            if key in shifts or key not in fk_columns or key in seen:
+                return shifts.get(key)
+            return referenced_shift(fk_columns[key], seen | {key})
+
+        for key in fk_columns:
+            shift = referenced_shift(key, set())
+            if shift:
+                shifts[key] = shift
+        return shifts
+
+    def order_tables(self, columns, fk_columns):
+        """
+        Order the tables such that referenced tables come first. Returns the
+        order, and whether some tables reference each other
+        """
+        dependencies = {table: set() for table in columns}
+        for ((table, _), (ref_table, _)) in fk_columns.items():
+            if table != ref_table and table in dependencies and ref_table in dependencies:
+                dependencies[table].add(ref_table)
+        order = []
+        remaining = dict(dependencies)
+        while remaining:
+            ready = sorted(t for (t, deps) in remaining.items() if not deps & set(remaining))
+            if not ready:
+                # Cycle: add the rest in any order
+                order.extend(sorted(remaining))
+                return (order, True)
+            order.extend(ready)
+            for table in ready:
+                del remaining[table]
+        return (order, False)
+
+    def copy_table(self, read_conn, cursor, table, table_columns, shifts):
+        column_names = [column for (column, _) in table_columns]
+        print("Generating {} copies of table {}.{}".format(self.scale_factor - 1, self.schema, table))
+        copy_sql = SQL('COPY {}.{} ({}) FROM STDIN;').format(
+            Identifier(self.schema), Identifier(table),
+            SQL(', ').join(map(Identifier, column_names))
+        ).as_string(cursor)
+        rows = self.generate_rows(read_conn, table, column_names, shifts)
+        cursor.copy_expert(copy_sql, IteratorFile(rows))
+
+    def generate_rows(self, read_conn, table, column_names, shifts):
+        """Stream the copies of the rows of the table, encoded for COPY"""
+        column_shifts = [shifts.get((table, column)) for column in column_names]
+        select = SQL('SELECT {} FROM {}.{};').format(
+            SQL(', ').join(SQL('{}::text').format(Identifier(c)) for c in column_names),
+            Identifier(self.schema), Identifier(table)
+        )
+        with read_conn.cursor(name='scale_' + table) as source:
+            source.itersize = self.fetch_size
+            source.execute(select)
+            for row in source:
+                for k in range(1, self.scale_factor):
+                    values = []
+                    for (value, shift) in zip(row, column_shifts):
+                        if shift and value is not None:
+                            (kind, offset) = shift
+                            value = str(int(value) + k * offset) if kind == 'offset' else value + '-' + str(k)
+                        values.append(copy_text_value(value))
+                    yield ('\t'.join(values) + '\n').encode('utf-8')
+
+    def update_sequences(self, cursor, shifts):
+        """Advance the sequences of the serial columns past the generated values"""
+        for ((table, column), (kind, _)) in shifts.items():
+            if kind != 'offset':
+                continue
+            qualified_table = '{}.{}'.format(Identifier(self.schema).as_string(cursor), Identifier(table).as_string(cursor))
+            cursor.execute(SQL('''
+            SELECT setval(seq, (SELECT max({c}) FROM {s}.{t}))
+            FROM pg_get_serial_sequence(%s, %s) AS seq
+            WHERE seq IS NOT NULL;
+            ''').format(c=Identifier(column), s=Identifier(self.schema), t=Identifier(table)),
+                (qualified_table, column))
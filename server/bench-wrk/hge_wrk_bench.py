@@ -1,9 +1,17 @@
 from sportsdb_setup import HGETestSetup, HGETestSetupArgs
 from run_hge import HGE
+from latency_histogram import Wrk2LatencyParser, write_hdr_histogram_log, percentile_spectrum
+from subscription_bench import SubscriptionLoad
+from workload import WorkloadProfile, MixedWorkload
+from variable_generators import make_variables_generator
+from resource_sampler import ResourceSampler
+from metadata_bench import MetadataSizeBenchmark, MetadataApiBenchmark
+import compare_results
 import graphql
 import multiprocessing
 import json
 import os
+import sys
 import docker
 import ruamel.yaml as yaml
 import cpuinfo
@@ -17,6 +25,11 @@ import webbrowser
 import pathlib
 from urllib.parse import urlparse, urlunparse
 import boto3
+import copy
+import shutil
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
 
 fileLoc = os.path.dirname(os.path.abspath(__file__))
@@ -26,6 +39,12 @@ def uri_path_join(uri, *paths):
     new_path = os.path.join(p.path, *paths)
     return urlunparse(p._replace(path=new_path))
 
+def boolean_string(s):
+    s = s.lower()
+    if s not in {'false', 'true'}:
+        raise ValueError('Not a valid boolean string')
+    return s == 'true'
+
 
 class HGEWrkBench(HGETestSetup):
 
@@ -36,14 +55,63 @@ class HGEWrkBench(HGETestSetup):
 
     rps_steps = [10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
 
+    # Maximum number of request bodies generated for queries with variables
+    max_request_bodies = 100000
+
+    # The saturation search starts at this rate and doubles it until the SLOs are violated
+    max_rps_search_start = 50
+
+    # Upper bound for the saturation search
+    max_rps_search_limit = 100000
+
+    # The saturation search stops bisecting once the interval between the
+    # highest passing rate and the lowest failing rate is within this fraction
+    max_rps_search_precision = 0.05
+
+    # Subscriptions are benchmarked on this table, which is created in the
+    # database of the GraphQL engine under test
+    subscription_rows_table = {
+        'schema': 'hge_sub_bench',
+        'name': 'rows'
+    }
+
+    subscription_query = '''
+subscription subscription_one_row($id: Int!) {
+  hge_sub_bench_rows(where: {id: {_eq: $id}}) {
+    id
+    mutated_at
+  }
+}'''
+
+    subscription_mutation = '''
+mutation mutate_row($id: Int!, $mutated_at: float8!) {
+  update_hge_sub_bench_rows(where: {id: {_eq: $id}}, _set: {mutated_at: $mutated_at}) {
+    affected_rows
+  }
+}'''
+
     def __init__(
             self, pg_url, remote_pg_url, pg_docker_image, hge_url=None,
             remote_hge_url=None, hge_docker_image=None,
             hge_args=[], skip_stack_build=False,
             graphql_queries_file='queries.graphql', connections=50,
-            duration=300, results_hge_url = None, results_hge_admin_secret = None
+            duration=300, results_hge_url = None, results_hge_admin_secret = None,
+            max_rps_method='wrk', slo_p99_latency=100, slo_error_rate=0.01,
+            max_rps_probe_duration=30, parallel_stacks=1,
+            subscription_connections=1000, subscription_rows=100,
+            subscription_mutations_per_sec=10, subscription_duration=60,
+            workload_profiles=[], query_variables_file=None,
+            resource_sample_interval=1, metadata_concurrency=1,
+            pg_snapshot_dir=None, skip_pg_snapshots=False, scale_factor=1,
+            warmup_duration=0, trials=1, metadata_bench_tables=[100, 500, 1000],
+            metadata_bench_roles=5, metadata_bench_reloads=3,
+            metadata_api_bench_tables=[10, 50, 100], remote_stand_in=False,
+            stand_in_latency=0, stand_in_jitter=0, stand_in_payload_size=0
     ):
         self.load_queries(graphql_queries_file)
+        self.load_query_variables(query_variables_file)
+        self.parallel_stacks = parallel_stacks
+        self.stack_cpusets = self.get_stack_cpusets(parallel_stacks) if parallel_stacks > 1 else [None]
         super().__init__(
             pg_url = pg_url,
             remote_pg_url = remote_pg_url,
@@ -52,12 +120,37 @@ class HGEWrkBench(HGETestSetup):
             remote_hge_url = remote_hge_url,
             hge_docker_image = hge_docker_image,
             hge_args = hge_args,
-            skip_stack_build = skip_stack_build
+            skip_stack_build = skip_stack_build,
+            cpuset = self.stack_cpusets[0],
+            metadata_concurrency = metadata_concurrency,
+            pg_snapshot_dir = pg_snapshot_dir,
+            skip_pg_snapshots = skip_pg_snapshots,
+            scale_factor = scale_factor,
+            remote_stand_in = remote_stand_in,
+            stand_in_latency = stand_in_latency,
+            stand_in_jitter = stand_in_jitter,
+            stand_in_payload_size = stand_in_payload_size
         )
         self.connections = connections
         self.duration = duration
         self.results_hge_url = results_hge_url
         self.results_hge_admin_secret = results_hge_admin_secret
+        self.max_rps_method = max_rps_method
+        self.slo_p99_latency = slo_p99_latency
+        self.slo_error_rate = slo_error_rate
+        self.max_rps_probe_duration = max_rps_probe_duration
+        self.subscription_connections = subscription_connections
+        self.subscription_rows = subscription_rows
+        self.subscription_mutations_per_sec = subscription_mutations_per_sec
+        self.subscription_duration = subscription_duration
+        self.workload_profiles = workload_profiles
+        self.resource_sample_interval = resource_sample_interval
+        self.warmup_duration = warmup_duration
+        self.trials = trials
+        self.metadata_bench_tables = metadata_bench_tables
+        self.metadata_bench_roles = metadata_bench_roles
+        self.metadata_bench_reloads = metadata_bench_reloads
+        self.metadata_api_bench_tables = metadata_api_bench_tables
         self.extract_cpu_info()
         # NOTE: we generally want to do this just once; otherwise if we happen
         # to be editing the tree while this script is running the shasum will
@@ -74,8 +167,68 @@ class HGEWrkBench(HGETestSetup):
             self.query_names.append(oper.name.value)
             self.queries.append(oper)
 
+    def load_query_variables(self, query_variables_file):
+        """
+        Load the specification of the variables of the queries, which is a
+        mapping from the name of each query to the specifications of its
+        variables (see variable_generators.make_variable_generator)
+        """
+        self.query_variables = {}
+        self.variables_generators = {}
+        if query_variables_file:
+            with open(query_variables_file) as f:
+                self.query_variables = yaml.safe_load(f) or {}
+
+    def get_variables_generator(self, query):
+        name = query.name.value
+        if name not in self.query_variables:
+            return None
+        # The generators may read values from the database, so make them only once
+        if name not in self.variables_generators:
+            self.variables_generators[name] = make_variables_generator(self.query_variables[name], self.pg)
+        return self.variables_generators[name]
+
+    def gen_query_variables(self, query):
+        gen = self.get_variables_generator(query)
+        return gen() if gen else {}
+
+    def write_request_bodies(self, query, count, bodies_dir):
+        """
+        If the query has variables, write count (up to max_request_bodies) request
+        bodies with generated variables, one per line, to a file in bodies_dir.
+        Returns the file, or None if the query has no variables
+        """
+        gen = self.get_variables_generator(query)
+        if not gen:
+            return None
+        os.makedirs(bodies_dir, exist_ok=True)
+        bodies_file = os.path.join(bodies_dir, 'request_bodies.jsonl')
+        query_str = graphql.print_ast(query)
+        with open(bodies_file, 'w') as f:
+            for _ in range(min(count, self.max_request_bodies)):
+                f.write(json.dumps({'query': query_str, 'variables': gen()}) + '\n')
+        return bodies_file
+
+    @staticmethod
+    def get_stack_cpusets(num_stacks):
+        """
+        Split the CPUs available to this process into num_stacks disjoint sets.
+        Each set is given as a comma separated list of CPUs
+        """
+        cpus = sorted(os.sched_getaffinity(0))
+        if len(cpus) < num_stacks:
+            raise ValueError("Cannot run {} parallel stacks with only {} CPUs".format(num_stacks, len(cpus)))
+        per_stack = len(cpus) // num_stacks
+        return [
+            ','.join(str(c) for c in cpus[i*per_stack:(i+1)*per_stack])
+            for i in range(num_stacks)
+        ]
+
     def get_wrk2_params(self):
-        cpu_count = multiprocessing.cpu_count()
+        if self.cpuset:
+            cpu_count = len(self.cpuset.split(','))
+        else:
+            cpu_count = multiprocessing.cpu_count()
         return {
             'threads': cpu_count,
             'connections': self.connections,
@@ -85,7 +238,31 @@ class HGEWrkBench(HGETestSetup):
     def get_current_user(self):
         return '{}:{}'.format(os.geteuid(), os.getegid())
 
-    def wrk2_test(self, query, rps):
+    def wrk2_trials(self, query, rps):
+        """
+        Warm up graphql-engine with the query at rps requests/sec, discarding the
+        results, and then run the given number of trials. Each trial is stored as
+        a separate result, with the same trial group
+        """
+        if self.warmup_duration > 0:
+            self.wrk2_warmup(query, rps)
+        trial_group = str(uuid.uuid4())
+        return [
+            self.wrk2_test(query, rps, trial=(trial_group, k))
+            for k in range(1, self.trials + 1)
+        ]
+
+    def wrk2_warmup(self, query, rps):
+        print(Fore.GREEN + "Warming up with wrk2 at {} req/s for {} seconds for query {}".format(
+            rps, self.warmup_duration, query.name.value) + Style.RESET_ALL)
+        warmup_dir = os.path.join(self.results_root_dir, str(rps), 'warmup')
+        os.makedirs(warmup_dir, exist_ok=True)
+        try:
+            self.run_wrk2(query, rps, self.warmup_duration, warmup_dir, sample_resources=False)
+        finally:
+            shutil.rmtree(warmup_dir, ignore_errors=True)
+
+    def wrk2_test(self, query, rps, trial=None):
         def upload_files(files):
             if self.upload_root_uri:
                 p = urlparse(self.upload_root_uri)
@@ -98,51 +275,31 @@ class HGEWrkBench(HGETestSetup):
 
         query_str = graphql.print_ast(query)
         params = self.get_wrk2_params()
-        print(Fore.GREEN + "Running benchmark wrk2 for at {} req/s (duration: {}) for query\n".format(rps, params['duration']), query_str +  Style.RESET_ALL)
-        bench_script = os.path.join(self.lua_dir, 'bench-wrk2.lua')
-        graphql_url = self.hge.url + '/v1/graphql'
+        trial_info = ', trial {} of {}'.format(trial[1], self.trials) if trial and self.trials > 1 else ''
+        print(Fore.GREEN + "Running benchmark wrk2 for at {} req/s (duration: {}{}) for query\n".format(rps, params['duration'], trial_info), query_str +  Style.RESET_ALL)
         timestamp = datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
         results_dir = self.results_root_dir
         tests_path = [str(rps), timestamp]
+        if trial and self.trials > 1:
+            tests_path[-1] += '_trial-{}'.format(trial[1])
         results_dir = os.path.join(results_dir, *tests_path)
         os.makedirs(results_dir, exist_ok=True)
-        wrk2_command = [
-            'wrk2',
-            '-R', str(rps),
-            '-t', str(params['threads']),
-            '-c', str(params['connections']),
-            '-d', str(params['duration']),
-            '--latency',
-            '-s', bench_script,
-            graphql_url,
-            query_str,
-            results_dir
-        ]
-        volumes = self.get_scripts_vol()
-        volumes[results_dir] = {
-            'bind': results_dir,
-            'mode': 'rw'
-        }
-        self.docker_client = docker.from_env()
-        result = self.docker_client.containers.run(
-            self.wrk_docker_image,
-            detach = False,
-            stdout = True,
-            stderr = False,
-            command = wrk2_command,
-            network_mode = 'host',
-            environment = self.get_lua_env(),
-            volumes = volumes,
-            remove = True,
-            user = self.get_current_user()
-        ).decode('ascii')
+        result = self.run_wrk2(query, rps, params['duration'], results_dir)
         histogram_file = os.path.join(results_dir, 'latencies.hgrm')
-        histogram = self.get_latency_histogram(result, histogram_file)
+        (histogram, latency_parser) = self.get_latency_histogram(result, histogram_file)
+        hdr_histogram_file = os.path.join(results_dir, 'latencies.hlog')
+        write_hdr_histogram_log(latency_parser.hdr_histogram, hdr_histogram_file, params['duration'])
+        hdr_histogram = latency_parser.encoded_hdr_histogram()
 
         summary_file = os.path.join(results_dir, 'summary.json')
         with open(summary_file) as f:
             summary = json.load(f)
         latencies_file = os.path.join(results_dir, 'latencies')
+        resource_usage_file = os.path.join(results_dir, 'resource_usage.json')
+        resource_usage = None
+        if os.path.exists(resource_usage_file):
+            with open(resource_usage_file) as f:
+                resource_usage = json.load(f)
 
         def extract_data(v):
             return v['data'] if isinstance(v, dict) and 'data' in v else v
@@ -157,65 +314,96 @@ class HGEWrkBench(HGETestSetup):
                     (summary_file, 'summary.json'),
                     (latencies_file, 'latencies'),
                     (histogram_file, 'latencies.hgrm'),
-                    (tests_setup_file, 'test_setup.json')
+                    (hdr_histogram_file, 'latencies.hlog'),
+                    (tests_setup_file, 'test_setup.json'),
+                    (resource_usage_file, 'resource_usage.json')
             ]
+            if os.path.exists(x)
         ])
         if self.upload_root_uri:
             latencies_uri = uri_path_join(self.upload_root_uri, *tests_path, 'latencies')
         else:
             latencies_uri = pathlib.Path(latencies_file).as_uri()
-        self.insert_result(query, rps, summary, histogram, latencies_uri)
+        self.insert_result(query, rps, summary, histogram, latencies_uri, hdr_histogram, resource_usage=resource_usage, trial=trial)
         return (summary, histogram)
 
-    def get_latency_histogram(self, result, write_histogram_file):
-        const_true = lambda l : True
-        state_changes = {
-            'start' : {
-                (lambda l: 'Detailed Percentile spectrum' in l) :  'histogram_start'
-            },
-            'histogram_start': {
-                (lambda l: 'Value' in l and 'Percentile' in l): 'histogram_headers'
-            },
-            'histogram_headers': {
-                const_true: 'histogram_empty_line'
-            },
-            'histogram_empty_line' : {
-                const_true: 'histogram_values'
-            },
-            'histogram_values': {
-                (lambda l: l.strip().startswith('#')): 'histogram_summary'
-            },
-            'histogram_summary': {
-                (lambda l: not l.strip().startswith('#')): 'histogram_end'
-            }
+    def run_wrk2(self, query, rps, duration, results_dir, sample_resources=True):
+        """
+        Run wrk2 at a fixed rate of rps requests/sec against the query.
+        The summary and the latencies are written to results_dir by the Lua script,
+        and the output of wrk2 (containing the latency histogram) is returned
+        """
+        params = self.get_wrk2_params()
+        bodies_file = self.write_request_bodies(query, rps * duration, results_dir)
+        if bodies_file:
+            bench_script = os.path.join(self.lua_dir, 'bench-wrk2-variables.lua')
+            script_args = [bodies_file, results_dir]
+        else:
+            bench_script = os.path.join(self.lua_dir, 'bench-wrk2.lua')
+            script_args = [graphql.print_ast(query), results_dir]
+        graphql_url = self.hge.url + '/v1/graphql'
+        wrk2_command = [
+            'wrk2',
+            '-R', str(rps),
+            '-t', str(params['threads']),
+            '-c', str(params['connections']),
+            '-d', str(duration),
+            '--latency',
+            '-s', bench_script,
+            graphql_url,
+            *script_args
+        ]
+        volumes = self.get_scripts_vol()
+        volumes[results_dir] = {
+            'bind': results_dir,
+            'mode': 'rw'
         }
-        state = 'start'
-        histogram = []
+        self.docker_client = docker.from_env()
+        with self.sample_resource_usage(results_dir, enabled=sample_resources):
+            return self.docker_client.containers.run(
+                self.wrk_docker_image,
+                detach = False,
+                stdout = True,
+                stderr = False,
+                command = wrk2_command,
+                network_mode = 'host',
+                environment = self.get_lua_env(),
+                volumes = volumes,
+                remove = True,
+                user = self.get_current_user(),
+                cpuset_cpus = self.cpuset
+            ).decode('ascii')
+
+    @contextmanager
+    def sample_resource_usage(self, results_dir, enabled=True):
+        """
+        Sample the resource usage of graphql-engine and Postgres while the benchmark
+        in the block is running, and write the samples to resource_usage.json in results_dir
+        """
+        if not enabled or not self.resource_sample_interval:
+            yield
+            return
+        sampler = ResourceSampler(self.hge, self.pg, self.resource_sample_interval)
+        with sampler:
+            yield
+        sampler.write(os.path.join(results_dir, 'resource_usage.json'))
+        summary = sampler.get_summary()
+        print(Fore.CYAN + "Resource usage: HGE {}, Postgres {}".format(summary['hge'], summary['postgres']) + Style.RESET_ALL)
+
+    def get_latency_histogram(self, result, write_histogram_file):
+        """
+        Parse the latency histogram from the output of wrk2, and write it to
+        write_histogram_file in the .hgrm format.
+        Returns the percentile spectrum and the parser holding the HdrHistogram
+        """
+        parser = Wrk2LatencyParser().feed_lines(result.splitlines())
         print(Fore.CYAN + "Latency histogram summary" + Style.RESET_ALL)
+        for line in parser.summary_lines:
+            print(Fore.CYAN + line + Style.RESET_ALL)
         with open(write_histogram_file, 'w') as f:
-            for line in result.splitlines():
-                # Change the state
-                for (check, next_state) in state_changes[state].items():
-                    if check(line):
-                        state = next_state
-                        break
-                if state == 'start':
-                    continue
-                elif state == 'histogram_end':
-                    break
-                if state == 'histogram_summary':
-                    print(Fore.CYAN + line + Style.RESET_ALL)
-                if state in ['histogram_headers','histogram_values','histogram_summary']:
-                    f.write(line+'\n')
-
-                if state == 'histogram_values':
-                    (val, percentile, total_count, _) = line.strip().split()
-                    histogram.append({
-                        'percentile': float(percentile),
-                        'latency': float(val),
-                        'total_count': float(total_count)
-                    })
-        return histogram
+            for line in parser.hgrm_lines:
+                f.write(line+'\n')
+        return (parser.histogram, parser)
 
     # The appropriate Lua env vars for execution within wrk container:
     def get_lua_env(self):
@@ -234,13 +422,27 @@ class HGEWrkBench(HGETestSetup):
         }
 
     def max_rps_test(self, query):
+        if self.max_rps_method == 'wrk2-search':
+            return self.max_sustainable_rps_test(query)
         query_str = graphql.print_ast(query)
         print(Fore.GREEN + "(Compute maximum Request per second) Running wrk benchmark for query\n", query_str + Style.RESET_ALL)
-        self.hge.graphql_q(query_str) # Test query once for errors
-        bench_script = os.path.join(self.lua_dir + '/bench-wrk.lua')
+        self.hge.graphql_q(query_str, self.gen_query_variables(query)) # Test query once for errors
         graphql_url = self.hge.url + '/v1/graphql'
         params = self.get_wrk2_params()
         duration = 30
+        volumes = self.get_scripts_vol()
+        bodies_dir = os.path.join(self.results_root_dir, 'max_rps')
+        bodies_file = self.write_request_bodies(query, self.max_request_bodies, bodies_dir)
+        if bodies_file:
+            bench_script = os.path.join(self.lua_dir, 'bench-wrk-variables.lua')
+            script_args = [bodies_file]
+            volumes[bodies_dir] = {
+                'bind': bodies_dir,
+                'mode': 'ro'
+            }
+        else:
+            bench_script = os.path.join(self.lua_dir, 'bench-wrk.lua')
+            script_args = [query_str]
         wrk_command = [
             'wrk',
             '-t', str(params['threads']),
@@ -249,29 +451,216 @@ class HGEWrkBench(HGETestSetup):
             '--latency',
             '-s', bench_script,
             graphql_url,
-            query_str
+            *script_args
         ]
         self.docker_client = docker.from_env()
 
-        result = self.docker_client.containers.run(
-            self.wrk_docker_image,
-            detach = False,
-            stdout = False,
-            stderr = True,
-            command = wrk_command,
-            network_mode = 'host',
-            environment = self.get_lua_env(),
-            volumes = self.get_scripts_vol(),
-            remove = True,
-            user = self.get_current_user()
-        )
+        os.makedirs(bodies_dir, exist_ok=True)
+        with self.sample_resource_usage(bodies_dir):
+            result = self.docker_client.containers.run(
+                self.wrk_docker_image,
+                detach = False,
+                stdout = False,
+                stderr = True,
+                command = wrk_command,
+                network_mode = 'host',
+                environment = self.get_lua_env(),
+                volumes = volumes,
+                remove = True,
+                user = self.get_current_user(),
+                cpuset_cpus = self.cpuset
+            )
         summary = json.loads(result)['summary']
         # TODO explain this calculation. Why aren't we using wrk's reported 'max'? Should we call this avg_sustained_rps or something?
         max_rps = round(summary['requests']/float(duration))
-        self.insert_max_rps_result(query, max_rps)
+        self.insert_max_rps_result(query, max_rps, resource_usage=self.load_resource_usage_summary(bodies_dir))
         print("Max RPS", max_rps)
         return max_rps
 
+    def load_resource_usage_summary(self, results_dir):
+        resource_usage_file = os.path.join(results_dir, 'resource_usage.json')
+        if not os.path.exists(resource_usage_file):
+            return None
+        with open(resource_usage_file) as f:
+            return json.load(f)['summary']
+
+    def get_slo(self):
+        return {
+            'p99_latency': self.slo_p99_latency,
+            'error_rate': self.slo_error_rate
+        }
+
+    def max_sustainable_rps_test(self, query):
+        """
+        Search for the highest request rate the GraphQL engine can sustain for the
+        query while staying within the latency and error rate SLOs.
+        The load is generated by wrk2 at fixed rates, so that the latencies are
+        corrected for coordinated omission. The rate is doubled until the SLOs are
+        violated, and then bisected between the last passing and the first failing rate.
+        """
+        query_str = graphql.print_ast(query)
+        print(Fore.GREEN + "(Compute maximum sustainable requests per second) Running wrk2 saturation search for query\n", query_str + Style.RESET_ALL)
+        self.hge.graphql_q(query_str, self.gen_query_variables(query)) # Test query once for errors
+        slo = self.get_slo()
+        probes = []
+
+        def within_slo(rps):
+            (p99_latency, error_rate, resource_usage) = self.wrk2_probe(query, rps)
+            passed = p99_latency <= slo['p99_latency'] and error_rate <= slo['error_rate']
+            probes.append({
+                'requests_per_sec': rps,
+                'p99_latency': p99_latency,
+                'error_rate': error_rate,
+                'within_slo': passed,
+                'resource_usage': resource_usage
+            })
+            color = Fore.GREEN if passed else Fore.RED
+            print(color + "{} req/s: p99 latency {} ms, error rate {}".format(rps, p99_latency, error_rate) + Style.RESET_ALL)
+            return passed
+
+        max_rps = 0
+        rps = self.max_rps_search_start
+        while rps <= self.max_rps_search_limit and within_slo(rps):
+            max_rps = rps
+            rps *= 2
+        failed_rps = rps
+        if rps > self.max_rps_search_limit:
+            # Every doubling passed: probe the limit itself, rather than
+            # assuming it fails
+            failed_rps = self.max_rps_search_limit
+            if max_rps < failed_rps and within_slo(failed_rps):
+                max_rps = failed_rps
+        # The engine sustains at least the search limit, which is then reported
+        capped = max_rps == self.max_rps_search_limit
+        while not capped and failed_rps - max_rps > max(1, max_rps * self.max_rps_search_precision):
+            rps = (max_rps + failed_rps) // 2
+            if within_slo(rps):
+                max_rps = rps
+            else:
+                failed_rps = rps
+
+        search_info = {
+            'slo': slo,
+            'probe_duration': self.max_rps_probe_duration,
+            'probes': probes,
+            'capped_at_search_limit': capped
+        }
+        if capped:
+            print(Fore.YELLOW + "Max sustainable RPS is capped at the search limit {}".format(self.max_rps_search_limit) + Style.RESET_ALL)
+        self.insert_max_rps_result(query, max_rps, search_info)
+        print("Max sustainable RPS", max_rps)
+        return max_rps
+
+    def wrk2_probe(self, query, rps):
+        """
+        Run wrk2 for a short duration at the given rate.
+        Returns the p99 latency (in milliseconds), the error rate and the
+        summary of the resource usage during the run
+        """
+        timestamp = datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
+        results_dir = os.path.join(self.results_root_dir, 'max_rps_search', str(rps), timestamp)
+        os.makedirs(results_dir, exist_ok=True)
+        result = self.run_wrk2(query, rps, self.max_rps_probe_duration, results_dir)
+        histogram_file = os.path.join(results_dir, 'latencies.hgrm')
+        (histogram, _) = self.get_latency_histogram(result, histogram_file)
+        with open(os.path.join(results_dir, 'summary.json')) as f:
+            summary = json.load(f)['summary']
+        p99_latency = next(
+            (e['latency'] for e in histogram if e['percentile'] >= 0.99),
+            float('inf')
+        )
+        errors = sum(summary['errors'].values())
+        error_rate = errors / summary['requests'] if summary['requests'] else 1.0
+        return (p99_latency, error_rate, self.load_resource_usage_summary(results_dir))
+
+    def setup_subscription_rows(self):
+        schema = self.subscription_rows_table['schema']
+        name = self.subscription_rows_table['name']
+        self.hge.run_sql('''
+create schema if not exists {schema};
+create table if not exists {schema}.{name} (
+  id integer primary key,
+  mutated_at double precision not null default 0
+);
+insert into {schema}.{name} (id)
+  select generate_series(1, {rows})
+  on conflict do nothing;
+'''.format(schema=schema, name=name, rows=self.subscription_rows))
+        if self.subscription_rows_table not in self.hge.get_all_tracked_tables():
+            self.hge.track_table(self.subscription_rows_table)
+
+    def subscription_test(self):
+        """
+        Open subscriptions on rows of a table over many websocket connections,
+        update the rows at a fixed rate, and measure how long it takes for the
+        updates to be delivered to the subscribers
+        """
+        subscription = graphql.parse(self.subscription_query).definitions[0]
+        print(Fore.GREEN + "Running subscription benchmark with {} connections on {} rows for query\n".format(
+            self.subscription_connections, self.subscription_rows), self.subscription_query + Style.RESET_ALL)
+        self.setup_subscription_rows()
+
+        def mutate_row(row_id, mutated_at):
+            self.hge.graphql_q(self.subscription_mutation, {'id': row_id, 'mutated_at': mutated_at})
+
+        ws_url = urlparse(self.hge.url)._replace(scheme='ws', path='/v1/graphql').geturl()
+        load = SubscriptionLoad(
+            ws_url = ws_url,
+            headers = self.hge.admin_auth_headers(),
+            subscription = self.subscription_query,
+            mutate_row = mutate_row,
+            rows = self.subscription_rows,
+            connections = self.subscription_connections,
+            mutations_per_sec = self.subscription_mutations_per_sec,
+            duration = self.subscription_duration,
+            memory_usage = self.hge.get_memory_usage
+        ).run()
+        results = load.get_results()
+        print(Fore.CYAN + "Update delivery latency percentiles (ms):", results['latency_percentiles'], Style.RESET_ALL)
+        print(Fore.CYAN + "HGE memory after subscribing: {}, max: {}".format(
+            results['hge_memory']['after_subscribing'], results['hge_memory']['max']) + Style.RESET_ALL)
+        self.insert_subscription_result(subscription, results)
+        return results
+
+    def run_workload_benchmarks(self, profile_file):
+        profile = WorkloadProfile(profile_file, self.graphql_queries_file, self.pg)
+        print(Fore.GREEN + "Benchmarking workload {} with weights {}".format(profile.name, profile.get_weights()) + Style.RESET_ALL)
+        for op in profile.operations:
+            self.hge.graphql_q(op.query_str, op.gen_variables()) # Test query once for errors
+        for rps in profile.requests_per_sec:
+            self.workload_test(profile, rps)
+
+    def workload_test(self, profile, rps):
+        """
+        Send the mix of operations in the workload profile at rps requests/sec,
+        and store the results of each operation separately
+        """
+        duration = profile.duration or self.duration
+        graphql_url = self.hge.url + '/v1/graphql'
+        ws_url = urlparse(self.hge.url)._replace(scheme='ws', path='/v1/graphql').geturl()
+        workload = MixedWorkload(
+            profile, graphql_url, ws_url, self.hge.admin_auth_headers(),
+            rps, duration, self.connections
+        ).run()
+        weights = profile.get_weights()
+        for op in profile.operations:
+            stats = workload.stats[op.name]
+            histogram = percentile_spectrum(stats.histogram)
+            summary = {
+                'requests': stats.requests,
+                'errors': stats.errors,
+                'duration': duration,
+                'weight': weights[op.name],
+                'subscription_updates_received': workload.updates_received
+            }
+            print(Fore.CYAN + "{}: {} requests, {} errors, p99 latency {} ms".format(
+                op.name, stats.requests, stats.errors,
+                stats.histogram.get_value_at_percentile(99) / 1000.0) + Style.RESET_ALL)
+            self.insert_result(
+                op.query, rps, summary, histogram, None,
+                stats.histogram.encode().decode('ascii'), workload_profile=profile.name
+            )
+
     def get_version(self):
         script = os.path.join(fileLoc, 'gen-version.sh')
         return subprocess.check_output([script]).decode('ascii').strip()
@@ -289,22 +678,37 @@ class HGEWrkBench(HGETestSetup):
     def get_results(self):
         query = '''
 query results {
-  latency: hge_bench_latest_results {
+  latency: hge_bench_latest_results(where: {workload_profile: {_is_null: true}}) {
+    id
+    time
     query_name
     requests_per_sec
     docker_image
     version
     latencies_uri
+    scale_factor
+    trial_group
+    trial
     latency_histogram {
       percentile
       latency
     }
+    trials(order_by: {trial: asc}) {
+      trial
+      latency_histogram {
+        percentile
+        latency
+      }
+    }
   }
   max_rps: hge_bench_avg_query_max_rps {
     query_name
     docker_image
     version
     max_rps
+    method
+    scale_factor
+    time
   }
 }
         '''
@@ -323,6 +727,8 @@ query results {
                 "update_columns": "key"
             }
         }
+        if self.cpuset:
+            insert_var['cpu_set'] = self.cpuset
 
 
     def set_query_info(self, insert_var, query):
@@ -346,6 +752,7 @@ query results {
             insert_var["server_shasum"] = self.server_shasum
 
         insert_var['postgres_version'] = self.pg.get_server_version()
+        insert_var['scale_factor'] = self.scale_factor
         if self.scenario_name:
             insert_var['scenario_name'] = self.scenario_name
 
@@ -360,7 +767,7 @@ query results {
             'args': args
         }
 
-    def gen_max_rps_insert_var(self, query, max_rps):
+    def gen_max_rps_insert_var(self, query, max_rps, search_info=None, resource_usage=None):
         insert_var = dict()
         self.set_cpu_info(insert_var)
         self.set_query_info(insert_var, query)
@@ -368,6 +775,12 @@ query results {
         self.set_hge_args_env_vars(insert_var)
         insert_var['max_rps'] = max_rps
         insert_var['wrk_parameters'] = self.get_wrk2_params()
+        if search_info:
+            insert_var['method'] = 'wrk2-search'
+            insert_var['search_info'] = search_info
+            insert_var['wrk_parameters']['duration'] = self.max_rps_probe_duration
+        if resource_usage:
+            insert_var['resource_usage'] = resource_usage
         return insert_var
 
     def plot_results(self):
@@ -375,7 +788,7 @@ query results {
             time.sleep(1)
             webbrowser.open_new_tab('http://127.0.0.1:8050/')
         threading.Thread(target=open_plot_in_browser).start()
-        run_dash_server(self.get_results())
+        run_dash_server(self.get_results(), os.path.join(self.work_dir, 'latency_cache'), precompute_figures=True)
 
     # Collect info about the test environment
     def gen_test_info(self, query, rps):
@@ -386,19 +799,36 @@ query results {
         self.set_hge_args_env_vars(test_info)
         test_info["requests_per_sec"] = rps
         test_info['wrk2_parameters'] = self.get_wrk2_params()
+        test_info['wrk2_parameters']['warmup_duration'] = self.warmup_duration
+        test_info['wrk2_parameters']['trials'] = self.trials
+        if query.name.value in self.query_variables:
+            test_info['wrk2_parameters']['variables'] = self.query_variables[query.name.value]
         return test_info
 
-    def gen_result_insert_var(self, query, rps, summary, latency_histogram, latencies_uri):
+    def gen_result_insert_var(self, query, rps, summary, latency_histogram, latencies_uri, hdr_histogram, workload_profile=None, resource_usage=None, trial=None):
         insert_var = self.gen_test_info(query, rps)
+        if workload_profile:
+            insert_var['workload_profile'] = workload_profile
+            insert_var['wrk2_parameters'] = {
+                'connections': self.connections,
+                'duration': summary['duration']
+            }
         insert_var["summary"] = summary
         insert_var['latency_histogram'] = {
             'data' : latency_histogram
         }
         insert_var['latencies_uri'] = latencies_uri
+        insert_var['hdr_histogram'] = hdr_histogram
+        if resource_usage:
+            insert_var['resource_usage'] = {
+                'data': [resource_usage]
+            }
+        if trial:
+            (insert_var['trial_group'], insert_var['trial']) = trial
         return insert_var
 
-    def insert_result(self, query, rps, summary, latency_histogram, latencies_uri):
-        result_var = self.gen_result_insert_var(query, rps, summary, latency_histogram, latencies_uri)
+    def insert_result(self, query, rps, summary, latency_histogram, latencies_uri, hdr_histogram, workload_profile=None, resource_usage=None, trial=None):
+        result_var = self.gen_result_insert_var(query, rps, summary, latency_histogram, latencies_uri, hdr_histogram, workload_profile, resource_usage, trial)
         insert_query = """
 mutation insertResult($result: hge_bench_results_insert_input!) {
   insert_hge_bench_results(objects: [$result]){
@@ -408,8 +838,8 @@ mutation insertResult($result: hge_bench_results_insert_input!) {
         variables = {'result': result_var}
         self.results_hge.graphql_q(insert_query, variables)
 
-    def insert_max_rps_result(self, query, max_rps):
-        result_var = self.gen_max_rps_insert_var(query, max_rps)
+    def insert_max_rps_result(self, query, max_rps, search_info=None, resource_usage=None):
+        result_var = self.gen_max_rps_insert_var(query, max_rps, search_info, resource_usage)
         insert_query = """
 mutation insertMaxRps($result: hge_bench_query_max_rps_insert_input!) {
   insert_hge_bench_query_max_rps(objects: [$result]){
@@ -419,6 +849,94 @@ mutation insertMaxRps($result: hge_bench_query_max_rps_insert_input!) {
         variables = {'result': result_var}
         self.results_hge.graphql_q(insert_query, variables)
 
+    def gen_subscription_result_insert_var(self, subscription, results):
+        insert_var = dict()
+        self.set_cpu_info(insert_var)
+        self.set_query_info(insert_var, subscription)
+        self.set_version_info(insert_var)
+        self.set_hge_args_env_vars(insert_var)
+        insert_var['connections'] = self.subscription_connections
+        insert_var['subscribed_rows'] = self.subscription_rows
+        insert_var['mutations_per_sec'] = self.subscription_mutations_per_sec
+        insert_var['duration'] = self.subscription_duration
+        insert_var.update(results)
+        return insert_var
+
+    def insert_subscription_result(self, subscription, results):
+        result_var = self.gen_subscription_result_insert_var(subscription, results)
+        insert_query = """
+mutation insertSubscriptionResult($result: hge_bench_subscription_results_insert_input!) {
+  insert_hge_bench_subscription_results(objects: [$result]){
+    affected_rows
+  }
+}"""
+        variables = {'result': result_var}
+        self.results_hge.graphql_q(insert_query, variables)
+
+    def run_metadata_size_benchmarks(self):
+        benchmark = MetadataSizeBenchmark(
+            self.hge, self.pg, self.metadata_bench_tables,
+            roles = self.metadata_bench_roles,
+            reloads = self.metadata_bench_reloads
+        )
+        for result in benchmark.run():
+            self.insert_metadata_size_result(result)
+
+    def run_metadata_api_benchmarks(self):
+        benchmark = MetadataApiBenchmark(
+            self.hge, self.pg, self.metadata_api_bench_tables,
+            roles = self.metadata_bench_roles
+        )
+        for results in benchmark.run():
+            self.insert_metadata_api_results(results)
+
+    def gen_metadata_result_insert_var(self, result):
+        insert_var = dict()
+        self.set_cpu_info(insert_var)
+        self.set_version_info(insert_var)
+        self.set_hge_args_env_vars(insert_var)
+        insert_var.update(result)
+        return insert_var
+
+    def insert_metadata_size_result(self, result):
+        insert_query = """
+mutation insertMetadataSizeResult($result: hge_bench_metadata_size_results_insert_input!) {
+  insert_hge_bench_metadata_size_results(objects: [$result]){
+    affected_rows
+  }
+}"""
+        variables = {'result': self.gen_metadata_result_insert_var(result)}
+        self.results_hge.graphql_q(insert_query, variables)
+
+    def insert_metadata_api_results(self, results):
+        insert_query = """
+mutation insertMetadataApiResults($results: [hge_bench_metadata_api_results_insert_input!]!) {
+  insert_hge_bench_metadata_api_results(objects: $results){
+    affected_rows
+  }
+}"""
+        variables = {'results': [self.gen_metadata_result_insert_var(r) for r in results]}
+        self.results_hge.graphql_q(insert_query, variables)
+
+    def gen_startup_result_insert_var(self, startup_timings):
+        insert_var = dict()
+        self.set_cpu_info(insert_var)
+        self.set_version_info(insert_var)
+        self.set_hge_args_env_vars(insert_var)
+        insert_var.update(startup_timings)
+        return insert_var
+
+    def insert_startup_result(self, startup_timings):
+        result_var = self.gen_startup_result_insert_var(startup_timings)
+        insert_query = """
+mutation insertStartupResult($result: hge_bench_startup_results_insert_input!) {
+  insert_hge_bench_startup_results(objects: [$result]){
+    affected_rows
+  }
+}"""
+        variables = {'result': result_var}
+        self.results_hge.graphql_q(insert_query, variables)
+
     def setup_results_schema(self):
         if not self.results_hge_url:
             self.results_hge_url = self.hge.url
@@ -432,15 +950,34 @@ mutation insertMaxRps($result: hge_bench_query_max_rps_insert_input!) {
             'name' : 'results',
             'schema': 'hge_bench'
         }
-        if results_table in self.results_hge.get_all_tracked_tables():
-            return
+        tracked_tables = self.results_hge.get_all_tracked_tables()
         schema_file = os.path.join(fileLoc, 'results_schema.yaml')
         with open(schema_file) as f:
             queries = yaml.safe_load(f)
+        if results_table in tracked_tables:
+            relationships = self.results_hge.get_all_relationships('hge_bench')
+            queries = self.get_results_schema_migrations(queries, tracked_tables, relationships)
         self.results_hge.run_bulk(queries)
 
+    def get_results_schema_migrations(self, queries, tracked_tables, relationships):
+        """
+        The results schema already exists. The SQL in the schema file is idempotent,
+        so run it again to apply the changes made since the schema was created.
+        Track the new tables, and create only the new relationships.
+        """
+        migrations = []
+        for q in queries:
+            if q['type'] == 'run_sql':
+                migrations.append(q)
+            elif q['type'] == 'track_table':
+                if q['args'] not in tracked_tables:
+                    migrations.append(q)
+            elif (q['args']['table'], q['args']['name']) not in relationships:
+                migrations.append(q)
+        return migrations
 
-    def run_query_benchmarks(self):
+
+    def run_query_benchmarks(self, queries=None):
         def get_results_root_dir(query):
             if self.hge_docker_image:
                 ver_info = 'docker-tag-' + self.hge_docker_image.split(':')[1]
@@ -451,7 +988,7 @@ mutation insertMaxRps($result: hge_bench_query_max_rps_insert_input!) {
             results_root_dir = os.path.abspath(os.path.join(self.work_dir, 'benchmark_runs'))
             return os.path.join(results_root_dir, ver_info, query_name)
 
-        for query in self.queries:
+        for query in queries or self.queries:
             try:
                 self.results_root_dir = get_results_root_dir(query)
                 max_rps = self.max_rps_test(query)
@@ -460,16 +997,68 @@ mutation insertMaxRps($result: hge_bench_query_max_rps_insert_input!) {
                 print("Benchmarking queries with wrk2 for the following requests/sec", rps_steps)
                 for rps in rps_steps:
                     if rps < int(0.6*max_rps):
-                        self.wrk2_test(query, rps)
+                        self.wrk2_trials(query, rps)
             except Exception:
                 print(Fore.RED + "Benchmarking Graphql Query '" + query.name.value + "' failed" + Style.RESET_ALL)
                 raise
 
+    def new_stack(self, index):
+        """
+        Create a copy of this benchmark with its own Postgres databases and
+        GraphQL engines, pinned to the index-th CPU set
+        """
+        stack = copy.copy(self)
+        stack.work_dir = os.path.join(self.work_dir, 'stacks', str(index))
+        os.makedirs(stack.work_dir, exist_ok=True)
+        stack.cpuset = self.stack_cpusets[index]
+        # The build (if any) is done while setting up the first stack
+        stack.skip_stack_build = True
+        stack.init_pgs()
+        stack.init_hges()
+        return stack
+
+    def run_parallel_query_benchmarks(self):
+        """
+        Shard the queries across independent stacks of Postgres databases and
+        GraphQL engines, each pinned to a disjoint CPU set, and benchmark the
+        shards in parallel. The first stack is this one.
+        """
+        stacks = [self] + [self.new_stack(i) for i in range(1, self.parallel_stacks)]
+        shards = [self.queries[i::len(stacks)] for i in range(len(stacks))]
+        print("Running benchmarks on {} stacks with CPU sets {}".format(len(stacks), self.stack_cpusets))
+        with ThreadPoolExecutor(max_workers=len(stacks)) as executor:
+            try:
+                setups = [executor.submit(stack._setup_graphql_engines) for stack in stacks[1:]]
+                for setup in setups:
+                    setup.result()
+                runs = [
+                    executor.submit(stack.run_query_benchmarks, shard)
+                    for (stack, shard) in zip(stacks, shards) if shard
+                ]
+                for run in runs:
+                    run.result()
+            finally:
+                for stack in stacks[1:]:
+                    stack.teardown()
+
     def run_tests(self):
         with self.graphql_engines_setup():
             self.setup_results_schema()
+            # Only when the GraphQL engine under test was started by us
+            if self.hge.startup_timings:
+                self.insert_startup_result(self.hge.startup_timings)
             if self.run_benchmarks:
-                self.run_query_benchmarks()
+                if self.parallel_stacks > 1:
+                    self.run_parallel_query_benchmarks()
+                else:
+                    self.run_query_benchmarks()
+            if self.run_subscription_benchmarks:
+                self.subscription_test()
+            for profile_file in self.workload_profiles:
+                self.run_workload_benchmarks(profile_file)
+            if self.run_metadata_benchmarks:
+                self.run_metadata_size_benchmarks()
+                self.run_metadata_api_benchmarks()
             if not self.skip_plots:
                 self.plot_results()
 
@@ -489,21 +1078,46 @@ class HGEWrkBenchArgs(HGETestSetupArgs):
         self.parse_wrk_options()
 
     def set_wrk_options(self):
-        def boolean_string(s):
-            s = s.lower()
-            if s not in {'false', 'true'}:
-                raise ValueError('Not a valid boolean string')
-            return s == 'true'
         wrk_opts = self.arg_parser.add_argument_group('wrk')
         wrk_opts.add_argument('--queries-file', metavar='HASURA_BENCH_QUERIES_FILE', help='Queries file for benchmarks', default='queries.graphql')
         wrk_opts.add_argument('--connections', metavar='HASURA_BENCH_CONNECTIONS', help='Total number of open connections', default=50)
         wrk_opts.add_argument('--duration', metavar='HASURA_BENCH_DURATION', help='Duration of tests in seconds', default=300)
+        wrk_opts.add_argument('--warmup-duration', metavar='HASURA_BENCH_WARMUP_DURATION', help='Duration in seconds of the wrk2 run before the trials of each query and requests/sec, whose results are discarded', default=0, type=int)
+        wrk_opts.add_argument('--trials', metavar='HASURA_BENCH_TRIALS', help='Number of wrk2 runs (each stored as a separate result) for each query and requests/sec (default: 1)', default=None, type=int)
         wrk_opts.add_argument('--upload-root-uri', metavar='HASURA_BENCH_UPLOAD_ROOT_URI', help='The URI to which the latency results should be uploaded. Curently only s3 is supported', required=False)
         wrk_opts.add_argument('--set-scenario-name', metavar='HASURA_BENCH_SCENARIO_NAME', help='Set a name for the test scenario. This will be shown in logs', required=False)
         wrk_opts.add_argument('--results-hge-url', metavar='HASURA_BENCH_RESULTS_HGE_URL', help='The GraphQL engine to which the results should be uploaded', required=False)
         wrk_opts.add_argument('--results-hge-admin-secret', metavar='HASURA_BENCH_RESULTS_HGE_ADMIN_SECRET', help='Admin secret of the GraphQL engine to which the results should be uploaded', required=False)
         wrk_opts.add_argument('--skip-plots', help='Skip plotting', action='store_true', required=False)
         wrk_opts.add_argument('--run-benchmarks', metavar='HASURA_BENCH_RUN_BENCHMARKS', help='Whether benchmarks should be run or not', default=True, type=boolean_string)
+        wrk_opts.add_argument('--run-subscription-benchmarks', metavar='HASURA_BENCH_RUN_SUBSCRIPTION_BENCHMARKS', help='Whether the subscription benchmark should be run or not (default: false)', default=None, type=boolean_string)
+        wrk_opts.add_argument('--subscription-connections', metavar='HASURA_BENCH_SUBSCRIPTION_CONNECTIONS', help='Number of websocket connections (each with one subscription) in the subscription benchmark', default=1000, type=int)
+        wrk_opts.add_argument('--subscription-rows', metavar='HASURA_BENCH_SUBSCRIPTION_ROWS', help='Number of distinct rows the subscriptions are spread over', default=100, type=int)
+        wrk_opts.add_argument('--subscription-mutations-per-sec', metavar='HASURA_BENCH_SUBSCRIPTION_MUTATIONS_PER_SEC', help='Rate at which the subscribed rows are updated', default=10, type=float)
+        wrk_opts.add_argument('--subscription-duration', metavar='HASURA_BENCH_SUBSCRIPTION_DURATION', help='Duration of the subscription benchmark in seconds', default=60, type=int)
+        wrk_opts.add_argument('--run-metadata-benchmarks', metavar='HASURA_BENCH_RUN_METADATA_BENCHMARKS', help='Whether the benchmarks of growing metadata should be run or not (default: false)', default=None, type=boolean_string)
+        wrk_opts.add_argument('--metadata-bench-tables', metavar='HASURA_BENCH_METADATA_BENCH_TABLES', help='Comma separated numbers of tables generated for the metadata benchmarks (default: 100,500,1000)', default='100,500,1000')
+        wrk_opts.add_argument('--metadata-bench-roles', metavar='HASURA_BENCH_METADATA_BENCH_ROLES', help='Number of roles with permissions on each generated table in the metadata benchmarks', default=5, type=int)
+        wrk_opts.add_argument('--metadata-api-bench-tables', metavar='HASURA_BENCH_METADATA_API_BENCH_TABLES', help='Comma separated numbers of tables for which the latencies of the metadata APIs are measured (default: 10,50,100)', default='10,50,100')
+        wrk_opts.add_argument('--metadata-bench-reloads', metavar='HASURA_BENCH_METADATA_BENCH_RELOADS', help='Number of times reload_metadata is timed for each number of tables', default=3, type=int)
+        wrk_opts.add_argument('--resource-sample-interval', metavar='HASURA_BENCH_RESOURCE_SAMPLE_INTERVAL', help='Interval in seconds at which the resource usage of GraphQL engine and Postgres is sampled during each run (default: 1, 0 to disable)', default=None, type=float)
+        wrk_opts.add_argument('--query-variables', metavar='HASURA_BENCH_QUERY_VARIABLES', help='YAML file with the generators of the variables of the queries', required=False)
+        wrk_opts.add_argument('--workload-profile', metavar='HASURA_BENCH_WORKLOAD_PROFILE', help='Workload profile (YAML) with a weighted mix of operations to be benchmarked. Can be given multiple times', action='append', dest='workload_profiles')
+        wrk_opts.add_argument('--max-rps-method', metavar='HASURA_BENCH_MAX_RPS_METHOD', help='Method used to compute the maximum requests/sec. "wrk" runs wrk for 30 seconds, "wrk2-search" searches for the highest rate within the SLOs using wrk2', choices=['wrk', 'wrk2-search'], default=None)
+        wrk_opts.add_argument('--slo-p99-latency', metavar='HASURA_BENCH_SLO_P99_LATENCY', help='Maximum p99 latency (in milliseconds) allowed while searching for the maximum sustainable requests/sec (default: 100)', default=None, type=float)
+        wrk_opts.add_argument('--slo-error-rate', metavar='HASURA_BENCH_SLO_ERROR_RATE', help='Maximum fraction of failed requests allowed while searching for the maximum sustainable requests/sec (default: 0.01)', default=None, type=float)
+        wrk_opts.add_argument('--parallel-stacks', metavar='HASURA_BENCH_PARALLEL_STACKS', help='Number of independent Postgres and GraphQL engine stacks, each pinned to a disjoint set of CPUs, across which the queries are benchmarked in parallel (default: 1)', default=None, type=int)
+        wrk_opts.add_argument('--max-rps-probe-duration', metavar='HASURA_BENCH_MAX_RPS_PROBE_DURATION', help='Duration in seconds of each wrk2 run while searching for the maximum sustainable requests/sec (default: 30)', default=None, type=int)
+
+    def get_param_with_default(self, attr, env_key, default, parse=str):
+        # For the options declared with default=None, since get_param never
+        # reads the environment variable of an option with a (truthy) default.
+        # This also keeps falsy values (like 0 or false) given either way
+        value = getattr(self.parsed_args, attr)
+        if value is not None:
+            return value
+        env_value = os.getenv(env_key)
+        return default if env_value is None else parse(env_value)
 
     def get_s3_caller_identity(self):
         return boto3.client('sts').get_caller_identity()
@@ -520,6 +1134,44 @@ class HGEWrkBenchArgs(HGETestSetupArgs):
                 ('run_benchmarks', 'HASURA_BENCH_RUN_BENCHMARKS'),
                 ('set_scenario_name', 'HASURA_BENCH_SCENARIO_NAME'),
             ])
+        self.max_rps_method = self.get_param_with_default('max_rps_method', 'HASURA_BENCH_MAX_RPS_METHOD', 'wrk')
+        if self.max_rps_method not in ['wrk', 'wrk2-search']:
+            self.arg_parser.error('HASURA_BENCH_MAX_RPS_METHOD should be either wrk or wrk2-search')
+        self.slo_p99_latency = self.get_param_with_default('slo_p99_latency', 'HASURA_BENCH_SLO_P99_LATENCY', 100, float)
+        self.slo_error_rate = self.get_param_with_default('slo_error_rate', 'HASURA_BENCH_SLO_ERROR_RATE', 0.01, float)
+        self.max_rps_probe_duration = self.get_param_with_default('max_rps_probe_duration', 'HASURA_BENCH_MAX_RPS_PROBE_DURATION', 30, int)
+        self.run_subscription_benchmarks = self.get_param_with_default('run_subscription_benchmarks', 'HASURA_BENCH_RUN_SUBSCRIPTION_BENCHMARKS', False, boolean_string)
+        self.subscription_connections, self.subscription_rows, self.subscription_mutations_per_sec, self.subscription_duration = \
+            self.get_params([
+                ('subscription_connections', 'HASURA_BENCH_SUBSCRIPTION_CONNECTIONS'),
+                ('subscription_rows', 'HASURA_BENCH_SUBSCRIPTION_ROWS'),
+                ('subscription_mutations_per_sec', 'HASURA_BENCH_SUBSCRIPTION_MUTATIONS_PER_SEC'),
+                ('subscription_duration', 'HASURA_BENCH_SUBSCRIPTION_DURATION'),
+            ])
+        self.query_variables_file = self.get_param('query_variables', 'HASURA_BENCH_QUERY_VARIABLES')
+        self.resource_sample_interval = self.get_param_with_default('resource_sample_interval', 'HASURA_BENCH_RESOURCE_SAMPLE_INTERVAL', 1, float)
+        self.warmup_duration = int(self.get_param('warmup_duration', 'HASURA_BENCH_WARMUP_DURATION'))
+        self.trials = self.get_param_with_default('trials', 'HASURA_BENCH_TRIALS', 1, int)
+        self.run_metadata_benchmarks = self.get_param_with_default('run_metadata_benchmarks', 'HASURA_BENCH_RUN_METADATA_BENCHMARKS', False, boolean_string)
+        metadata_bench_tables, self.metadata_bench_roles, self.metadata_bench_reloads, metadata_api_bench_tables = \
+            self.get_params([
+                ('metadata_bench_tables', 'HASURA_BENCH_METADATA_BENCH_TABLES'),
+                ('metadata_bench_roles', 'HASURA_BENCH_METADATA_BENCH_ROLES'),
+                ('metadata_bench_reloads', 'HASURA_BENCH_METADATA_BENCH_RELOADS'),
+                ('metadata_api_bench_tables', 'HASURA_BENCH_METADATA_API_BENCH_TABLES'),
+            ])
+        self.metadata_bench_tables = [int(t) for t in str(metadata_bench_tables).split(',')]
+        self.metadata_api_bench_tables = [int(t) for t in str(metadata_api_bench_tables).split(',')]
+        self.metadata_bench_roles = int(self.metadata_bench_roles)
+        self.metadata_bench_reloads = int(self.metadata_bench_reloads)
+        if self.trials < 1:
+            self.arg_parser.error('--trials should be at least 1')
+        self.workload_profiles = self.parsed_args.workload_profiles or []
+        if os.getenv('HASURA_BENCH_WORKLOAD_PROFILE') and not self.workload_profiles:
+            self.workload_profiles = os.getenv('HASURA_BENCH_WORKLOAD_PROFILE').split(',')
+        self.parallel_stacks = self.get_param_with_default('parallel_stacks', 'HASURA_BENCH_PARALLEL_STACKS', 1, int)
+        if self.parallel_stacks > 1 and (self.pg_url or self.remote_pg_url or self.hge_url or self.remote_hge_url):
+            self.arg_parser.error('--parallel-stacks cannot be used with already running Postgres databases or GraphQL engines')
         self.upload_root_uri = None
         if upload_root_uri:
             p = urlparse(upload_root_uri)
@@ -549,10 +1201,38 @@ class HGEWrkBenchWithArgs(HGEWrkBenchArgs, HGEWrkBench):
             skip_stack_build = self.skip_stack_build,
             graphql_queries_file = self.graphql_queries_file,
             connections = self.connections,
-            duration = self.duration
+            duration = self.duration,
+            max_rps_method = self.max_rps_method,
+            slo_p99_latency = self.slo_p99_latency,
+            slo_error_rate = self.slo_error_rate,
+            max_rps_probe_duration = self.max_rps_probe_duration,
+            parallel_stacks = self.parallel_stacks,
+            subscription_connections = self.subscription_connections,
+            subscription_rows = self.subscription_rows,
+            subscription_mutations_per_sec = self.subscription_mutations_per_sec,
+            subscription_duration = self.subscription_duration,
+            workload_profiles = self.workload_profiles,
+            query_variables_file = self.query_variables_file,
+            resource_sample_interval = self.resource_sample_interval,
+            metadata_concurrency = self.metadata_concurrency,
+            pg_snapshot_dir = self.pg_snapshot_dir,
+            skip_pg_snapshots = self.skip_pg_snapshots,
+            scale_factor = self.scale_factor,
+            warmup_duration = self.warmup_duration,
+            trials = self.trials,
+            metadata_bench_tables = self.metadata_bench_tables,
+            metadata_bench_roles = self.metadata_bench_roles,
+            metadata_bench_reloads = self.metadata_bench_reloads,
+            metadata_api_bench_tables = self.metadata_api_bench_tables,
+            remote_stand_in = self.remote_stand_in,
+            stand_in_latency = self.stand_in_latency,
+            stand_in_jitter = self.stand_in_jitter,
+            stand_in_payload_size = self.stand_in_payload_size
         )
 
 if __name__ == "__main__":
+    if sys.argv[1:2] == ['compare']:
+        sys.exit(compare_results.main(sys.argv[2:]))
     bench = HGEWrkBenchWithArgs()
     bench.run_tests()
 
@@ -0,0 +1,65 @@
+import os
+import hashlib
+import threading
+import numpy as np
+
+
+class LatencyCache:
+    """
+    A size bounded, on-disk cache of the parsed latencies of benchmark runs,
+    keyed by their latencies_uri.
+
+    The latencies are stored as .npy files of 32-bit floats (microseconds),
+    which are memory mapped when read. The least recently used files are
+    evicted when the total size of the cache exceeds max_size bytes.
+    """
+
+    default_max_size = 2 * 1024 * 1024 * 1024
+
+    def __init__(self, cache_dir, max_size=default_max_size):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def get_cache_file(self, uri):
+        key = hashlib.sha256(uri.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, key + '.npy')
+
+    def get(self, uri, load):
+        """
+        Get the latencies for the uri from the cache, or load them using
+        load(uri) and add them to the cache
+        """
+        cache_file = self.get_cache_file(uri)
+        with self.lock:
+            if os.path.exists(cache_file):
+                # The modification time is used to track the recently used files
+                os.utime(cache_file)
+                return np.load(cache_file, mmap_mode='r')
+        latencies = np.asarray(load(uri), dtype=np.float32)
+        with self.lock:
+            tmp_file = cache_file + '.' + str(threading.get_ident()) + '.tmp'
+            with open(tmp_file, 'wb') as f:
+                np.save(f, latencies)
+            os.replace(tmp_file, cache_file)
+            self.evict()
+        return latencies
+
+    def loader(self, load):
+        """Wrap the function load(uri) to use the cache"""
+        return lambda uri: self.get(uri, load)
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.npy'):
+                stat = os.stat(os.path.join(self.cache_dir, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+        total_size = sum(size for (_, size, _) in entries)
+        for (_, size, name) in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            print('Evicting latencies from cache:', name)
+            os.remove(os.path.join(self.cache_dir, name))
+            total_size -= size
@@ -0,0 +1,115 @@
+from hdrh.histogram import HdrHistogram
+from hdrh.log import HistogramLogWriter
+
+
+# Latencies are recorded in microseconds, ranging from 1 microsecond to an hour
+LOWEST_TRACKABLE_LATENCY = 1
+HIGHEST_TRACKABLE_LATENCY = 60 * 60 * 1000 * 1000
+SIGNIFICANT_DIGITS = 3
+
+
+def new_hdr_histogram():
+    return HdrHistogram(LOWEST_TRACKABLE_LATENCY, HIGHEST_TRACKABLE_LATENCY, SIGNIFICANT_DIGITS)
+
+
+def decode_hdr_histogram(encoded):
+    """Decode a histogram from its (base64) compressed encoding"""
+    return HdrHistogram.decode(encoded)
+
+
+def write_hdr_histogram_log(histogram, log_file, duration):
+    """Write the histogram as a single interval of a HdrHistogram (.hlog) log file"""
+    with open(log_file, 'w') as f:
+        writer = HistogramLogWriter(f)
+        writer.output_log_format_version()
+        writer.output_legend()
+        writer.output_interval_histogram(histogram, 0, duration)
+
+
+def percentile_spectrum(histogram, percentiles=[0, 25, 50, 75, 90, 95, 99, 99.9, 99.99, 100]):
+    """
+    The latencies of the histogram at the given percentiles, in the same form
+    as the spectrum parsed from the output of wrk2 (with latencies in milliseconds)
+    """
+    total_count = histogram.get_total_count()
+    return [
+        {
+            'percentile': p / 100.0,
+            'latency': histogram.get_value_at_percentile(p) / 1000.0,
+            'total_count': round(total_count * p / 100.0)
+        }
+        for p in percentiles
+    ]
+
+
+class Wrk2LatencyParser:
+    """
+    Incrementally parses the detailed percentile spectrum printed by wrk2 when
+    run with --latency, one line at a time.
+
+    Along with the percentile spectrum, the latencies are recorded into a
+    HdrHistogram, which can be encoded compactly and merged with histograms of
+    other runs. Each row of the spectrum gives the number of requests with a
+    latency up to its value, so the difference in counts between successive
+    rows is recorded at the value of the row.
+    """
+
+    def __init__(self):
+        self.state = 'start'
+        # Lines of the spectrum in the .hgrm format
+        self.hgrm_lines = []
+        # The lines starting with '#' after the spectrum, like the mean and max latencies
+        self.summary_lines = []
+        self.histogram = []
+        self.hdr_histogram = new_hdr_histogram()
+        self.total_count = 0
+
+    def feed(self, line):
+        stripped = line.strip()
+        if self.state == 'start':
+            if 'Detailed Percentile spectrum' in line:
+                self.state = 'histogram_start'
+        elif self.state == 'histogram_start':
+            if 'Value' in line and 'Percentile' in line:
+                self.hgrm_lines.append(line)
+                self.state = 'histogram_values'
+        elif self.state == 'histogram_values':
+            if stripped.startswith('#'):
+                self.state = 'histogram_summary'
+                self.add_summary_line(line)
+            elif stripped:
+                self.add_value_line(line)
+        elif self.state == 'histogram_summary':
+            if stripped.startswith('#'):
+                self.add_summary_line(line)
+            else:
+                self.state = 'histogram_end'
+
+    def feed_lines(self, lines):
+        for line in lines:
+            if self.state == 'histogram_end':
+                break
+            self.feed(line)
+        return self
+
+    def add_value_line(self, line):
+        self.hgrm_lines.append(line)
+        (val, percentile, total_count, _) = line.strip().split()
+        self.histogram.append({
+            'percentile': float(percentile),
+            'latency': float(val),
+            'total_count': float(total_count)
+        })
+        total_count = int(total_count)
+        if total_count > self.total_count:
+            # wrk2 reports the latencies in milliseconds
+            latency_us = round(float(val) * 1000)
+            self.hdr_histogram.record_value(latency_us, total_count - self.total_count)
+            self.total_count = total_count
+
+    def add_summary_line(self, line):
+        self.hgrm_lines.append(line)
+        self.summary_lines.append(line)
+
+    def encoded_hdr_histogram(self):
+        return self.hdr_histogram.encode().decode('ascii')
@@ -0,0 +1,343 @@
+import json
+import statistics
+import time
+import requests
+from colorama import Fore, Style
+
+
+class MetadataBenchError(Exception):
+    """Exception type for the metadata benchmarks"""
+
+
+class MetadataGenerator:
+    """
+    Generates a chain of tables in a schema of its own, along with their
+    metadata: the i-th table references the (i-1)-th one, giving an object
+    relationship 'parent' on each table and an array relationship 'children'
+    on the table it references, and each table has a select permission for
+    each of the roles, filtering the rows by X-Hasura-User-Id.
+    """
+
+    schema = 'hge_metadata_bench'
+
+    # Number of tables created by each SQL statement
+    sql_chunk_size = 500
+
+    columns = ['id', 'owner_id', 'name', 'parent_id']
+
+    def __init__(self, hge, pg, roles=1):
+        self.hge = hge
+        self.pg = pg
+        self.roles = ['role_{}'.format(r) for r in range(1, roles + 1)]
+        # Number of tables created so far
+        self.created_tables = 0
+        # Number of tables whose metadata is generated so far
+        self.tables = 0
+
+    def table(self, i):
+        return {
+            'schema': self.schema,
+            'name': 't_{}'.format(i)
+        }
+
+    def create_tables_sql(self, start, end):
+        statements = ['CREATE SCHEMA IF NOT EXISTS {};'.format(self.schema)]
+        for i in range(start, end):
+            parent_column = ''
+            if i > 0:
+                parent_column = ', parent_id integer REFERENCES {}.t_{} (id)'.format(self.schema, i - 1)
+            statements.append(
+                'CREATE TABLE {}.t_{} (id serial PRIMARY KEY, owner_id integer NOT NULL, name text{});'.format(
+                    self.schema, i, parent_column))
+        return '\n'.join(statements)
+
+    def create_tables(self, tables):
+        """Create the tables (without their metadata) up to the given number of tables"""
+        for chunk_start in range(self.created_tables, tables, self.sql_chunk_size):
+            chunk_end = min(tables, chunk_start + self.sql_chunk_size)
+            self.pg.run_sql(self.create_tables_sql(chunk_start, chunk_end))
+            self.created_tables = chunk_end
+
+    def track_table_queries(self, start, end):
+        return [self.hge.mk_track_table_q(self.table(i)) for i in range(start, end)]
+
+    def relationship_queries(self, start, end):
+        queries = []
+        for i in range(max(start, 1), end):
+            queries.append({
+                'type': 'create_object_relationship',
+                'args': {
+                    'table': self.table(i),
+                    'name': 'parent',
+                    'using': {
+                        'foreign_key_constraint_on': 'parent_id'
+                    }
+                }
+            })
+            queries.append({
+                'type': 'create_array_relationship',
+                'args': {
+                    'table': self.table(i - 1),
+                    'name': 'children',
+                    'using': {
+                        'foreign_key_constraint_on': {
+                            'table': self.table(i),
+                            'column': 'parent_id'
+                        }
+                    }
+                }
+            })
+        return queries
+
+    def permission_queries(self, start, end):
+        return [
+            {
+                'type': 'create_select_permission',
+                'args': {
+                    'table': self.table(i),
+                    'role': role,
+                    'permission': {
+                        'columns': self.columns if i > 0 else self.columns[:-1],
+                        'filter': {
+                            'owner_id': {'_eq': 'X-Hasura-User-Id'}
+                        }
+                    }
+                }
+            }
+            for i in range(start, end)
+            for role in self.roles
+        ]
+
+    def metadata_counts(self):
+        """Number of tracked tables, relationships and permissions generated so far"""
+        return {
+            'tables': self.tables,
+            'relationships': 2 * max(self.tables - 1, 0),
+            'permissions': self.tables * len(self.roles)
+        }
+
+    def grow(self, tables):
+        """Add tables (along with their metadata) up to the given number of tables"""
+        if tables <= self.tables:
+            return
+        (start, end) = (self.tables, tables)
+        print(Fore.YELLOW + "Generating tables {} to {} in schema {}".format(start, end - 1, self.schema) + Style.RESET_ALL)
+        self.create_tables(end)
+        self.hge.run_bulk_in_chunks(self.track_table_queries(start, end), 'tracked tables')
+        self.hge.run_bulk_in_chunks(self.relationship_queries(start, end), 'relationships')
+        self.hge.run_bulk_in_chunks(self.permission_queries(start, end), 'permissions')
+        self.tables = tables
+
+    def drop(self):
+        """Drop the generated tables, along with their metadata"""
+        print(Fore.YELLOW + "Dropping schema {}".format(self.schema) + Style.RESET_ALL)
+        self.hge.v1q({
+            'type': 'run_sql',
+            'args': {
+                'sql': 'DROP SCHEMA IF EXISTS {} CASCADE;'.format(self.schema),
+                'cascade': True
+            }
+        })
+        self.pg.invalidate_catalog()
+        self.created_tables = 0
+        self.tables = 0
+
+
+class MetadataSizeBenchmark:
+    """
+    Measures how graphql-engine copes with growing metadata. For each number
+    of generated tables (on top of the existing metadata), measures
+      - the latency of reload_metadata (which rebuilds the schema cache)
+      - the time taken to start up with the metadata, by restarting
+        graphql-engine (only when it's run by us)
+      - the resident memory and live bytes (when run with +RTS -T) after start up
+    """
+
+    def __init__(self, hge, pg, table_counts, roles=1, reloads=3):
+        self.hge = hge
+        self.table_counts = sorted(table_counts)
+        self.roles = roles
+        self.reloads = reloads
+        self.generator = MetadataGenerator(hge, pg, roles)
+
+    def reload_metadata(self):
+        start = time.time()
+        self.hge.v1q({'type': 'reload_metadata', 'args': {}})
+        return time.time() - start
+
+    def measure(self):
+        result = {
+            **self.generator.metadata_counts(),
+            'roles': self.roles,
+            'tracked_tables': len(self.hge.get_all_tracked_tables())
+        }
+        latencies = [self.reload_metadata() for _ in range(self.reloads)]
+        result['reload_metadata_latencies'] = latencies
+        result['reload_metadata_latency'] = statistics.median(latencies) if latencies else None
+        if self.hge.proc or self.hge.container:
+            self.hge.restart()
+            result.update(self.hge.startup_timings)
+        result['rss'] = self.hge.get_memory_usage()
+        rts_stats = self.hge.get_rts_stats()
+        if rts_stats:
+            result['live_bytes'] = rts_stats.get('gc', {}).get('gcdetails_live_bytes')
+        print(Fore.CYAN + "Metadata with {tables} generated tables: reload_metadata {reload_metadata_latency:.3f}s, memory {rss}".format(**result) + Style.RESET_ALL)
+        return result
+
+    def run(self):
+        """Yields the result for each number of tables"""
+        try:
+            for tables in self.table_counts:
+                self.generator.grow(tables)
+                yield self.measure()
+        finally:
+            self.generator.drop()
+
+
+def metadata_api_query(query):
+    """
+    The /v1/metadata form of a /v1/query metadata query on a table of the
+    default Postgres source (like track_table -> pg_track_table)
+    """
+    if query['type'] == 'track_table':
+        args = {'table': query['args']}
+    else:
+        args = dict(query['args'])
+    args['source'] = 'default'
+    return {
+        'type': 'pg_' + query['type'],
+        'args': args
+    }
+
+
+class MetadataApiBenchmark:
+    """
+    Measures the latency of the metadata API for each number of generated
+    tables (see MetadataGenerator), for each API (/v1/query and /v1/metadata)
+    and each mode:
+      - single: one call for each table, relationship or permission
+      - bulk: a single bulk call with all of them
+    For each, the tables are tracked, then the relationships are created,
+    and then the permissions, starting from the existing metadata. Finally,
+    the latency of replace_metadata with all the generated metadata is
+    measured. The existing metadata is restored after each run.
+    """
+
+    apis = {
+        'query': '/v1/query',
+        'metadata': '/v1/metadata'
+    }
+
+    modes = ['single', 'bulk']
+
+    def __init__(self, hge, pg, table_counts, roles=1):
+        self.hge = hge
+        self.table_counts = sorted(table_counts)
+        self.generator = MetadataGenerator(hge, pg, roles)
+        self.base_metadata = None
+
+    def post(self, api, query):
+        """Send the query to the API, returning the latency in seconds"""
+        start = time.time()
+        resp = requests.post(
+            self.hge.url + self.apis[api], json.dumps(query),
+            headers=self.hge.admin_auth_headers()
+        )
+        latency = time.time() - start
+        if resp.status_code != 200:
+            raise MetadataBenchError("{} query {} failed with error: {}".format(
+                api, query['type'], resp.text))
+        return latency
+
+    def supported_apis(self):
+        """The metadata API isn't supported by older versions of graphql-engine"""
+        apis = ['query']
+        resp = requests.post(
+            self.hge.url + self.apis['metadata'],
+            json.dumps({'type': 'export_metadata', 'args': {}}),
+            headers=self.hge.admin_auth_headers()
+        )
+        if resp.status_code == 200:
+            apis.append('metadata')
+        else:
+            print(Fore.YELLOW + "Skipping the /v1/metadata API, which isn't supported" + Style.RESET_ALL)
+        return apis
+
+    def export_metadata(self):
+        return self.hge.v1q({'type': 'export_metadata', 'args': {}})
+
+    def replace_metadata(self, api, metadata):
+        return self.post(api, {'type': 'replace_metadata', 'args': metadata})
+
+    def run_operation(self, api, mode, operation, queries, tables):
+        if api == 'metadata':
+            queries = [metadata_api_query(q) for q in queries]
+        if mode == 'bulk':
+            latencies = [self.post(api, {'type': 'bulk', 'args': queries})]
+        else:
+            latencies = [self.post(api, q) for q in queries]
+        result = {
+            'api': api,
+            'mode': mode,
+            'operation': operation,
+            'tables': tables,
+            'items': len(queries),
+            'calls': len(latencies),
+            'total_time': sum(latencies),
+            'mean_latency': statistics.mean(latencies) if latencies else None,
+            'max_latency': max(latencies) if latencies else None,
+            'latencies': latencies
+        }
+        print(Fore.CYAN + "{api} {operation} ({mode}) of {items} items with {tables} tables: {total_time:.3f}s".format(**result) + Style.RESET_ALL)
+        return result
+
+    def measure(self, api, mode, tables):
+        results = []
+        self.replace_metadata('query', self.base_metadata)
+        operations = [
+            ('track_table', self.generator.track_table_queries(0, tables)),
+            ('create_relationship', self.generator.relationship_queries(0, tables)),
+            ('create_permission', self.generator.permission_queries(0, tables))
+        ]
+        for (operation, queries) in operations:
+            if queries:
+                results.append(self.run_operation(api, mode, operation, queries, tables))
+        return results
+
+    def measure_replace_metadata(self, api, tables, metadata):
+        self.replace_metadata('query', self.base_metadata)
+        latency = self.replace_metadata(api, metadata)
+        result = {
+            'api': api,
+            'mode': 'single',
+            'operation': 'replace_metadata',
+            'tables': tables,
+            'items': tables,
+            'calls': 1,
+            'total_time': latency,
+            'mean_latency': latency,
+            'max_latency': latency,
+            'latencies': [latency]
+        }
+        print(Fore.CYAN + "{api} replace_metadata with {tables} tables: {total_time:.3f}s".format(**result) + Style.RESET_ALL)
+        return result
+
+    def run(self):
+        """Yields the results for each number of tables"""
+        self.base_metadata = self.export_metadata()
+        apis = self.supported_apis()
+        try:
+            for tables in self.table_counts:
+                self.generator.create_tables(tables)
+                results = []
+                for api in apis:
+                    for mode in self.modes:
+                        results += self.measure(api, mode, tables)
+                # The metadata with all the tables, relationships and permissions
+                metadata = self.export_metadata()
+                for api in apis:
+                    results.append(self.measure_replace_metadata(api, tables, metadata))
+                yield results
+        finally:
+            self.replace_metadata('query', self.base_metadata)
+            self.generator.drop()
@@ -24,6 +24,11 @@ import argparse
 import base64
 from urllib.parse import urlparse
 import boto3
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from latency_cache import LatencyCache
 
 def as_pairs(l, pair_size=2):
     if len(l) < pair_size:
@@ -44,16 +49,28 @@ def get_scenario_results(results, scenarios):
         out_results.append((snro, req_results))
     return out_results
 
+def version_label(snro):
+    """The version (or docker image tag) of the scenario, along with the scale of the data if it was scaled"""
+    ver_info = snro['version'] or snro['docker_image'].split(':')[1]
+    if snro.get('scale_factor', 1) != 1:
+        ver_info += ' (scale {})'.format(snro['scale_factor'])
+    return ver_info
+
 def throughput_data(max_rps_results, scenarios):
     results = get_scenario_results(max_rps_results, scenarios)
     data = []
     for (snro, req_results) in results:
-        ver_info = snro['version'] or snro['docker_image'].split(':')[1]
-        if req_results:
+        ver_info = version_label(snro)
+        for method in set(x.get('method', 'wrk') for x in req_results):
+            method_results = [x for x in req_results if x.get('method', 'wrk') == method]
+            query_name = snro['query_name']
+            # Max RPS computed with other methods are not comparable with the wrk ones
+            if method != 'wrk':
+                query_name += ' ({})'.format(method)
             data.append({
                 'version': ver_info,
-                'query name': snro['query_name'],
-                'max throughput': float(req_results[0]['max_rps'])
+                'query name': query_name,
+                'max throughput': float(method_results[0]['max_rps'])
             })
     return pd.DataFrame(data)
 
@@ -84,39 +101,56 @@ def gen_plot_figure_data(plt):
     return "data:image/png;base64,{}".format(encoded)
 
 
-def uri_readlines(uri):
+def uri_read(uri):
     print('Latency file:', uri)
     p = urlparse(uri)
     if p.scheme == 'file':
-        return urlopen(uri).readlines()
+        return urlopen(uri).read()
     elif p.scheme == 's3':
         s3 = boto3.resource('s3')
         obj = s3.Object(bucket_name=p.netloc, key=p.path.lstrip('/'))
         with BytesIO() as data:
             obj.download_fileobj(data)
-            return data.getvalue().splitlines()
+            return data.getvalue()
+
+
+def load_latencies(uri):
+    """Load the latencies (in microseconds) from the newline separated latencies file"""
+    return np.fromstring(uri_read(uri).decode('ascii'), dtype=np.float64, sep=' ')
 
 
-def violin_plot_data(latency_results, scenarios):
+# Maximum number of latency samples plotted per scenario
+max_plot_samples = 20000
+
+def downsample_latencies(latencies, max_samples=max_plot_samples):
+    """
+    Reduce the latencies to at most max_samples values at evenly spaced
+    quantiles. This preserves the distribution, including the minimum, the
+    maximum and (with enough samples) the tail percentiles shown in the plots
+    """
+    if len(latencies) <= max_samples:
+        return latencies
+    return np.quantile(latencies, np.linspace(0, 1, max_samples))
+
+
+def violin_plot_data(latency_results, scenarios, load_latencies=load_latencies):
     y_label = 'latency (ms)'
     x_label = 'version'
     category_label = 'req/sec'
-    data = []
+    frames = []
     results = get_scenario_results(latency_results, scenarios)
     for (snro, req_results) in results:
-        ver_info = snro['version'] or snro['docker_image'].split(':')[1]
+        ver_info = version_label(snro)
         if req_results:
-            latencies = uri_readlines(req_results[0]['latencies_uri'])
-            for x in latencies:
-                if isinstance(x, bytes):
-                    x = x.decode()
-                val_ms = float(x)/1000.0
-                data.append({
-                    y_label: val_ms,
-                    x_label: ver_info,
-                    category_label: snro['requests_per_sec']
-                })
-    return pd.DataFrame(data)
+            latencies = downsample_latencies(load_latencies(req_results[0]['latencies_uri']))
+            frames.append(pd.DataFrame({
+                y_label: latencies/1000.0,
+                x_label: ver_info,
+                category_label: snro['requests_per_sec']
+            }))
+    if not frames:
+        return pd.DataFrame(columns=[y_label, x_label, category_label])
+    return pd.concat(frames, ignore_index=True)
 
 
 def violin_plot_figure(df):
@@ -191,8 +225,9 @@ def violin_plot_figure(df):
 def hdrhistogram_figure(df):
     sns.set_style("whitegrid")
     fig, ax = plt.subplots(figsize=(14,6))
+    # With several trials, the band is the 95% confidence interval of the mean latency
     sns.lineplot(x='percentile', y='latency', hue='version',
-                 data=df, ax=ax)
+                 data=df, ax=ax, ci=95)
     ax.grid()
     ax.set(
         xlabel='Percentile',
@@ -209,23 +244,102 @@ def hdrhistogram_figure(df):
     return out_fig
 
 
+def trial_histograms(result):
+    """
+    The latency histograms of the trials run along with the result, or just its
+    own histogram for results without trials
+    """
+    trials = result.get('trials') or [result]
+    return [t['latency_histogram'] for t in trials if t['latency_histogram']]
+
+
+def latency_at_percentiles(histogram, percentiles):
+    """The latencies of the histogram at the percentiles (as fractions), interpolated"""
+    histogram = sorted(histogram, key=lambda e: float(e['percentile']))
+    return np.interp(
+        percentiles,
+        [float(e['percentile']) for e in histogram],
+        [float(e['latency']) for e in histogram]
+    )
+
+
 def hdrhistogram_data(latency_results, scenarios):
     results = get_scenario_results(latency_results, scenarios)
     data = []
     for (snro, req_results) in results:
-        ver_info = snro['version'] or snro['docker_image'].split(':')[1]
-        if req_results:
-            histogram = req_results[0]['latency_histogram']
-            for e in histogram:
+        ver_info = version_label(snro)
+        if not req_results:
+            continue
+        histograms = trial_histograms(req_results[0])
+        if len(histograms) == 1:
+            percentiles = [float(e['percentile']) for e in histograms[0]]
+        else:
+            # The percentiles in the histograms printed by wrk2 vary with the
+            # number of requests, so the trials are compared at the same percentiles
+            max_percentile = min(max(float(e['percentile']) for e in h) for h in histograms)
+            percentiles = sorted(set(
+                float(e['percentile']) for e in histograms[0]
+                if float(e['percentile']) <= max_percentile
+            ))
+        for (trial, histogram) in enumerate(histograms, 1):
+            latencies = latency_at_percentiles(histogram, percentiles)
+            for (percentile, latency) in zip(percentiles, latencies):
                 data.append({
-                    'latency': float(e['latency']),
-                    'percentile': float(e['percentile']),
+                    'latency': float(latency),
+                    'percentile': percentile,
                     'req/sec': snro['requests_per_sec'],
-                    'version': ver_info
+                    'version': ver_info,
+                    'trial': trial
                 })
     return pd.DataFrame(data)
 
 
+trial_percentiles = [50, 90, 99, 99.9]
+
+def trial_percentiles_data(latency_results, scenarios, percentiles=trial_percentiles):
+    """The latencies at the percentiles in each trial of the scenarios"""
+    results = get_scenario_results(latency_results, scenarios)
+    data = []
+    for (snro, req_results) in results:
+        ver_info = version_label(snro)
+        if not req_results:
+            continue
+        for (trial, histogram) in enumerate(trial_histograms(req_results[0]), 1):
+            latencies = latency_at_percentiles(histogram, [p / 100.0 for p in percentiles])
+            for (percentile, latency) in zip(percentiles, latencies):
+                data.append({
+                    'latency': float(latency),
+                    'percentile': 'p{:g}'.format(percentile),
+                    'version': ver_info,
+                    'trial': trial
+                })
+    return pd.DataFrame(data, columns=['latency', 'percentile', 'version', 'trial'])
+
+
+def trial_percentiles_figure(df):
+    """
+    The mean latency at each percentile over the trials, with error bars
+    showing its 95% confidence interval (bootstrapped from the trials)
+    """
+    sns.set_style("whitegrid")
+    fig, ax = plt.subplots(figsize=(14,6))
+    sns.pointplot(x='version', y='latency', hue='percentile', data=df, ax=ax,
+                  ci=95, capsize=0.05, dodge=0.3, join=False)
+    trials = df.groupby('version')['trial'].nunique() if len(df) else {}
+    ax.set_xticklabels([
+        '{} ({} trials)'.format(t.get_text(), trials[t.get_text()])
+        for t in ax.get_xticklabels()
+    ])
+    ax.set(
+        xlabel='Version/Docker image',
+        ylabel='Latency (ms)'
+    )
+    plt.ylim(0, None)
+    out_fig = gen_plot_figure_data(plt)
+    plt.close()
+    return out_fig
+
+
 # Human friendly Y labels.
 # Copy-pasta: https://stackoverflow.com/a/40573071
 def y_fmt(y, pos):
@@ -247,10 +361,52 @@ def y_fmt(y, pos):
                 return tx.format(val=val, suffix=suffix[i])
     return y
 
-def run_dash_server(bench_results):
+# pyplot keeps global state, so the figures are drawn one at a time
+plot_lock = threading.Lock()
+
+
+class FigureCache:
+    """
+    Memoizes the rendered figures (as data URIs), so that selecting the same
+    scenarios again doesn't redraw the figure. At most max_size figures are
+    kept, evicting the least recently used ones.
+    """
+
+    def __init__(self, max_size=256):
+        self.max_size = max_size
+        self.figures = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, render):
+        with self.lock:
+            if key in self.figures:
+                self.figures.move_to_end(key)
+                return self.figures[key]
+        figure = render()
+        with self.lock:
+            self.figures[key] = figure
+            if len(self.figures) > self.max_size:
+                self.figures.popitem(last=False)
+        return figure
+
+
+def scenarios_cache_key(scenarios):
+    """Key for the scenarios, independent of their order"""
+    return tuple(sorted(set(json.dumps(s, sort_keys=True) for s in scenarios)))
+
+
+default_latency_cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'hge-bench', 'latencies')
+
+def run_dash_server(bench_results, latency_cache_dir=default_latency_cache_dir, latency_cache_size=LatencyCache.default_max_size, precompute_figures=False):
+    latency_cache = LatencyCache(latency_cache_dir, latency_cache_size)
+    cached_load_latencies = latency_cache.loader(load_latencies)
+    figure_cache = FigureCache()
     latency_results = bench_results['latency']
     max_rps_results = bench_results['max_rps']
-    latency_results.sort(key=lambda x : x['version'] or x['docker_image'])
+    # Results from before the data could be scaled
+    for x in latency_results + max_rps_results:
+        x.setdefault('scale_factor', 1)
+    latency_results.sort(key=lambda x : (x['version'] or x['docker_image'], x['scale_factor']))
 
     app = dash.Dash(external_stylesheets=[dbc.themes.BOOTSTRAP])
 
@@ -259,14 +415,14 @@ def run_dash_server(bench_results):
 
 
     rows = []
-    plot_types = ['latency histogram','latency violins', 'max throughput']
+    plot_types = ['latency histogram','latency violins', 'latency trials', 'max throughput']
     plots_filters_1 = [
         dbc.Col([
             html.Label('Plot type'),
             dcc.Dropdown(
                 id='plot-type',
                 options=[{'label':q, 'value': q} for q in plot_types],
-                value= plot_types[2]
+                value= 'max throughput'
             )
         ], width=2),
         dbc.Col([
@@ -328,17 +484,18 @@ def run_dash_server(bench_results):
             (x['requests_per_sec'] in rps_list or plot_type == 'max throughput')
         ]
         uniq_vers = list(set([
-            (x['version'], x['docker_image'])
+            (x['version'], x['docker_image'], x['scale_factor'])
             for x in relvnt_q
         ]))
         print("Updating version options to", uniq_vers)
         return [
             {
-                'label': x[0] or x[1],
+                'label': (x[0] or x[1]) + (' (scale {})'.format(x[2]) if x[2] != 1 else ''),
                 'value': json.dumps({
                     'version': x[0],
 
-                    'docker_image': x[1]
+                    'docker_image': x[1],
+                    'scale_factor': x[2]
                     })
             }
             for x in uniq_vers
@@ -418,7 +575,7 @@ def run_dash_server(bench_results):
         [ State('rps', 'value') ]
     )
     def updateRPSValue(plot_type, options, rps):
-        if plot_type == 'latency histogram':
+        if plot_type in ['latency histogram', 'latency trials']:
             return updateSingleValue(options, rps)
         else:
             rps = as_list(rps)
@@ -443,17 +600,98 @@ def run_dash_server(bench_results):
         else:
             return {'display': 'block'}
 
+    def latency_results_key(scenarios):
+        # The latest result is the last of its trials
+        return tuple(
+            req_results[0].get('id')
+            for (_, req_results) in get_scenario_results(latency_results, scenarios)
+            if req_results
+        )
+
+    def max_rps_results_key(scenarios):
+        return tuple(
+            (x.get('method', 'wrk'), x['max_rps'])
+            for (_, req_results) in get_scenario_results(max_rps_results, scenarios)
+            for x in req_results
+        )
+
+    def get_figure(plot_type, scenarios, results_key, get_data, figure):
+        def render():
+            df = get_data(scenarios)
+            with plot_lock:
+                return figure(df)
+        key = (plot_type, scenarios_cache_key(scenarios), results_key(scenarios))
+        return figure_cache.get(key, render)
+
     def get_hdrhistogram_figure(scenarios):
-        df = hdrhistogram_data(latency_results, scenarios)
-        return hdrhistogram_figure(df)
+        return get_figure(
+            'latency histogram', scenarios, latency_results_key,
+            lambda snros: hdrhistogram_data(latency_results, snros),
+            hdrhistogram_figure
+        )
 
     def get_violin_figure(scenarios):
-        df = violin_plot_data(latency_results, scenarios)
-        return violin_plot_figure(df)
+        return get_figure(
+            'latency violins', scenarios, latency_results_key,
+            lambda snros: violin_plot_data(latency_results, snros, cached_load_latencies),
+            violin_plot_figure
+        )
+
+    def get_trials_figure(scenarios):
+        return get_figure(
+            'latency trials', scenarios, latency_results_key,
+            lambda snros: trial_percentiles_data(latency_results, snros),
+            trial_percentiles_figure
+        )
 
     def get_throughput_figure(scenarios):
-        df = throughput_data(max_rps_results, scenarios)
-        return throughput_figure(df)
+        return get_figure(
+            'max throughput', scenarios, max_rps_results_key,
+            lambda snros: throughput_data(max_rps_results, snros),
+            throughput_figure
+        )
+
+    def precompute_latest_figures():
+        """
+        Render the figures comparing the latest two versions for each query
+        (and each requests/sec for the latency plots) in the background
+        """
+        def latest_versions(results):
+            latest = {}
+            for x in results:
+                ver = (x['version'], x['docker_image'], x['scale_factor'])
+                latest[ver] = max(latest.get(ver, ''), x.get('time') or '')
+            vers = sorted(latest, key=lambda v: latest[v], reverse=True)[:2]
+            return [{'version': v, 'docker_image': d, 'scale_factor': f} for (v, d, f) in vers]
+
+        def render(get_fig, scenarios):
+            try:
+                get_fig(scenarios)
+            except Exception as e:
+                print('Failed to precompute figure for scenarios', scenarios, repr(e))
+
+        executor = ThreadPoolExecutor(max_workers=4)
+        for query_name in uniq_queries:
+            query_results = [x for x in latency_results if x['query_name'] == query_name]
+            for rps in sorted(set(x['requests_per_sec'] for x in query_results)):
+                rps_results = [x for x in query_results if x['requests_per_sec'] == rps]
+                scenarios = [
+                    {'query_name': query_name, 'requests_per_sec': rps, **ver}
+                    for ver in latest_versions(rps_results)
+                ]
+                executor.submit(render, get_hdrhistogram_figure, scenarios)
+                executor.submit(render, get_violin_figure, scenarios)
+                executor.submit(render, get_trials_figure, scenarios)
+            query_max_rps_results = [x for x in max_rps_results if x['query_name'] == query_name]
+            scenarios = [
+                {'query_name': query_name, **ver}
+                for ver in latest_versions(query_max_rps_results)
+            ]
+            executor.submit(render, get_throughput_figure, scenarios)
+        executor.shutdown(wait=False)
+
+    if precompute_figures:
+        threading.Thread(target=precompute_latest_figures, daemon=True).start()
 
     @app.callback(
         Output('graph', 'src'),
@@ -495,6 +733,8 @@ def run_dash_server(bench_results):
             return get_hdrhistogram_figure(scenarios)
         elif plot_type == 'latency violins':
             return get_violin_figure(scenarios)
+        elif plot_type == 'latency trials':
+            return get_trials_figure(scenarios)
         elif plot_type == 'max throughput':
             return get_throughput_figure(scenarios)
 
@@ -506,6 +746,15 @@ if __name__ == '__main__':
     parser.add_argument(
         '--results', nargs='?', type=argparse.FileType('r'),
         default=sys.stdin)
+    parser.add_argument(
+        '--latency-cache-dir', default=default_latency_cache_dir,
+        help='Directory in which the downloaded latencies are cached')
+    parser.add_argument(
+        '--latency-cache-size', type=int, default=LatencyCache.default_max_size,
+        help='Maximum size of the latencies cache in bytes')
+    parser.add_argument(
+        '--precompute-figures', action='store_true',
+        help='Render the figures for the latest results in the background on start')
     args = parser.parse_args()
     bench_results = json.load(args.results)
     print(bench_results)
@@ -513,4 +762,4 @@ if __name__ == '__main__':
     print("=" * 20)
     print("starting dash server for graphs")
 
-    run_dash_server(bench_results)
+    run_dash_server(bench_results, args.latency_cache_dir, args.latency_cache_size, args.precompute_figures)
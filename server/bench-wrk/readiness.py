@@ -0,0 +1,174 @@
+import datetime
+import json
+import socket
+import struct
+import threading
+import time
+
+
+class ReadinessTimeout(Exception):
+    """Exception type for timeouts waiting for a service to be ready"""
+
+
+def wait_until(condition, timeout, description, check=None, initial_delay=0.01, max_delay=0.5, sleep=time.sleep):
+    """
+    Call condition until it returns a truthy value (which is returned), waiting
+    with exponential backoff (from initial_delay up to max_delay) in between.
+    check is called before each attempt, to fail early (say, if the process
+    being waited for exited). sleep can be the wait method of a threading.Event,
+    to stop waiting as soon as the event is set.
+    Raises ReadinessTimeout if the condition isn't met within the timeout
+    """
+    deadline = time.time() + timeout
+    delay = initial_delay
+    while True:
+        if check:
+            check()
+        result = condition()
+        if result:
+            return result
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise ReadinessTimeout("Timeout waiting for " + description)
+        sleep(min(delay, remaining))
+        delay = min(delay * 2, max_delay)
+
+
+# Protocol version 3.0
+PG_PROTOCOL_VERSION = 196608
+
+# SQLSTATE of the errors returned while Postgres is starting up or shutting down
+PG_CANNOT_CONNECT_NOW = '57P03'
+
+
+def pg_ping(host, port, user, database, timeout=1):
+    """
+    Whether Postgres is accepting connections, like pg_isready. A startup
+    message is sent, and the server is ready if it asks for authentication
+    (or rejects the connection for any reason other than starting up). Unlike
+    connecting, this doesn't authenticate or start a backend session
+    """
+    params = b''.join(
+        k + b'\0' + v.encode('utf-8') + b'\0'
+        for (k, v) in [(b'user', user), (b'database', database)]
+    ) + b'\0'
+    startup_message = struct.pack('!ii', 8 + len(params), PG_PROTOCOL_VERSION) + params
+    try:
+        with socket.create_connection((host, port), timeout=timeout) as sock:
+            sock.sendall(startup_message)
+            message_type = sock.recv(1)
+            if message_type == b'R':
+                return True
+            if message_type != b'E':
+                # Like the connection being closed by a docker proxy with nothing behind it
+                return False
+            (length,) = struct.unpack('!i', recv_exactly(sock, 4))
+            fields = recv_exactly(sock, length - 4).split(b'\0')
+            codes = [f[1:].decode('ascii') for f in fields if f[:1] == b'C']
+            return PG_CANNOT_CONNECT_NOW not in codes
+    except (OSError, struct.error):
+        return False
+
+
+def recv_exactly(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Connection closed")
+        data += chunk
+    return data
+
+
+def tail_lines(file_name, stop_event, max_delay=0.1):
+    """
+    The lines of the file as they are written (like tail -f), until the stop
+    event is set
+    """
+    delay = 0.001
+    with open(file_name, errors='replace') as f:
+        partial = ''
+        while not stop_event.is_set():
+            line = f.readline()
+            if not line:
+                stop_event.wait(delay)
+                delay = min(delay * 2, max_delay)
+                continue
+            delay = 0.001
+            partial += line
+            if partial.endswith('\n'):
+                yield partial
+                partial = ''
+
+
+def stream_lines(chunks):
+    """The lines in a stream of chunks of bytes, like the logs of a docker container"""
+    partial = b''
+    for chunk in chunks:
+        partial += chunk
+        *lines, partial = partial.split(b'\n')
+        for line in lines:
+            yield line.decode('utf-8', errors='replace')
+    if partial:
+        yield partial.decode('utf-8', errors='replace')
+
+
+def parse_log_timestamp(timestamp):
+    """The time (as seconds since the epoch) of a graphql-engine log timestamp like 2021-03-02T10:12:13.123+0530"""
+    try:
+        return datetime.datetime.strptime(timestamp, '%Y-%m-%dT%H:%M:%S.%f%z').timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+class StartupLogWatcher:
+    """
+    Follows the JSON logs of graphql-engine in a background thread, recording
+    the times of the startup events:
+      - schema_cache: the schema cache is built (the schema-sync log, which
+        follows the catalog migration and the building of the schema cache)
+      - api_server: the API server is about to start listening (the 'starting
+        API server' log, with the initialisation time measured by graphql-engine)
+    Stops following the logs once the API server is started.
+    """
+
+    def __init__(self, lines):
+        self.lines = lines
+        self.event_times = {}
+        # Initialisation time reported by graphql-engine in the 'starting API server' log
+        self.reported_init_time = None
+        self.api_server_started = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def run(self):
+        for line in self.lines:
+            self.feed(line)
+            if self.api_server_started.is_set():
+                break
+
+    def feed(self, line):
+        try:
+            log = json.loads(line)
+        except ValueError:
+            # Like the output of 'cabal run'
+            return
+        if not isinstance(log, dict) or log.get('type') != 'startup':
+            return
+        detail = log.get('detail') or {}
+        info = detail.get('info')
+        event_time = parse_log_timestamp(log.get('timestamp')) or time.time()
+        if detail.get('kind') == 'schema-sync':
+            self.event_times.setdefault('schema_cache', event_time)
+        elif detail.get('kind') == 'server' and isinstance(info, dict) \
+                and info.get('message') == 'starting API server':
+            self.event_times.setdefault('api_server', event_time)
+            self.reported_init_time = info.get('time_taken')
+            self.api_server_started.set()
+
+    def wait(self, delay):
+        """Wait for the API server to be started, for at most delay seconds"""
+        return self.api_server_started.wait(delay)
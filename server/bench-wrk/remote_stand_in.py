@@ -0,0 +1,146 @@
+import asyncio
+import random
+import threading
+import graphene
+from aiohttp import web
+from colorama import Fore, Style
+
+
+class RemoteStandInError(Exception):
+    """Exception type for failures of the remote stand-in server"""
+
+
+class Message(graphene.ObjectType):
+    id = graphene.Int(required=True)
+    parent_id = graphene.Int()
+    msg = graphene.String()
+    # Filler of the configured size, to control the size of the responses
+    payload = graphene.String()
+
+
+def mk_message(info, id, parent_id=None):
+    return Message(
+        id=id, parent_id=parent_id, msg='Message {}'.format(id),
+        payload=info.context['payload']
+    )
+
+
+class MessagesQuery(graphene.ObjectType):
+    """The messages schema of tests-py/graphql_server.py, with arguments to page through any number of messages"""
+    message = graphene.Field(Message, id=graphene.Int(required=True))
+    messages = graphene.List(
+        Message, parent_id=graphene.Int(),
+        limit=graphene.Int(default_value=10), offset=graphene.Int(default_value=0)
+    )
+
+    def resolve_message(self, info, id):
+        return mk_message(info, id)
+
+    def resolve_messages(self, info, limit, offset, parent_id=None):
+        return [mk_message(info, i, parent_id) for i in range(offset + 1, offset + limit + 1)]
+
+
+messages_schema = graphene.Schema(query=MessagesQuery)
+
+
+class RemoteStandIn:
+    """
+    A GraphQL server on asyncio standing in for a remote schema, whose
+    responses are delayed by the given latency (in milliseconds), varied
+    uniformly by up to the given jitter, and whose messages carry a payload
+    of the given size (in bytes). This isolates the overhead of remote joins
+    in graphql-engine from the costs of executing the remote queries.
+    The number of requests and of the top level fields in them are counted,
+    to show how the remote joins are batched (see stats).
+    """
+
+    def __init__(self, port_allocator, latency=0, jitter=0, payload_size=0):
+        self.port = port_allocator.allocate_port(5000)
+        self.url = 'http://127.0.0.1:{}/graphql'.format(self.port)
+        self.latency = latency
+        self.jitter = jitter
+        self.context = {'payload': 'x' * payload_size}
+        self.loop = None
+        self.thread = None
+        self.started = threading.Event()
+        self.error = None
+        self.requests = 0
+        self.root_fields = 0
+        self.max_root_fields = 0
+
+    def response_delay(self):
+        """The delay of a response in seconds"""
+        low = max(0, self.latency - self.jitter)
+        return random.uniform(low, self.latency + self.jitter) / 1000
+
+    async def handle_graphql(self, request):
+        body = await request.json()
+        delay = self.response_delay()
+        result = await messages_schema.execute_async(
+            body['query'],
+            variable_values=body.get('variables'),
+            operation_name=body.get('operationName'),
+            context_value=self.context
+        )
+        if delay:
+            await asyncio.sleep(delay)
+        resp = {'data': result.data}
+        if result.errors:
+            resp['errors'] = [e.formatted for e in result.errors]
+        root_fields = len(result.data or {})
+        self.requests += 1
+        self.root_fields += root_fields
+        self.max_root_fields = max(self.max_root_fields, root_fields)
+        return web.json_response(resp)
+
+    async def handle_stats(self, request):
+        return web.json_response(self.stats())
+
+    def stats(self):
+        return {
+            'requests': self.requests,
+            'root_fields': self.root_fields,
+            'max_root_fields': self.max_root_fields
+        }
+
+    def serve(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        app = web.Application()
+        app.router.add_post('/graphql', self.handle_graphql)
+        app.router.add_get('/stats', self.handle_stats)
+        runner = web.AppRunner(app, access_log=None)
+        try:
+            self.loop.run_until_complete(runner.setup())
+            site = web.TCPSite(runner, '127.0.0.1', self.port)
+            self.loop.run_until_complete(site.start())
+        except Exception as e:
+            self.error = e
+            self.started.set()
+            return
+        self.started.set()
+        self.loop.run_forever()
+        self.loop.run_until_complete(runner.cleanup())
+        self.loop.close()
+
+    def run(self):
+        if self.thread:
+            return
+        print("Running the remote stand-in server (port:{}, latency: {}ms, jitter: {}ms, payload: {} bytes)".format(
+            self.port, self.latency, self.jitter, len(self.context['payload'])))
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+        self.started.wait()
+        if self.error:
+            raise RemoteStandInError("Remote stand-in server failed to start: " + str(self.error))
+
+    def teardown(self):
+        if not self.thread or self.error:
+            return
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.thread = None
+        stats = self.stats()
+        mean_fields = stats['root_fields'] / stats['requests'] if stats['requests'] else 0
+        print(Fore.CYAN + "Remote stand-in server: {requests} requests, {max_root_fields} top level fields at most per request".format(**stats)
+              + ", {:.1f} on average".format(mean_fields) + Style.RESET_ALL)
@@ -0,0 +1,286 @@
+import json
+import threading
+import time
+from urllib.parse import urlparse
+import psutil
+import psycopg2
+from colorama import Fore, Style
+
+
+# Fields of the GHC RTS stats (exposed by graphql-engine at /dev/rts_stats when
+# run with +RTS -T) which are recorded in each sample
+rts_stats_fields = [
+    'gcs', 'major_gcs', 'allocated_bytes', 'max_live_bytes',
+    'gc_cpu_ns', 'gc_elapsed_ns', 'mutator_cpu_ns', 'mutator_elapsed_ns'
+]
+
+# Cumulative RTS stats, whose increase over the run is reported in the summary
+rts_stats_counters = [
+    'gcs', 'major_gcs', 'allocated_bytes',
+    'gc_cpu_ns', 'gc_elapsed_ns', 'mutator_cpu_ns', 'mutator_elapsed_ns'
+]
+
+
+def process_tree_usage(pid):
+    """
+    Total CPU time (in seconds) and resident memory (in bytes) of the process
+    and all its descendants
+    """
+    proc = psutil.Process(pid)
+    cpu_seconds = 0
+    rss = 0
+    for p in [proc, *proc.children(recursive=True)]:
+        try:
+            cpu_times = p.cpu_times()
+            cpu_seconds += cpu_times.user + cpu_times.system
+            rss += p.memory_info().rss
+        except psutil.NoSuchProcess:
+            # Like Postgres backends exiting in between
+            pass
+    return {
+        'cpu_seconds': cpu_seconds,
+        'rss': rss
+    }
+
+
+def tcp_connections_to_port(port):
+    return sum(
+        1 for c in psutil.net_connections(kind='tcp')
+        if c.laddr and c.laddr.port == port and c.status == psutil.CONN_ESTABLISHED
+    )
+
+
+class ResourceSampler:
+    """
+    Samples the resource usage of graphql-engine and Postgres at a fixed
+    interval in a background thread, while a benchmark is running:
+      - CPU usage and resident memory of the processes (when run by us on this host)
+      - GC stats of graphql-engine (when run with +RTS -T)
+      - Established connections to graphql-engine, and Postgres connections by state
+      - Calls and execution time of the statements in pg_stat_statements
+        (when the extension is installed)
+    """
+
+    # Number of statements, by their increase in execution time, in the summary
+    top_statements = 10
+
+    def __init__(self, hge, pg, interval=1):
+        self.hge = hge
+        self.pg = pg
+        self.interval = interval
+        self.samples = []
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.pg_conn = None
+        self.statements_time_column = None
+        self.statements_start = {}
+        self.statements_end = {}
+        self.prev_cpu = {}
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def start(self):
+        self.pg_conn = psycopg2.connect(self.pg.url)
+        self.pg_conn.autocommit = True
+        self.statements_time_column = self.get_statements_time_column()
+        self.statements_start = self.get_statements()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+        if self.pg_conn:
+            self.statements_end = self.get_statements()
+            self.pg_conn.close()
+            self.pg_conn = None
+
+    def run(self):
+        while not self.stop_event.is_set():
+            start = time.time()
+            try:
+                self.samples.append(self.sample())
+            except Exception as e:
+                # Keep sampling, so that one failure doesn't lose the rest of the run
+                print(Fore.YELLOW + "Failed to sample resource usage: " + repr(e) + Style.RESET_ALL)
+            self.stop_event.wait(max(0, self.interval - (time.time() - start)))
+
+    def sample(self):
+        now = time.time()
+        return {
+            'time': now,
+            'hge': self.process_usage('hge', self.hge.get_pid(), now, self.hge_connections()),
+            'hge_rts': self.hge_rts_stats(),
+            'postgres': self.process_usage('postgres', self.pg.get_pid(), now, self.pg_connections()),
+            'pg_stat_statements': self.statements_totals()
+        }
+
+    def process_usage(self, name, pid, now, connections):
+        usage = {'connections': connections}
+        if pid is None:
+            return usage
+        try:
+            tree_usage = process_tree_usage(pid)
+        except (psutil.NoSuchProcess, psutil.AccessDenied):
+            return usage
+        usage['rss'] = tree_usage['rss']
+        prev = self.prev_cpu.get(name)
+        if prev:
+            (prev_time, prev_cpu_seconds) = prev
+            # CPU time of exited children is lost, so the difference can be negative
+            cpu_seconds = max(0, tree_usage['cpu_seconds'] - prev_cpu_seconds)
+            usage['cpu_percent'] = 100 * cpu_seconds / (now - prev_time)
+        self.prev_cpu[name] = (now, tree_usage['cpu_seconds'])
+        return usage
+
+    def hge_connections(self):
+        port = urlparse(self.hge.url).port
+        try:
+            return tcp_connections_to_port(port)
+        except psutil.AccessDenied:
+            return None
+
+    def hge_rts_stats(self):
+        stats = self.hge.get_rts_stats()
+        if not stats:
+            return None
+        sample = {k: stats.get(k) for k in rts_stats_fields}
+        # Live bytes after the last GC
+        sample['live_bytes'] = stats.get('gc', {}).get('gcdetails_live_bytes')
+        return sample
+
+    def pg_connections(self):
+        with self.pg_conn.cursor() as cursor:
+            cursor.execute('''
+            SELECT coalesce(state, 'unknown'), count(*)
+            FROM pg_stat_activity
+            WHERE datname = current_database()
+            GROUP BY state;
+            ''')
+            return dict(cursor.fetchall())
+
+    def get_statements_time_column(self):
+        """
+        The column of pg_stat_statements with the total execution time, which was
+        renamed in Postgres 13. Returns None if pg_stat_statements can't be used
+        """
+        try:
+            with self.pg_conn.cursor() as cursor:
+                cursor.execute('''
+                SELECT attname
+                FROM pg_attribute
+                WHERE attrelid = to_regclass('pg_stat_statements')
+                  AND attname IN ('total_time', 'total_exec_time');
+                ''')
+                rows = cursor.fetchall()
+                if not rows:
+                    return None
+                column = rows[0][0]
+                # Fails if pg_stat_statements isn't in shared_preload_libraries
+                cursor.execute('SELECT count(*) FROM pg_stat_statements;')
+                return column
+        except psycopg2.Error:
+            return None
+
+    def query_statements(self, select):
+        with self.pg_conn.cursor() as cursor:
+            cursor.execute(
+                select.format(total_time=self.statements_time_column) + '''
+                FROM pg_stat_statements
+                WHERE dbid = (SELECT oid FROM pg_database WHERE datname = current_database())
+                ''')
+            return cursor.fetchall()
+
+    def get_statements(self):
+        if not self.statements_time_column:
+            return {}
+        rows = self.query_statements('SELECT queryid, query, calls, {total_time}')
+        return {
+            queryid: {'query': query, 'calls': calls, 'total_time': total_time}
+            for (queryid, query, calls, total_time) in rows
+        }
+
+    def statements_totals(self):
+        if not self.statements_time_column:
+            return None
+        [(calls, total_time)] = self.query_statements('SELECT sum(calls), sum({total_time})')
+        return {
+            'calls': int(calls or 0),
+            'total_time': float(total_time or 0)
+        }
+
+    def statements_deltas(self):
+        """The statements which ran during the benchmark, by their increase in execution time"""
+        deltas = []
+        for (queryid, end) in self.statements_end.items():
+            start = self.statements_start.get(queryid, {'calls': 0, 'total_time': 0})
+            calls = end['calls'] - start['calls']
+            if calls > 0:
+                deltas.append({
+                    'query': end['query'],
+                    'calls': calls,
+                    'total_time': end['total_time'] - start['total_time']
+                })
+        deltas.sort(key=lambda d: d['total_time'], reverse=True)
+        return deltas[:self.top_statements]
+
+    def get_summary(self):
+        def stats(component, key):
+            values = [
+                s[component][key] for s in self.samples
+                if s[component] and s[component].get(key) is not None
+            ]
+            if not values:
+                return None
+            return {
+                'avg': sum(values) / len(values),
+                'max': max(values)
+            }
+
+        def total_pg_connections(s):
+            return sum(s['postgres']['connections'].values())
+
+        summary = {
+            'samples': len(self.samples),
+            'hge': {
+                'cpu_percent': stats('hge', 'cpu_percent'),
+                'rss': stats('hge', 'rss'),
+                'connections': stats('hge', 'connections')
+            },
+            'postgres': {
+                'cpu_percent': stats('postgres', 'cpu_percent'),
+                'rss': stats('postgres', 'rss'),
+                'connections': {
+                    'avg': sum(map(total_pg_connections, self.samples)) / len(self.samples),
+                    'max': max(map(total_pg_connections, self.samples))
+                } if self.samples else None
+            },
+            'hge_rts': None,
+            'pg_stat_statements': None
+        }
+        rts_samples = [s['hge_rts'] for s in self.samples if s['hge_rts']]
+        if rts_samples:
+            (first, last) = (rts_samples[0], rts_samples[-1])
+            summary['hge_rts'] = {k: last[k] - first[k] for k in rts_stats_counters}
+            summary['hge_rts']['max_live_bytes'] = last['max_live_bytes']
+        if self.statements_time_column:
+            summary['pg_stat_statements'] = self.statements_deltas()
+        return summary
+
+    def get_results(self):
+        return {
+            'sample_interval': self.interval,
+            'summary': self.get_summary(),
+            'samples': self.samples
+        }
+
+    def write(self, results_file):
+        with open(results_file, 'w') as f:
+            json.dump(self.get_results(), f, indent=2)
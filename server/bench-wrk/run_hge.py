@@ -3,12 +3,16 @@ import subprocess
 import argparse
 import json
 import signal
+import threading
 import time
 import contextlib
 import requests
 import inflection
 import docker
+import psutil
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from colorama import Fore, Style
+from readiness import wait_until, tail_lines, stream_lines, StartupLogWatcher, ReadinessTimeout
 
 
 def rm_file_if_exists(f):
@@ -31,7 +35,13 @@ class HGE:
         'HASURA_GRAPHQL_ENABLE_CONSOLE' : 'true'
     }
 
-    def __init__(self, pg, port_allocator, docker_image=None, log_file='hge.log', url=None, args=[]):
+    # Number of metadata queries sent in each bulk query by run_bulk_in_chunks
+    metadata_chunk_size = 50
+
+    # Number of times a failed bulk query is retried by run_bulk_in_chunks
+    metadata_retries = 3
+
+    def __init__(self, pg, port_allocator, docker_image=None, log_file='hge.log', url=None, args=[], cpuset=None, metadata_concurrency=1, env={}):
         self.pg = pg
         self.log_file = log_file
         if self.log_file:
@@ -42,9 +52,22 @@ class HGE:
         self.arr_fk_rels = set()
         self.port_allocator = port_allocator
         self.url = url
+        self.port = None
         self.proc = None
         self.container = None
         self.args = args
+        # Comma separated list of CPUs to which graphql-engine is pinned
+        self.cpuset = cpuset
+        # Number of bulk queries sent concurrently by run_bulk_in_chunks
+        self.metadata_concurrency = metadata_concurrency
+        # Additional environment variables of graphql-engine
+        self.env = env
+        self.spawn_time = None
+        self.log_watcher = None
+        self.log_stop_event = threading.Event()
+        # Seconds from spawning graphql-engine to each startup event (see wait_for_start)
+        self.startup_timings = None
+        self.rts_stats_warned = False
 
 
     def admin_secret(self):
@@ -68,7 +91,8 @@ class HGE:
             'HASURA_GRAPHQL_DATABASE_URL': self.pg.url,
             'HASURA_GRAPHQL_SERVER_PORT': str(self.port),
             'HASURA_GRAPHQL_SERVER_HOST': '127.0.0.1',
-            'HPCTIXFILE' : self.tix_file
+            'HPCTIXFILE' : self.tix_file,
+            **self.env
         }
         return hge_env
 
@@ -83,7 +107,8 @@ class HGE:
     def run_with_docker(self):
         if self.url:
             return
-        self.port = self.port_allocator.allocate_port(8080)
+        if not self.port:
+            self.port = self.port_allocator.allocate_port(8080)
         hge_env = self.get_hge_env()
         process_args = ['graphql-engine', 'serve', *self.args]
         docker_ports = {str(self.port) + '/tcp': ('127.0.0.1', self.port)}
@@ -91,6 +116,7 @@ class HGE:
         print("Running GraphQL Engine docker with image:",
               self.docker_image, '(port:{})'.format(self.port))
         print(process_args)
+        self.spawn_time = time.time()
         self.container = self.docker_client.containers.run(
             self.docker_image,
             command=process_args,
@@ -98,9 +124,13 @@ class HGE:
             ports=docker_ports,
             environment=hge_env,
             network_mode='host',
-            volumes={}
+            volumes={},
+            cpuset_cpus=self.cpuset
         )
         self.url = 'http://127.0.0.1:' + str(self.port)
+        self.log_watcher = StartupLogWatcher(
+            stream_lines(self.container.logs(stream=True, follow=True))
+        ).start()
         print("Waiting for GraphQL Engine to be running.", end='')
         self.wait_for_start()
 
@@ -108,13 +138,17 @@ class HGE:
     def run_with_cabal(self):
         if self.url:
             return
-        self.port = self.port_allocator.allocate_port(8080)
+        if not self.port:
+            self.port = self.port_allocator.allocate_port(8080)
         rm_file_if_exists(self.tix_file)
         hge_env = self.get_hge_env()
         process_args = ['cabal', 'new-run', '--', 'exe:graphql-engine', 'serve', *self.args]
+        if self.cpuset:
+            process_args = ['taskset', '--cpu-list', self.cpuset, *process_args]
         print("Running GraphQL with 'cabal run': (port:{})".format(self.port))
         print(process_args)
         self.log_fp = open(self.log_file, 'w')
+        self.spawn_time = time.time()
         self.proc = subprocess.Popen(
             process_args,
             env=hge_env,
@@ -125,6 +159,7 @@ class HGE:
             stderr=subprocess.STDOUT
         )
         self.url = 'http://127.0.0.1:' + str(self.port)
+        self.log_watcher = StartupLogWatcher(tail_lines(self.log_file, self.log_stop_event)).start()
         print("Waiting for GraphQL Engine to be running.", end='')
         self.wait_for_start()
 
@@ -142,29 +177,113 @@ class HGE:
                 self.container.logs(stdout=True, stderr=True).decode('ascii')
             )
 
-    def wait_for_start(self, timeout=120):
-        if timeout <= 0:
-            raise HGEError("Timeout waiting for graphql process to start")
+    def check_if_running(self):
         if self.proc:
             self.check_if_process_is_running()
         elif self.container:
             self.check_if_container_is_running()
+
+    def is_responding(self):
+        """The time of a successful response to a GraphQL query, or None"""
         try:
             q = { 'query': 'query { __typename }' }
             r = requests.post(self.url + '/v1/graphql',json.dumps(q),headers=self.admin_auth_headers())
             if r.status_code == 200:
-                print()
-                return
+                return time.time()
         except requests.exceptions.ConnectionError:
             pass
         except ConnectionError:
             pass
-        print(".", end="", flush=True),
-        sleep_time = 0.5
-        time.sleep(sleep_time)
-        self.wait_for_start(timeout - sleep_time)
+        return None
+
+    def wait_for_start(self, timeout=120):
+        """
+        Wait for the startup log of the API server, and then for the first
+        successful response. As older versions may not log the startup events,
+        the API is also probed while waiting for the log. The time taken for
+        each event since graphql-engine was spawned is set in startup_timings
+        """
+        deadline = time.time() + timeout
+        try:
+            if self.log_watcher:
+                wait_until(
+                    lambda: self.log_watcher.api_server_started.is_set() or self.is_responding(),
+                    timeout, 'graphql-engine to start', check=self.check_if_running,
+                    sleep=self.log_watcher.wait
+                )
+            first_response_time = wait_until(
+                self.is_responding, deadline - time.time(), 'graphql-engine to respond',
+                check=self.check_if_running, initial_delay=0.005
+            )
+        except ReadinessTimeout as e:
+            raise HGEError("Timeout waiting for graphql process to start") from e
+        print()
+        if self.spawn_time:
+            self.set_startup_timings(first_response_time)
+
+    def set_startup_timings(self, first_response_time):
+        def since_spawn(event_time):
+            return event_time - self.spawn_time if event_time else None
+        event_times = self.log_watcher.event_times if self.log_watcher else {}
+        self.startup_timings = {
+            'schema_cache_built': since_spawn(event_times.get('schema_cache')),
+            'api_server_started': since_spawn(event_times.get('api_server')),
+            'first_response': since_spawn(first_response_time),
+            'reported_init_time': self.log_watcher.reported_init_time if self.log_watcher else None
+        }
+        print(Fore.CYAN + "GraphQL engine startup times (seconds): {}".format(self.startup_timings) + Style.RESET_ALL)
+
+    def get_memory_usage(self):
+        """
+        Memory used by graphql-engine in bytes. Returns None if graphql-engine
+        is not run by us
+        """
+        if self.proc:
+            # The graphql-engine process is a descendant of the 'cabal run' process
+            proc = psutil.Process(self.proc.pid)
+            return sum(p.memory_info().rss for p in [proc, *proc.children(recursive=True)])
+        elif self.container:
+            return self.container.stats(stream=False)['memory_stats']['usage']
+        return None
+
+    def get_pid(self):
+        """
+        Pid of the process running graphql-engine (for 'cabal run', its ancestor).
+        Returns None if graphql-engine is not run by us
+        """
+        if self.proc:
+            return self.proc.pid
+        elif self.container:
+            self.container.reload()
+            return self.container.attrs['State']['Pid'] or None
+        return None
+
+    def get_rts_stats(self):
+        """
+        The GHC runtime stats of graphql-engine, which are available only when it
+        is run with +RTS -T (the default of the graphql-engine builds). Returns
+        None otherwise
+        """
+        try:
+            resp = requests.get(self.url + '/dev/rts_stats', headers=self.admin_auth_headers())
+        except requests.exceptions.ConnectionError:
+            return None
+        stats = None
+        if resp.status_code == 200:
+            try:
+                stats = resp.json()
+            except ValueError:
+                pass
+        if not stats:
+            if not self.rts_stats_warned:
+                print(Fore.YELLOW + "GHC runtime stats of GraphQL engine at {} are unavailable (status {}). "
+                      "They require +RTS -T".format(self.url, resp.status_code) + Style.RESET_ALL)
+                self.rts_stats_warned = True
+            return None
+        return stats
 
     def teardown(self):
+        self.log_stop_event.set()
         if getattr(self, 'log_fp', None):
             self.log_fp.close()
             self.log_fp = None
@@ -173,6 +292,20 @@ class HGE:
         elif self.container:
             self.cleanup_docker()
 
+    def restart(self):
+        """
+        Stop graphql-engine and start it again on the same port, say to measure
+        the time taken to start up with the current metadata
+        """
+        if not (self.proc or self.container):
+            raise HGEError("Only a graphql-engine run by us can be restarted")
+        self.teardown()
+        self.url = None
+        self.log_watcher = None
+        self.log_stop_event = threading.Event()
+        self.startup_timings = None
+        self.run()
+
     def cleanup_process(self):
         # TODO hangs
             print(Fore.YELLOW + "Stopping graphql engine at port:", self.port, Style.RESET_ALL)
@@ -226,6 +359,55 @@ class HGE:
         }
         return self.v1q(bulk_q, exp_status)
 
+    def run_bulk_in_chunks(self, queries, description='queries'):
+        """
+        Run the queries as bulk queries of metadata_chunk_size queries each,
+        metadata_concurrency of them at a time, reporting the progress.
+        Each bulk query is retried (with a backoff) on connection errors and
+        server errors. The results are returned in the order of the queries
+        """
+        chunks = [
+            queries[i:i + self.metadata_chunk_size]
+            for i in range(0, len(queries), self.metadata_chunk_size)
+        ]
+        results = [None] * len(chunks)
+        done = 0
+        with ThreadPoolExecutor(max_workers=self.metadata_concurrency) as executor:
+            futures = {
+                executor.submit(self.run_bulk_with_retries, chunk): i
+                for (i, chunk) in enumerate(chunks)
+            }
+            for future in as_completed(futures):
+                i = futures[future]
+                results[i] = future.result()
+                done += len(chunks[i])
+                print("\rCreated {}/{} {}".format(done, len(queries), description), end='', flush=True)
+        print()
+        return [r for chunk_results in results for r in chunk_results]
+
+    def run_bulk_with_retries(self, queries):
+        bulk_q = {
+            'type': 'bulk',
+            'args': queries
+        }
+        error = None
+        for attempt in range(self.metadata_retries + 1):
+            if attempt > 0:
+                print(Fore.YELLOW + "\nRetrying bulk query after error:", error, Style.RESET_ALL)
+                time.sleep(0.5 * 2 ** (attempt - 1))
+            try:
+                resp = requests.post(self.url + '/v1/query', json.dumps(bulk_q), headers=self.admin_auth_headers())
+            except requests.exceptions.ConnectionError as e:
+                error = repr(e)
+                continue
+            if resp.status_code == 200:
+                return resp.json()
+            error = (resp.status_code, resp.text)
+            # Errors in the queries themselves would fail again
+            if resp.status_code < 500:
+                break
+        raise HGEError("Bulk query failed with error: " + repr(error))
+
     def select_simple(self, table, columns):
         query = {
             'type': 'select',
@@ -251,6 +433,25 @@ class HGE:
             })
         return tables
 
+    def get_all_relationships(self, schema='public'):
+        """The (table, relationship name) pairs of the relationships on the tables in the schema"""
+        table = {
+            'schema': 'hdb_catalog',
+            'name': 'hdb_relationship'
+        }
+        query = {
+            'type': 'select',
+            'args': {
+                'table': table,
+                'columns': ['table_name', 'rel_name'],
+                'where': {'table_schema': schema}
+            }
+        }
+        return [
+            ({'schema': schema, 'name': row['table_name']}, row['rel_name'])
+            for row in self.v1q(query)
+        ]
+
 
     def track_tables(self, tables, exp_status=200):
         queries = []
@@ -272,7 +473,7 @@ class HGE:
             'args' : table
         }
 
-    def add_remote_schema(self, name, remote_url, headers={}, client_hdrs=False):
+    def add_remote_schema(self, name, remote_url=None, headers={}, client_hdrs=False, url_from_env=None):
         def hdr_name_val_pair(headers):
             nvp = []
             for (k,v) in headers.items():
@@ -280,24 +481,33 @@ class HGE:
             return nvp
         if len(headers) > 0:
             client_hdrs = True
+        definition = {
+            'headers':  hdr_name_val_pair(headers),
+            'forward_client_headers': client_hdrs
+        }
+        if url_from_env:
+            definition['url_from_env'] = url_from_env
+        else:
+            definition['url'] = remote_url
         q = {
             'type' : 'add_remote_schema',
             'args': {
                 'name': name,
                 'comment': name,
-                'definition': {
-                    'url': remote_url,
-                    'headers':  hdr_name_val_pair(headers),
-                    'forward_client_headers': client_hdrs
-                }
+                'definition': definition
             }
         }
         return self.v1q(q)
 
+    def get_remote_schemas(self):
+        metadata = self.v1q({'type': 'export_metadata', 'args': {}})
+        return [r['name'] for r in metadata.get('remote_schemas') or []]
+
 
     def create_remote_obj_rel_to_itself(self, tables_schema, remote, remote_tables_schema):
         print("Creating remote relationship to the tables in schema {} to itself using remote {}".format(tables_schema, remote))
         fk_constrnts = self.pg.get_all_fk_constraints(tables_schema)
+        queries = []
         for (s, _, t, c, _, ft, _) in fk_constrnts:
             table_cols = self.pg.get_all_columns_of_a_table(t, s)
             if not 'id' in table_cols:
@@ -333,12 +543,44 @@ class HGE:
                     }
                 }
             }
-            print(query)
-            self.v1q(query)
+            queries.append(query)
+        return self.run_bulk_in_chunks(queries, 'remote relationships')
+
+    def create_remote_stand_in_relationships(self, tables_schema, remote):
+        """
+        Remote relationships from the tables with an id column to the messages
+        schema of the remote stand-in server (see remote_stand_in.RemoteStandIn)
+        """
+        print("Creating remote relationships for tables in schema {} using remote stand-in {}".format(tables_schema, remote))
+        queries = []
+        for t in self.pg.get_all_tables_with_column('id', tables_schema):
+            for (rel_name, remote_field) in [('stand_in_message', 'message'), ('stand_in_messages', 'messages')]:
+                arg = 'id' if remote_field == 'message' else 'parent_id'
+                queries.append({
+                    'type': 'create_remote_relationship',
+                    'args' : {
+                        'name' : rel_name,
+                        'table' : {
+                            'schema': tables_schema,
+                            'name': t
+                        },
+                        'remote_schema': remote,
+                        'hasura_fields': ['id'],
+                        'remote_field': {
+                            remote_field : {
+                                'arguments': {
+                                    arg: '$id'
+                                }
+                            }
+                        }
+                    }
+                })
+        return self.run_bulk_in_chunks(queries, 'stand-in remote relationships')
 
     def create_remote_obj_fk_ish_relationships(self, tables_schema, remote, remote_tables_schema):
         print("Creating object foreign key ish relationships for tables in schema {} using remote {}".format(tables_schema, remote))
         fk_constrnts = self.pg.get_all_fk_constraints(tables_schema)
+        queries = []
         for (s, _, t, c, _, ft, _) in fk_constrnts:
             rel_name = inflection.singularize(ft)
             if c.endswith('_id'):
@@ -364,8 +606,8 @@ class HGE:
 
                 }
             }
-            print(query)
-            self.v1q(query)
+            queries.append(query)
+        return self.run_bulk_in_chunks(queries, 'object remote relationships')
 
     def create_obj_fk_relationships(self, schema='public'):
         print("Creating object foreign key relationships for tables in schema ", schema)
@@ -395,7 +637,9 @@ class HGE:
         return self.run_bulk(queries)
 
     def create_remote_arr_fk_ish_relationships(self, tables_schema, remote, remote_tables_schema):
+        print("Creating array foreign key ish relationships for tables in schema {} using remote {}".format(tables_schema, remote))
         fk_constrnts = self.pg.get_all_fk_constraints(tables_schema)
+        queries = []
         for (_, _, t, c, fs, ft, _) in fk_constrnts:
             rel_name = 'remote_' + inflection.pluralize(t) + '_by_' + c
             query ={
@@ -421,8 +665,8 @@ class HGE:
                     }
                 }
             }
-            print(query)
-            self.v1q(query)
+            queries.append(query)
+        return self.run_bulk_in_chunks(queries, 'array remote relationships')
 
     def create_arr_fk_relationships(self, schema='public'):
         print("Creating array foreign key relationships for tables in schema ", schema)
@@ -461,4 +705,7 @@ class HGE:
                     'sql' : sql
                 }
             }
-        return self.v1q(mk_run_sql_q(sql))
+        resp = self.v1q(mk_run_sql_q(sql))
+        if self.pg:
+            self.pg.invalidate_catalog()
+        return resp
@@ -1,23 +1,68 @@
 import docker
 import time
+import re
+import shutil
+import subprocess
+import threading
+from collections import defaultdict
 from contextlib import contextmanager
 import psycopg2
+import psycopg2.pool
 from psycopg2.sql import SQL, Identifier
 from colorama import Fore, Style
 import os
+from urllib.parse import urlparse
+from readiness import wait_until, pg_ping, ReadinessTimeout
 
 
 class PostgresError(Exception):
     pass
 
 
+class PostgresCatalog:
+    """
+    A snapshot of the tables, columns and foreign key constraints in the
+    database, indexed for the lookups done while setting up the metadata
+    """
+
+    def __init__(self, tables, columns, fk_constraints):
+        # schema -> tables
+        self.tables = defaultdict(list)
+        for (schema, table) in tables:
+            self.tables[schema].append(table)
+        # (schema, table) -> columns
+        self.columns = defaultdict(list)
+        # (schema, column) -> tables
+        self.tables_with_column = defaultdict(list)
+        for (schema, table, column) in columns:
+            self.columns[(schema, table)].append(column)
+            self.tables_with_column[(schema, column)].append(table)
+        # schema -> foreign key constraints, as returned by Postgres.get_all_fk_constraints
+        self.fk_constraints = defaultdict(list)
+        for fk_constraint in fk_constraints:
+            self.fk_constraints[fk_constraint[0]].append(fk_constraint)
+
+
 class Postgres:
 
-    def __init__(self, docker_image, db_data_dir, port_allocator, url):
+    # Maximum number of pooled connections
+    max_pool_connections = 10
+
+    # The snapshot directory is bind mounted to this directory within the docker container
+    container_snapshot_dir = '/pg_snapshots'
+
+    def __init__(self, docker_image, db_data_dir, port_allocator, url, cpuset=None, snapshot_dir=None):
         self.port_allocator =  port_allocator
         self.docker_image = docker_image
         self.db_data_dir = os.path.abspath(db_data_dir)
         self.url = url
+        # Comma separated list of CPUs to which the docker container is pinned
+        self.cpuset = cpuset
+        # Directory of the snapshots (pg_dump archives) of the data
+        self.snapshot_dir = snapshot_dir and os.path.abspath(snapshot_dir)
+        self.pool = None
+        self.pool_lock = threading.Lock()
+        self.catalog = None
 
     def setup(self):
         if self.docker_image and not self.url:
@@ -43,6 +88,12 @@ class Postgres:
                 'mode': 'rw'
             }
         }
+        if self.snapshot_dir:
+            os.makedirs(self.snapshot_dir, exist_ok=True)
+            docker_vols[self.snapshot_dir] = {
+                'bind': self.container_snapshot_dir,
+                'mode': 'rw'
+            }
 
         self.docker_client = docker.from_env()
         print("Running postgres docker with image:",
@@ -52,7 +103,8 @@ class Postgres:
             detach=True,
             ports=docker_ports,
             environment=env,
-            volumes = docker_vols
+            volumes = docker_vols,
+            cpuset_cpus = self.cpuset
         )
         self.pg_container = cntnr
         self.url = 'postgresql://' + self.user + ':' + self.password + '@localhost:' + str(self.port) + '/' + self.database
@@ -69,31 +121,77 @@ class Postgres:
             )
 
     def wait_for_db_start(self, timeout=60):
-        if self.pg_container:
-            self.check_if_container_is_running()
-        if timeout > 0:
-            try:
-                self.run_sql('select 1')
-                return
-            except Exception as e:
-                if timeout < 5:
-                    print("\nWaiting for database to be up and running:" + repr(e), end=""),
-                else:
-                    print(".", end="", flush=True),
-                sleep_time = 0.5
-                time.sleep(sleep_time)
-                self.wait_for_db_start(timeout-sleep_time)
-        else:
+        """
+        Wait for the database to accept connections, probing it like pg_isready
+        with exponential backoff, which doesn't need a connection per probe
+        """
+        p = urlparse(self.url)
+        try:
+            wait_until(
+                lambda: pg_ping(p.hostname, p.port or 5432, p.username, p.path.lstrip('/')),
+                timeout, 'database to start',
+                check=self.check_if_container_is_running if self.pg_container else None
+            )
+        except ReadinessTimeout:
             raise PostgresError("Timeout waiting for database to start")
 
+    def get_pool(self):
+        with self.pool_lock:
+            if not self.pool:
+                self.pool = psycopg2.pool.ThreadedConnectionPool(1, self.max_pool_connections, self.url)
+            return self.pool
+
+    def close_pool(self):
+        with self.pool_lock:
+            if self.pool:
+                self.pool.closeall()
+                self.pool = None
+
     @contextmanager
     def cursor(self):
-        with psycopg2.connect(self.url) as conn:
-            with conn.cursor() as cursor:
-                yield cursor
+        """
+        A cursor on a pooled connection. The transaction is committed at the end
+        of the block, or rolled back if it fails
+        """
+        pool = self.get_pool()
+        conn = pool.getconn()
+        try:
+            with conn:
+                with conn.cursor() as cursor:
+                    yield cursor
+        finally:
+            # Don't reuse the connection if it is broken (say, Postgres was restarted)
+            pool.putconn(conn, close=bool(conn.closed))
 
-    def get_all_fk_constraints(self, schema='public'):
+    def get_catalog(self):
+        """
+        The snapshot of the tables, columns and foreign key constraints, which
+        is loaded once and reused until the schema is changed through this object
+        """
+        if not self.catalog:
+            self.catalog = self.load_catalog()
+        return self.catalog
+
+    def invalidate_catalog(self):
+        """
+        Drop the catalog snapshot. To be called after changing the schema other
+        than through this object (say, with run_sql of graphql-engine)
+        """
+        self.catalog = None
+
+    def load_catalog(self):
         with self.cursor() as cursor:
+            cursor.execute('''
+            SELECT table_schema, table_name
+            FROM information_schema.tables;
+            ''')
+            tables = cursor.fetchall()
+            cursor.execute('''
+            SELECT table_schema, table_name, column_name
+            FROM information_schema.columns
+            ORDER BY table_schema, table_name, ordinal_position;
+            ''')
+            columns = cursor.fetchall()
             cursor.execute('''
             SELECT
                 tc.table_schema,
@@ -111,9 +209,13 @@ class Postgres:
                 JOIN information_schema.constraint_column_usage AS ccu
                     ON ccu.constraint_name = tc.constraint_name
                     AND ccu.table_schema = tc.table_schema
-            WHERE tc.constraint_type = 'FOREIGN KEY' and tc.table_schema=%s
-            ''',(schema,))
-            return cursor.fetchall()
+            WHERE tc.constraint_type = 'FOREIGN KEY'
+            ''')
+            fk_constraints = cursor.fetchall()
+        return PostgresCatalog(tables, columns, fk_constraints)
+
+    def get_all_fk_constraints(self, schema='public'):
+        return list(self.get_catalog().fk_constraints[schema])
 
     def move_tables_to_schema(self, cur_schema, target_schema):
         print("Moving tables in schema {} to schema {}".format(cur_schema, target_schema))
@@ -122,30 +224,21 @@ class Postgres:
             cursor.execute(SQL('CREATE SCHEMA IF NOT EXISTS {} ').format(Identifier(target_schema)))
             for table in table_names:
                 cursor.execute(SQL('''ALTER TABLE {}.{} SET SCHEMA {};''').format( Identifier(cur_schema), Identifier(table), Identifier(target_schema) ))
+        self.invalidate_catalog()
 
     def get_all_columns_of_a_table(self, table_name, table_schema='public'):
-        columns = []
-        with self.cursor() as cursor:
-            cursor.execute('''
-            SELECT column_name
-            FROM information_schema.columns
-            WHERE  table_name= %s and table_schema=%s;
-            ''', (table_name, table_schema))
-            for row in cursor.fetchall():
-                columns.append(row[0])
-        return columns
+        return list(self.get_catalog().columns[(table_schema, table_name)])
 
     def get_all_tables_with_column(self, column, schema='public'):
-        tables = []
+        return list(self.get_catalog().tables_with_column[(schema, column)])
+
+    def get_distinct_column_values(self, table_name, column, table_schema='public'):
         with self.cursor() as cursor:
-            cursor.execute('''
-            SELECT table_name
-            FROM information_schema.columns
-            WHERE  column_name= %s and table_schema=%s;
-            ''', (column,schema))
-            for row in cursor.fetchall():
-                tables.append(row[0])
-        return tables
+            # Ordered, so that the values (and the ranks of the zipfian
+            # generators) don't depend on the query plan
+            cursor.execute(SQL('SELECT DISTINCT {} FROM {}.{} ORDER BY 1;').format(
+                Identifier(column), Identifier(table_schema), Identifier(table_name)))
+            return [row[0] for row in cursor.fetchall()]
 
     def set_id_as_primary_key_for_tables(self, schema='public'):
         print("Setting id as primary key for all tables in schema ", schema)
@@ -153,36 +246,107 @@ class Postgres:
         with self.cursor() as cursor:
             for table in tables_with_id_col:
                 self.set_id_as_primary_key_for_table(cursor, table, schema)
+        self.invalidate_catalog()
 
     def set_id_as_primary_key_for_table(self, cursor, table, schema='public'):
             cursor.execute(SQL('''ALTER TABLE {}.{} ADD PRIMARY KEY (id);''').format( Identifier(schema), Identifier(table) ))
 
     def get_all_tables_in_a_schema(self, schema='public'):
-        tables = []
-        with self.cursor() as cursor:
-            cursor.execute('''
-            SELECT table_name
-            FROM information_schema.tables
-            WHERE table_schema=%s;
-            ''', (schema,))
-            for row in cursor.fetchall():
-                tables.append(row[0])
-        return tables
+        return list(self.get_catalog().tables[schema])
 
     def run_sql(self, sql):
         with self.cursor() as cursor:
             cursor.execute(sql)
+        self.invalidate_catalog()
 
     def get_server_version(self):
         with self.cursor() as cursor:
             cursor.execute("select setting from pg_config where name = 'VERSION';")
             return cursor.fetchall()[0][0]
 
+    def get_snapshot_name(self, dataset, schema):
+        """Snapshots are specific to the dataset, the schema and the version of Postgres"""
+        pg_version = re.sub(r'[^A-Za-z0-9.]+', '_', self.get_server_version())
+        return '{}-{}-{}.dump'.format(dataset, schema, pg_version)
+
+    def snapshots_supported(self):
+        """
+        The pg_dump and pg_restore of the docker container are used if Postgres
+        is run by us, otherwise they should be installed locally
+        """
+        if not self.snapshot_dir:
+            return False
+        if getattr(self, 'pg_container', None):
+            return True
+        return bool(shutil.which('pg_dump') and shutil.which('pg_restore'))
+
+    def run_pg_tool(self, args):
+        """
+        Run pg_dump or pg_restore with the given arguments, followed by the
+        database url. The paths in the arguments are relative to the snapshot directory
+        """
+        if getattr(self, 'pg_container', None):
+            snapshot_dir = self.container_snapshot_dir
+            url = 'postgresql://{}:{}@localhost:5432/{}'.format(self.user, self.password, self.database)
+        else:
+            snapshot_dir = self.snapshot_dir
+            url = self.url
+        command = [
+            arg.format(snapshot_dir=snapshot_dir) for arg in args
+        ] + ['--dbname', url]
+        if getattr(self, 'pg_container', None):
+            (exit_code, output) = self.pg_container.exec_run(command)
+            output = output.decode('utf-8', errors='replace')
+        else:
+            proc = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            (exit_code, output) = (proc.returncode, proc.stdout.decode('utf-8', errors='replace'))
+        if exit_code != 0:
+            raise PostgresError("{} failed with error:\n{}".format(args[0], output))
+
+    def save_snapshot(self, name, schema):
+        """Dump the schema with its data to the snapshot with given name"""
+        print("Saving snapshot of schema {} to {}".format(schema, name))
+        tmp_name = name + '.tmp'
+        self.run_pg_tool([
+            'pg_dump', '--format=custom', '--schema', schema,
+            '--file', os.path.join('{snapshot_dir}', tmp_name)
+        ])
+        os.replace(os.path.join(self.snapshot_dir, tmp_name), os.path.join(self.snapshot_dir, name))
+
+    def restore_snapshot(self, name, jobs=None):
+        """
+        Restore the snapshot with given name, using jobs parallel jobs (by default,
+        the number of CPUs). Returns False if there's no such snapshot
+        """
+        if not os.path.exists(os.path.join(self.snapshot_dir, name)):
+            return False
+        jobs = jobs or os.cpu_count()
+        print("Restoring snapshot {} with {} jobs".format(name, jobs))
+        start_time = time.time()
+        self.run_pg_tool([
+            'pg_restore', '--no-owner', '--jobs', str(jobs),
+            os.path.join('{snapshot_dir}', name)
+        ])
+        print("Restored snapshot {} in {:.2f} seconds".format(name, time.time() - start_time))
+        self.invalidate_catalog()
+        return True
+
     def run_sql_from_file(self, sql_file):
         print("Running sql from file:", sql_file)
         self.run_sql(open(sql_file, 'r').read())
 
+    def get_pid(self):
+        """
+        Pid of the main process of the Postgres docker container.
+        Returns None if Postgres is not run by us
+        """
+        if getattr(self, 'pg_container', None):
+            self.pg_container.reload()
+            return self.pg_container.attrs['State']['Pid'] or None
+        return None
+
     def teardown(self):
+        self.close_pool()
         self.cleanup_docker()
 
     def cleanup_docker(self):
@@ -10,6 +10,8 @@ from colorama import Fore, Style
 from port_allocator import PortAllocator
 from run_postgres import Postgres
 from run_hge import HGE
+from data_generator import ScaledDataGenerator
+from remote_stand_in import RemoteStandIn
 
 
 def _first_true(iterable, default=False, pred=None):
@@ -24,7 +26,13 @@ class HGETestSetup:
 
     previous_work_dir_file = '.previous_work_dir'
 
-    def __init__(self, pg_url, remote_pg_url, pg_docker_image, hge_url, remote_hge_url, hge_docker_image=None, hge_args=[], skip_remote_graphql_setup=False, skip_stack_build=False):
+    # Name of the remote schema of the remote stand-in server
+    remote_stand_in_name = 'stand_in'
+
+    # Environment variable with the url of the remote stand-in server
+    remote_stand_in_url_env = 'HASURA_BENCH_REMOTE_STAND_IN_URL'
+
+    def __init__(self, pg_url, remote_pg_url, pg_docker_image, hge_url, remote_hge_url, hge_docker_image=None, hge_args=[], skip_remote_graphql_setup=False, skip_stack_build=False, cpuset=None, metadata_concurrency=1, pg_snapshot_dir=None, skip_pg_snapshots=False, scale_factor=1, remote_stand_in=False, stand_in_latency=0, stand_in_jitter=0, stand_in_payload_size=0):
         self.pg_url = pg_url
         self.remote_pg_url = remote_pg_url
         self.pg_docker_image = pg_docker_image
@@ -34,8 +42,19 @@ class HGETestSetup:
         self.hge_args = hge_args
         self.skip_remote_graphql_setup = skip_remote_graphql_setup
         self.skip_stack_build = skip_stack_build
+        self.cpuset = cpuset
+        self.metadata_concurrency = metadata_concurrency
+        # The sportsdb data is scaled by this factor (see data_generator.ScaledDataGenerator)
+        self.scale_factor = scale_factor
         self.port_allocator = PortAllocator()
         self.init_work_dir()
+        self.init_pg_snapshot_dir(pg_snapshot_dir, skip_pg_snapshots)
+        self.remote_stand_in = None
+        if remote_stand_in:
+            self.remote_stand_in = RemoteStandIn(
+                self.port_allocator, latency=stand_in_latency,
+                jitter=stand_in_jitter, payload_size=stand_in_payload_size
+            )
         self.init_pgs()
         self.init_hges()
         self.set_previous_work_dir()
@@ -77,27 +96,50 @@ class HGETestSetup:
         os.makedirs(self.work_dir, exist_ok=True)
         requests_cache.install_cache(self.work_dir + '/sportsdb_cache')
 
+    def init_pg_snapshot_dir(self, pg_snapshot_dir, skip_pg_snapshots):
+        """
+        The snapshots of the data are stored in pg_snapshots under the work
+        directory by default. They aren't used if skip_pg_snapshots is set
+        """
+        self.pg_snapshot_dir = None
+        if not skip_pg_snapshots:
+            self.pg_snapshot_dir = os.path.abspath(pg_snapshot_dir or os.path.join(self.work_dir, 'pg_snapshots'))
+        self.sql_file_lock = threading.Lock()
+        self.sql_file = None
+
+    def get_dataset_name(self):
+        """Name of the dataset, in the names of the data directories and the Postgres snapshots"""
+        if self.scale_factor == 1:
+            return 'sportsdb'
+        return 'sportsdb_x{}'.format(self.scale_factor)
+
     def init_pgs(self):
         def _init_pg(data_dir, url):
             return Postgres(
                 port_allocator=self.port_allocator, docker_image=self.pg_docker_image,
-                db_data_dir= self.work_dir + '/' + data_dir, url=url
+                db_data_dir= self.work_dir + '/' + data_dir.format(self.get_dataset_name()), url=url, cpuset=self.cpuset,
+                snapshot_dir=self.pg_snapshot_dir
             )
 
-        self.pg = _init_pg('sportsdb_data', self.pg_url)
+        self.pg = _init_pg('{}_data', self.pg_url)
 
         if not self.skip_remote_graphql_setup:
-            self.remote_pg = _init_pg('remote_sportsdb_data', self.remote_pg_url)
+            self.remote_pg = _init_pg('remote_{}_data', self.remote_pg_url)
 
     def init_hges(self):
-        def _init_hge(pg, hge_url, log_file):
+        def _init_hge(pg, hge_url, log_file, env={}):
             return HGE(
                 pg=pg, url=hge_url, port_allocator=self.port_allocator,
                 args=self.hge_args, log_file= self.work_dir + '/' + log_file,
-                docker_image=self.hge_docker_image
+                docker_image=self.hge_docker_image, cpuset=self.cpuset,
+                metadata_concurrency=self.metadata_concurrency, env=env
             )
 
-        self.hge = _init_hge(self.pg, self.hge_url, 'hge.log')
+        hge_env = {}
+        # The url of the remote stand-in server, when graphql-engine is run by us
+        if self.remote_stand_in and not self.hge_url:
+            hge_env[self.remote_stand_in_url_env] = self.remote_stand_in.url
+        self.hge = _init_hge(self.pg, self.hge_url, 'hge.log', hge_env)
 
         if not self.skip_remote_graphql_setup:
             self.remote_hge = _init_hge(self.remote_pg, self.remote_hge_url, 'remote_hge.log')
@@ -105,12 +147,21 @@ class HGETestSetup:
     @contextmanager
     def graphql_engines_setup(self):
         try:
+            if self.remote_stand_in:
+                self.remote_stand_in.run()
             self._setup_graphql_engines()
             yield
         finally:
             self.teardown()
+            if self.remote_stand_in:
+                self.remote_stand_in.teardown()
 
     def _setup_graphql_engines(self):
+        self._setup_sportsdb_graphql_engines()
+        if self.remote_stand_in:
+            self.setup_remote_stand_in()
+
+    def _setup_sportsdb_graphql_engines(self):
 
         if not self.hge_docker_image and not self.skip_stack_build:
             HGE.do_stack_build()
@@ -128,16 +179,26 @@ class HGETestSetup:
 
         def set_hge(hge, schema, hge_type):
             pg = hge.pg
-            # Schema and data
-            pg.run_sql_from_file(sql_file)
-            pg.set_id_as_primary_key_for_tables(schema='public')
-            pg.move_tables_to_schema('public', schema)
+            # Schema and data, from the snapshot of a previous setup if present
+            if pg.snapshots_supported():
+                snapshot = pg.get_snapshot_name(self.get_dataset_name(), schema)
+                if not pg.restore_snapshot(snapshot):
+                    setup_schema_and_data(pg, schema)
+                    pg.save_snapshot(snapshot, schema)
+            else:
+                setup_schema_and_data(pg, schema)
 
             # Metadata stuff
             hge.track_all_tables_in_schema(schema)
             hge.create_obj_fk_relationships(schema)
             hge.create_arr_fk_relationships(schema)
 
+        def setup_schema_and_data(pg, schema):
+            pg.run_sql_from_file(self.get_sportsdb_sql_file())
+            pg.set_id_as_primary_key_for_tables(schema='public')
+            pg.move_tables_to_schema('public', schema)
+            ScaledDataGenerator(pg, schema, self.scale_factor).generate()
+
         def start_remote_postgres_docker():
             if not self.skip_remote_graphql_setup:
                 self.remote_pg.start_postgres_docker()
@@ -159,10 +220,6 @@ class HGETestSetup:
         if len(tables) > 0:
             return
 
-        # Download sportsdb
-        zip_file = self.download_sportsdb_zip(self.work_dir+ '/sportsdb.zip')
-        sql_file = self.unzip_sql_file(zip_file)
-
         def set_remote_hge():
             if not self.skip_remote_graphql_setup:
                 set_hge(self.remote_hge, 'remote_hge', 'Remote')
@@ -182,21 +239,47 @@ class HGETestSetup:
             )
 
         # TODO update the remote schema url if needed
-        tables = self.pg.get_all_tables_in_a_schema('hdb_catalog')
 
 	    # Create remote relationships only if it is supported
-        if 'hdb_remote_relationship' not in tables:
+        if not self.remote_relationships_supported():
             return
 
         # Create remote relationships
         if not self.skip_remote_graphql_setup:
             self.create_remote_relationships()
 
+    def remote_relationships_supported(self):
+        return 'hdb_remote_relationship' in self.pg.get_all_tables_in_a_schema('hdb_catalog')
+
+    def setup_remote_stand_in(self):
+        """
+        Add the remote stand-in server as a remote schema, with remote
+        relationships to it from the tables in schema hge, unless already
+        present. Its url is taken from an environment variable of the GraphQL
+        engine when it's run by us, as the port may differ from run to run
+        """
+        if self.remote_stand_in_name in self.hge.get_remote_schemas():
+            return
+        if self.hge.env.get(self.remote_stand_in_url_env):
+            self.hge.add_remote_schema(self.remote_stand_in_name, url_from_env=self.remote_stand_in_url_env)
+        else:
+            self.hge.add_remote_schema(self.remote_stand_in_name, self.remote_stand_in.url)
+        if self.remote_relationships_supported():
+            self.hge.create_remote_stand_in_relationships('hge', self.remote_stand_in_name)
+
     def create_remote_relationships(self):
         self.hge.create_remote_obj_rel_to_itself('hge', 'remote_hge', 'remote_hge')
         self.hge.create_remote_arr_fk_ish_relationships('hge', 'remote_hge', 'remote_hge')
         self.hge.create_remote_obj_fk_ish_relationships('hge', 'remote_hge', 'remote_hge')
 
+    def get_sportsdb_sql_file(self):
+        """Download and unzip the sportsdb SQL file, once for both the databases"""
+        with self.sql_file_lock:
+            if not self.sql_file:
+                zip_file = self.download_sportsdb_zip(self.work_dir+ '/sportsdb.zip')
+                self.sql_file = self.unzip_sql_file(zip_file)
+            return self.sql_file
+
     def teardown(self):
         for res in [self.hge, self.pg]:
             res.teardown()
@@ -258,9 +341,21 @@ class HGETestSetupArgs:
         self.skip_stack_build = self.parsed_args.skip_stack_build
         self.skip_remote_graphql_setup = self.parsed_args.skip_remote_graphql_setup
         self.hge_args =  self.parsed_args.hge_args[1:]
+        self.metadata_concurrency = int(self.get_param('metadata_concurrency') or 1)
+        self.pg_snapshot_dir = self.get_param('pg_snapshot_dir')
+        self.scale_factor = int(self.get_param('scale_factor') or 1)
+        self.skip_pg_snapshots = self.parsed_args.skip_pg_snapshots
+        self.remote_stand_in = self.parsed_args.remote_stand_in
+        self.stand_in_latency = float(self.get_param('stand_in_latency') or 0)
+        self.stand_in_jitter = float(self.get_param('stand_in_jitter') or 0)
+        self.stand_in_payload_size = int(self.get_param('stand_in_payload_size') or 0)
 
     def set_pg_options(self):
-        pg_opts = self.arg_parser.add_argument_group('Postgres').add_mutually_exclusive_group()
+        pg_group = self.arg_parser.add_argument_group('Postgres')
+        pg_group.add_argument('--pg-snapshot-dir', metavar='HASURA_BENCH_PG_SNAPSHOT_DIR', help='Directory of the snapshots of the databases, restored instead of setting up the data again (default: pg_snapshots in the work directory)', required=False)
+        pg_group.add_argument('--skip-pg-snapshots', help='Set up the data from the SQL file, without using or saving snapshots', action='store_true', required=False)
+        pg_group.add_argument('--scale-factor', metavar='HASURA_BENCH_SCALE_FACTOR', help='Scale the sportsdb data by this factor, keeping the foreign keys intact (default: 1)', type=int, required=False)
+        pg_opts = pg_group.add_mutually_exclusive_group()
         pg_opts.add_argument('--pg-url', metavar='HASURA_BENCH_PG_URLS', help='Postgres database url to be used for tests', required=False)
         pg_opts.add_argument('--remote-pg-url', metavar='HASURA_BENCH_REMOTE_PG_URLS', help='Url of Postgres database which is attached/has to be attached, with remote graphql-engine', required=False)
         pg_opts.add_argument('--pg-docker-image', metavar='HASURA_BENCH_PG_DOCKER_IMAGE', help='Postgres docker image to be used for tests', required=False)
@@ -271,7 +366,13 @@ class HGETestSetupArgs:
         hge_opts.add_argument('--remote-hge-url', metavar='HASURA_BENCH_REMOTE_HGE_URL', help='Url of remote Hasura graphql-engine')
         hge_opts.add_argument('--hge-docker-image', metavar='HASURA_BENCH_HGE_DOCKER_IMAGE', help='GraphQl engine docker image to be used for tests', required=False)
         hge_opts.add_argument('--skip-stack-build', help='Skip stack build if this option is set', action='store_true', required=False)
+        hge_opts.add_argument('--metadata-concurrency', metavar='HASURA_BENCH_METADATA_CONCURRENCY', help='Number of bulk metadata queries (like creating remote relationships) sent concurrently during setup', type=int, required=False)
         hge_opts.add_argument('--skip-remote-graphql-setup', help='Skip setting up of remote graphql engine', action='store_true', required=False)
+        stand_in_opts = self.arg_parser.add_argument_group('Remote stand-in server')
+        stand_in_opts.add_argument('--remote-stand-in', help='Run a GraphQL server with a controllable latency, and add it as the remote schema {} (see remote_stand_in.py)'.format(HGETestSetup.remote_stand_in_name), action='store_true', required=False)
+        stand_in_opts.add_argument('--stand-in-latency', metavar='HASURA_BENCH_STAND_IN_LATENCY', help='Latency of the responses of the remote stand-in server in milliseconds (default: 0)', type=float, required=False)
+        stand_in_opts.add_argument('--stand-in-jitter', metavar='HASURA_BENCH_STAND_IN_JITTER', help='Maximum variation of the latency of the remote stand-in server in milliseconds (default: 0)', type=float, required=False)
+        stand_in_opts.add_argument('--stand-in-payload-size', metavar='HASURA_BENCH_STAND_IN_PAYLOAD_SIZE', help='Size in bytes of the payload of each message returned by the remote stand-in server (default: 0)', type=int, required=False)
         self.arg_parser.add_argument('hge_args', nargs=argparse.REMAINDER)
 
     def default_env(self, attr):
@@ -311,7 +412,15 @@ class HGETestSetupWithArgs(HGETestSetup, HGETestSetupArgs):
             hge_docker_image = self.hge_docker_image,
             skip_stack_build = self.skip_stack_build,
             skip_remote_graphql_setup = self.skip_remote_graphql_setup,
-            hge_args = self.hge_args
+            hge_args = self.hge_args,
+            metadata_concurrency = self.metadata_concurrency,
+            pg_snapshot_dir = self.pg_snapshot_dir,
+            skip_pg_snapshots = self.skip_pg_snapshots,
+            scale_factor = self.scale_factor,
+            remote_stand_in = self.remote_stand_in,
+            stand_in_latency = self.stand_in_latency,
+            stand_in_jitter = self.stand_in_jitter,
+            stand_in_payload_size = self.stand_in_payload_size
         )
 
 if __name__ == "__main__":
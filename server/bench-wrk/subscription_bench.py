@@ -0,0 +1,227 @@
+import asyncio
+import json
+import time
+import random
+import websockets
+from colorama import Fore, Style
+from latency_histogram import new_hdr_histogram
+
+
+class SubscriptionBenchError(Exception):
+    """Exception type for the subscription benchmarks"""
+
+
+class GraphQLWsConnection:
+    """
+    A client for the graphql-ws protocol on asyncio, handling the same messages
+    as GQLWsClient in tests-py/context.py. Unlike GQLWsClient, which runs a
+    thread per connection, thousands of these can be opened from a single thread.
+    """
+
+    def __init__(self, url, headers={}):
+        self.url = url
+        self.headers = headers
+        self.ws = None
+
+    async def send(self, frame):
+        await self.ws.send(json.dumps(frame))
+
+    async def recv(self):
+        while True:
+            msg = json.loads(await self.ws.recv())
+            if msg['type'] != 'ka':
+                return msg
+
+    async def connect(self):
+        self.ws = await websockets.connect(self.url, subprotocols=['graphql-ws'], max_size=None)
+        payload = {}
+        if self.headers:
+            payload['headers'] = self.headers
+        await self.send({'type': 'connection_init', 'payload': payload})
+        ev = await self.recv()
+        if ev['type'] != 'connection_ack':
+            raise SubscriptionBenchError("Unexpected response to connection_init: " + repr(ev))
+
+    async def start(self, query_id, query, variables={}):
+        await self.send({
+            'id': query_id,
+            'type': 'start',
+            'payload': {
+                'query': query,
+                'variables': variables
+            }
+        })
+
+    async def close(self):
+        if self.ws:
+            await self.ws.close()
+            self.ws = None
+
+
+class SubscriptionLoad:
+    """
+    Opens the given number of connections, each with a subscription on one of
+    the rows of a table, and updates the rows at a fixed rate.
+
+    The update sets a column of the row to the (epoch) time at which the
+    update was sent, so every subscriber receiving the new value of the row
+    can compute the delay in delivering the update. The delays are recorded in
+    a HdrHistogram in microseconds.
+    """
+
+    # Maximum number of connections being opened at any time
+    max_pending_connections = 100
+
+    def __init__(
+            self, ws_url, headers, subscription, mutate_row, rows, connections,
+            mutations_per_sec, duration, memory_usage=None, memory_sample_interval=1
+    ):
+        self.ws_url = ws_url
+        self.headers = headers
+        self.subscription = subscription
+        # Function which sets the time column of the row with given id to the given time
+        self.mutate_row = mutate_row
+        self.rows = rows
+        self.connections = connections
+        self.mutations_per_sec = mutations_per_sec
+        self.duration = duration
+        # Function returning the memory used by graphql-engine (in bytes)
+        self.memory_usage = memory_usage
+        self.memory_sample_interval = memory_sample_interval
+        self.histogram = new_hdr_histogram()
+        self.updates_received = 0
+        self.mutations_sent = 0
+        self.errors = 0
+        self.memory_samples = []
+        self.running = False
+
+    def run(self):
+        asyncio.run(self.run_async())
+        return self
+
+    async def run_async(self):
+        conns = []
+        loop = asyncio.get_event_loop()
+        try:
+            print(Fore.GREEN + "Opening {} subscriptions".format(self.connections) + Style.RESET_ALL)
+            semaphore = asyncio.Semaphore(self.max_pending_connections)
+            start_time = time.time()
+            subscribed = await asyncio.gather(*[
+                self.subscribe(semaphore, i) for i in range(self.connections)
+            ], return_exceptions=True)
+            conns = [c for c in subscribed if isinstance(c, GraphQLWsConnection)]
+            errors = [e for e in subscribed if isinstance(e, BaseException)]
+            if errors:
+                raise errors[0]
+            print("Opened subscriptions in {:.2f} seconds".format(time.time() - start_time))
+            await self.sample_memory_usage(loop, 'subscribed')
+            self.running = True
+            receivers = [asyncio.ensure_future(self.receive_updates(conn)) for conn in conns]
+            sampler = asyncio.ensure_future(self.sample_memory_usage_periodically(loop))
+            print(Fore.GREEN + "Updating rows at {} req/s for {} seconds".format(self.mutations_per_sec, self.duration) + Style.RESET_ALL)
+            await self.send_mutations(loop)
+            # Let the updates of the last mutations be delivered
+            await asyncio.sleep(2)
+            self.running = False
+            sampler.cancel()
+            for receiver in receivers:
+                receiver.cancel()
+            await asyncio.gather(*receivers, sampler, return_exceptions=True)
+        finally:
+            await asyncio.gather(*[conn.close() for conn in conns], return_exceptions=True)
+
+    async def subscribe(self, semaphore, index):
+        row_id = index % self.rows + 1
+        async with semaphore:
+            conn = GraphQLWsConnection(self.ws_url, self.headers)
+            await conn.connect()
+            await conn.start('1', self.subscription, {'id': row_id})
+            # Wait for the initial result
+            ev = await conn.recv()
+            if ev['type'] != 'data' or ev['payload'].get('errors'):
+                raise SubscriptionBenchError("Subscription failed: " + repr(ev))
+            conn.last_value = self.get_mutated_at(ev)
+            return conn
+
+    @staticmethod
+    def get_mutated_at(ev):
+        rows = list(ev['payload']['data'].values())[0]
+        if not rows:
+            return None
+        return float(rows[0]['mutated_at'])
+
+    async def receive_updates(self, conn):
+        while True:
+            ev = await conn.recv()
+            received_at = time.time()
+            if ev['type'] != 'data' or ev['payload'].get('errors'):
+                self.errors += 1
+                continue
+            mutated_at = self.get_mutated_at(ev)
+            if mutated_at is None or mutated_at == conn.last_value:
+                continue
+            conn.last_value = mutated_at
+            if self.running:
+                self.updates_received += 1
+                delay_us = max(1, round((received_at - mutated_at) * 1000 * 1000))
+                self.histogram.record_value(delay_us)
+
+    async def send_mutations(self, loop):
+        interval = 1.0 / self.mutations_per_sec
+        start_time = loop.time()
+        pending = set()
+        for i in range(int(self.duration * self.mutations_per_sec)):
+            # Send the mutations at fixed times, irrespective of how long the previous ones took
+            await asyncio.sleep(max(0, start_time + i * interval - loop.time()))
+            row_id = random.randint(1, self.rows)
+            pending.add(loop.create_task(self.send_mutation(loop, row_id)))
+        if pending:
+            await asyncio.wait(pending)
+
+    async def send_mutation(self, loop, row_id):
+        try:
+            await loop.run_in_executor(None, lambda: self.mutate_row(row_id, time.time()))
+        except Exception as e:
+            if not self.errors:
+                print("Mutation failed:", e)
+            self.errors += 1
+            return
+        self.mutations_sent += 1
+
+    async def sample_memory_usage(self, loop, label):
+        if self.memory_usage:
+            # Getting the memory usage (say, of a docker container) can be slow,
+            # so don't block the receivers
+            usage = await loop.run_in_executor(None, self.memory_usage)
+            self.memory_samples.append({
+                'time': time.time(),
+                'label': label,
+                'bytes': usage
+            })
+
+    async def sample_memory_usage_periodically(self, loop):
+        while True:
+            await asyncio.sleep(self.memory_sample_interval)
+            await self.sample_memory_usage(loop, 'running')
+
+    def get_latency_percentiles(self):
+        """Update delivery latency percentiles in milliseconds"""
+        return {
+            str(p): self.histogram.get_value_at_percentile(p) / 1000.0
+            for p in [50, 90, 95, 99, 99.9, 100]
+        }
+
+    def get_results(self):
+        memory = [s['bytes'] for s in self.memory_samples if s['bytes'] is not None]
+        return {
+            'updates_received': self.updates_received,
+            'mutations_sent': self.mutations_sent,
+            'errors': self.errors,
+            'latency_percentiles': self.get_latency_percentiles(),
+            'hdr_histogram': self.histogram.encode().decode('ascii'),
+            'hge_memory': {
+                'after_subscribing': memory[0] if memory else None,
+                'max': max(memory) if memory else None,
+                'samples': self.memory_samples
+            }
+        }
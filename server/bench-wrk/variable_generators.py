@@ -0,0 +1,76 @@
+import random
+import itertools
+
+
+class VariableGeneratorError(Exception):
+    """Exception type for invalid variable generator specifications"""
+
+
+class ZipfianChoice:
+    """
+    Chooses one of the values such that the probability of choosing the k-th
+    most frequent value is proportional to 1/k^s.
+    The values are shuffled with a fixed seed before assigning the ranks, so that
+    the frequent values are spread across the key space, but stay the same across runs
+    """
+
+    def __init__(self, values, s=1.0, seed=0):
+        self.values = list(values)
+        random.Random(seed).shuffle(self.values)
+        self.cum_weights = list(itertools.accumulate(
+            1.0 / (rank ** s) for rank in range(1, len(self.values) + 1)
+        ))
+
+    def __call__(self):
+        return random.choices(self.values, cum_weights=self.cum_weights)[0]
+
+
+def _json_value(v):
+    if v is None or isinstance(v, (bool, int, float, str)):
+        return v
+    # Like dates and decimals
+    return str(v)
+
+
+def get_column_values(spec, pg):
+    if not pg:
+        raise VariableGeneratorError("Postgres is required for generator " + repr(spec))
+    values = pg.get_distinct_column_values(spec['table'], spec['column'], spec.get('schema', 'public'))
+    if not values:
+        raise VariableGeneratorError("No values found for generator " + repr(spec))
+    return [_json_value(v) for v in values]
+
+
+def make_variable_generator(spec, pg=None):
+    """
+    Make a function generating the values of a query variable from its
+    specification. The specification can be
+      - a literal value, which is used as is
+      - {'choice': [v1, v2, ...]}: one of the values, chosen uniformly
+      - {'range': [min, max]}: an integer between min and max (both inclusive), chosen uniformly
+      - {'uniform': {'schema': s, 'table': t, 'column': c}}: one of the distinct values
+        of the column in the Postgres table, chosen uniformly
+      - {'zipfian': {'schema': s, 'table': t, 'column': c, 's': 1.0}}: one of the
+        distinct values of the column in the Postgres table, with a zipfian
+        distribution of exponent s
+    """
+    if isinstance(spec, dict) and len(spec) == 1:
+        [(kind, arg)] = spec.items()
+        if kind == 'choice':
+            values = list(arg)
+            return lambda: random.choice(values)
+        elif kind == 'range':
+            (low, high) = arg
+            return lambda: random.randint(low, high)
+        elif kind == 'uniform':
+            values = get_column_values(arg, pg)
+            return lambda: random.choice(values)
+        elif kind == 'zipfian':
+            return ZipfianChoice(get_column_values(arg, pg), arg.get('s', 1.0))
+    return lambda: spec
+
+
+def make_variables_generator(specs, pg=None):
+    """Make a function generating the variables of a query from the specification of each variable"""
+    generators = {k: make_variable_generator(v, pg) for (k, v) in specs.items()}
+    return lambda: {k: gen() for (k, gen) in generators.items()}
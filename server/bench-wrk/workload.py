@@ -0,0 +1,219 @@
+import asyncio
+import random
+import os
+import graphql
+import aiohttp
+import ruamel.yaml as yaml
+from colorama import Fore, Style
+from latency_histogram import new_hdr_histogram
+from subscription_bench import GraphQLWsConnection
+from variable_generators import make_variables_generator
+
+
+class WorkloadError(Exception):
+    """Exception type for the workload profiles"""
+
+
+class WorkloadOperation:
+    """An operation in the workload, along with its weight, variables and headers"""
+
+    def __init__(self, query, weight=1, variables={}, headers={}, pg=None):
+        self.query = query
+        self.name = query.name.value
+        self.query_str = graphql.print_ast(query)
+        self.weight = weight
+        self.gen_variables = make_variables_generator(variables, pg)
+        self.headers = headers
+
+    def request_body(self):
+        body = {'query': self.query_str}
+        variables = self.gen_variables()
+        if variables:
+            body['variables'] = variables
+        return body
+
+
+class OperationStats:
+    """Latencies and errors of the requests of an operation in a workload run"""
+
+    def __init__(self):
+        self.histogram = new_hdr_histogram()
+        self.requests = 0
+        self.errors = 0
+
+    def record(self, latency, success):
+        self.requests += 1
+        if not success:
+            self.errors += 1
+        # Latencies are recorded in microseconds
+        self.histogram.record_value(max(1, round(latency * 1000 * 1000)))
+
+
+class WorkloadSubscription:
+    """Subscriptions kept open (and receiving updates) during the workload"""
+
+    def __init__(self, query, connections=1, variables={}, headers={}, pg=None):
+        self.name = query.name.value
+        self.query_str = graphql.print_ast(query)
+        self.connections = connections
+        self.gen_variables = make_variables_generator(variables, pg)
+        self.headers = headers
+
+
+class WorkloadProfile:
+    """
+    A weighted mix of GraphQL operations, loaded from a YAML file like:
+
+        name: mixed_reads
+        # Operations are looked up by name in this file (relative to the profile)
+        queries_file: mixed.graphql
+        requests_per_sec: [100, 200]
+        operations:
+          - name: event_by_id
+            weight: 10
+            variables:
+              id: {zipfian: {schema: hge, table: events, column: id, s: 1.1}}
+            headers:
+              X-Hasura-Role: admin
+        subscriptions:
+          - name: event_status
+            connections: 100
+            variables:
+              id: {range: [1, 100]}
+
+    For the variables, see variable_generators.make_variable_generator.
+    """
+
+    def __init__(self, profile_file, default_queries_file, pg=None):
+        self.profile_file = profile_file
+        with open(profile_file) as f:
+            profile = yaml.safe_load(f)
+        self.name = profile['name']
+        queries_file = default_queries_file
+        if profile.get('queries_file'):
+            queries_file = os.path.join(os.path.dirname(profile_file), profile['queries_file'])
+        with open(queries_file) as f:
+            definitions = {
+                d.name.value: d for d in graphql.parse(f.read()).definitions
+            }
+
+        def get_query(op):
+            if op['name'] not in definitions:
+                raise WorkloadError("Operation {} of workload {} not found in {}".format(
+                    op['name'], self.name, queries_file))
+            return definitions[op['name']]
+
+        self.requests_per_sec = profile.get('requests_per_sec', [])
+        self.duration = profile.get('duration')
+        self.operations = [
+            WorkloadOperation(
+                get_query(op), op.get('weight', 1),
+                op.get('variables', {}), op.get('headers', {}), pg
+            )
+            for op in profile.get('operations', [])
+        ]
+        self.subscriptions = [
+            WorkloadSubscription(
+                get_query(op), op.get('connections', 1),
+                op.get('variables', {}), op.get('headers', {}), pg
+            )
+            for op in profile.get('subscriptions', [])
+        ]
+        if not self.operations:
+            raise WorkloadError("Workload {} has no operations".format(self.name))
+
+    def get_weights(self):
+        total = sum(op.weight for op in self.operations)
+        return {op.name: op.weight / total for op in self.operations}
+
+
+class MixedWorkload:
+    """
+    Sends an interleaved stream of the operations of a workload profile at a
+    fixed rate, choosing each operation at random according to its weight.
+
+    Like wrk2, the requests are sent at their scheduled times irrespective of
+    the responses to the previous requests, and the latency of a request is
+    measured from its scheduled time, so that it's not affected by
+    coordinated omission. The latencies are recorded separately for each
+    operation. Since the requests are sent from a single Python process, the
+    rate shouldn't exceed a few thousand requests per second.
+    """
+
+    def __init__(self, profile, graphql_url, ws_url, headers, requests_per_sec, duration, connections):
+        self.profile = profile
+        self.graphql_url = graphql_url
+        self.ws_url = ws_url
+        # Headers sent with all the requests (like the admin secret)
+        self.headers = headers
+        self.requests_per_sec = requests_per_sec
+        self.duration = duration
+        self.connections = connections
+        self.stats = {op.name: OperationStats() for op in profile.operations}
+        self.updates_received = {sub.name: 0 for sub in profile.subscriptions}
+
+    def run(self):
+        asyncio.run(self.run_async())
+        return self
+
+    async def run_async(self):
+        loop = asyncio.get_event_loop()
+        subscriptions = await self.open_subscriptions()
+        try:
+            print(Fore.GREEN + "Running workload {} at {} req/s for {} seconds".format(
+                self.profile.name, self.requests_per_sec, self.duration) + Style.RESET_ALL)
+            connector = aiohttp.TCPConnector(limit=self.connections)
+            async with aiohttp.ClientSession(connector=connector) as session:
+                await self.send_requests(loop, session)
+        finally:
+            for (_, conn, receiver) in subscriptions:
+                receiver.cancel()
+            await asyncio.gather(
+                *[receiver for (_, _, receiver) in subscriptions],
+                *[conn.close() for (_, conn, _) in subscriptions],
+                return_exceptions=True
+            )
+
+    async def open_subscriptions(self):
+        subscriptions = []
+        for sub in self.profile.subscriptions:
+            for _ in range(sub.connections):
+                conn = GraphQLWsConnection(self.ws_url, {**self.headers, **sub.headers})
+                await conn.connect()
+                await conn.start('1', sub.query_str, sub.gen_variables())
+                receiver = asyncio.ensure_future(self.receive_updates(sub, conn))
+                subscriptions.append((sub, conn, receiver))
+        return subscriptions
+
+    async def receive_updates(self, sub, conn):
+        while True:
+            ev = await conn.recv()
+            if ev['type'] == 'data':
+                self.updates_received[sub.name] += 1
+
+    async def send_requests(self, loop, session):
+        operations = self.profile.operations
+        weights = [op.weight for op in operations]
+        interval = 1.0 / self.requests_per_sec
+        start_time = loop.time()
+        pending = set()
+        for i in range(int(self.duration * self.requests_per_sec)):
+            scheduled_time = start_time + i * interval
+            await asyncio.sleep(max(0, scheduled_time - loop.time()))
+            op = random.choices(operations, weights)[0]
+            pending.add(asyncio.ensure_future(self.send_request(loop, session, op, scheduled_time)))
+            if len(pending) > self.connections:
+                pending = {t for t in pending if not t.done()}
+        if pending:
+            await asyncio.wait(pending)
+
+    async def send_request(self, loop, session, op, scheduled_time):
+        success = False
+        try:
+            headers = {**self.headers, **op.headers}
+            async with session.post(self.graphql_url, json=op.request_body(), headers=headers) as resp:
+                body = await resp.json()
+                success = resp.status == 200 and 'errors' not in body
+        except (aiohttp.ClientError, ValueError):
+            pass
+        self.stats[op.name].record(loop.time() - scheduled_time, success)
@@ -0,0 +1,25 @@
+-- A library to load pre-generated request bodies (one JSON body per line),
+-- used to send queries with different variables
+
+local _M = {}
+
+function _M.load(bodies_file)
+  local bodies = {}
+  for line in io.lines(bodies_file) do
+    if line ~= "" then
+      table.insert(bodies, line)
+    end
+  end
+  return bodies
+end
+
+-- Each thread picks the bodies in a different random order
+function _M.seed(thread_id)
+  math.randomseed(os.time() + (thread_id or 0))
+end
+
+function _M.pick(bodies)
+  return bodies[math.random(#bodies)]
+end
+
+return _M
@@ -0,0 +1,30 @@
+-- Like bench-wrk2.lua, but each request picks one of the request bodies
+-- (queries with variables) from the file given as the first argument
+
+local gqbench = require "bench-lib-wrk2"
+local bodies_lib = require "bench-lib-bodies"
+
+local bodies = {}
+
+local results_dir = nil
+
+local threads_count = 0
+
+function setup(thread)
+  thread:set("thread_id", threads_count)
+  threads_count = threads_count + 1
+end
+
+function init(args)
+  bodies = bodies_lib.load(args[1])
+  results_dir = args[2]
+  bodies_lib.seed(thread_id)
+end
+
+function request()
+  return gqbench.request(wrk, bodies_lib.pick(bodies))
+end
+
+function done(s, l, r)
+  return gqbench.done(s, l, r, results_dir)
+end
@@ -1,11 +1,17 @@
 import pytest
 import time
 from context import HGECtx, HGECtxError, ActionsWebhookServer, EvtsWebhookServer, HGECtxGQLServer, GQLWsClient, PytestConf
+from yaml_cache import yaml_cache
+from db_snapshot import DBStateSnapshot
+from durations import DurationsStore
+from provision import Provisioner
 import threading
 import random
 from datetime import datetime
 import sys
 import os
+import shutil
+import tempfile
 from collections import OrderedDict
 
 def pytest_addoption(parser):
@@ -108,6 +114,46 @@ def pytest_addoption(parser):
         required=False,
         help="Accept any failing test cases from YAML files as correct, and write the new files out to disk."
     )
+    parser.addoption(
+        "--provision-hge-bin",
+        metavar="<path>",
+        required=False,
+        help="Run a graphql-engine (and a Postgres docker container) from this binary for each worker, instead of using --hge-urls and --pg-urls"
+    )
+    parser.addoption(
+        "--provision-hge-docker-image",
+        metavar="<image>",
+        required=False,
+        help="Run a graphql-engine (and a Postgres docker container) from this docker image for each worker, instead of using --hge-urls and --pg-urls"
+    )
+    parser.addoption(
+        "--provision-pg-docker-image",
+        metavar="<image>",
+        default="circleci/postgres:11.5-alpine-postgis",
+        required=False,
+        help="Docker image of the Postgres databases run for each worker (default: circleci/postgres:11.5-alpine-postgis)"
+    )
+    parser.addoption(
+        "--provision-hge-args",
+        metavar="<args>",
+        default="",
+        required=False,
+        help="Additional arguments of 'graphql-engine serve', for the graphql-engines run for each worker"
+    )
+    parser.addoption(
+        "--test-durations-file",
+        metavar="<path>",
+        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '.test_durations.json'),
+        required=False,
+        help="File in which the durations of the tests and of their class scoped fixtures are recorded, to hand out the longest work first to the workers"
+    )
+
+    parser.addoption(
+        "--yaml-cache-file",
+        metavar="<path>",
+        required=False,
+        help="Cache the parsed YAML test case files in this file, so that the files which haven't changed are not parsed again in the next runs"
+    )
     parser.addoption(
         "--skip-schema-teardown",
         action="store_true",
@@ -129,6 +175,18 @@ This option may result in test failures if the schema has to change between the
 """
     )
 
+    parser.addoption(
+        "--db-state-snapshots",
+        action="store_true",
+        default=False,
+        required=False,
+        help="""
+Set up the database state of per_method_tests_db_state and per_method_db_data_for_mutation_tests once per class,
+and restore it after each test from a snapshot of the data (and of the metadata, if it changed), unless the schema
+changed. Restoring the data requires the Postgres user to be a superuser
+"""
+    )
+
     parser.addoption(
         "--avoid-error-message-checks",
         action="store_true",
@@ -202,15 +260,32 @@ def pytest_configure(config):
     # Pytest has removed the global pytest.config
     # As a solution we are going to store it in PytestConf.config
     PytestConf.config = config
+    yaml_cache.configure(config.getoption('--yaml-cache-file'))
     if is_help_option_present(config):
         return
     if is_master(config):
-        if not config.getoption('--hge-urls'):
-            print("hge-urls should be specified")
-        if not config.getoption('--pg-urls'):
-            print("pg-urls should be specified")
-        config.hge_url_list = config.getoption('--hge-urls')
-        config.pg_url_list = config.getoption('--pg-urls')
+        config.test_durations = DurationsStore(config.getoption('--test-durations-file'))
+        # Where the workers write the info about the tests needed by the scheduler
+        config.test_info_dir = tempfile.mkdtemp(prefix='hasura-tests-')
+        config.provisioner = None
+        if is_provisioning(config):
+            config.provisioner = Provisioner(
+                config.getoption('-n', default=None) or 1,
+                hge_bin=config.getoption('--provision-hge-bin'),
+                hge_docker_image=config.getoption('--provision-hge-docker-image'),
+                pg_docker_image=config.getoption('--provision-pg-docker-image'),
+                hge_args=config.getoption('--provision-hge-args')
+            )
+            config.provisioner.start()
+            config.hge_url_list = config.provisioner.hge_urls
+            config.pg_url_list = config.provisioner.pg_urls
+        else:
+            if not config.getoption('--hge-urls'):
+                print("hge-urls should be specified")
+            if not config.getoption('--pg-urls'):
+                print("pg-urls should be specified")
+            config.hge_url_list = config.getoption('--hge-urls')
+            config.pg_url_list = config.getoption('--pg-urls')
         config.hge_ctx_gql_server = HGECtxGQLServer(config.hge_url_list)
         if config.getoption('-n', default=None):
             xdist_threads = config.getoption('-n')
@@ -259,6 +334,40 @@ def pytest_report_collectionfinish(config, startdir, items):
 
 
 
+# Durations of the setup of the module and class scoped fixtures, since the last test report
+fixture_durations = []
+
+@pytest.hookimpl(hookwrapper=True)
+def pytest_fixture_setup(fixturedef, request):
+    start = time.perf_counter()
+    yield
+    if fixturedef.scope in ['module', 'class']:
+        fixture_durations.append((request.node.nodeid, fixturedef.argname, time.perf_counter() - start))
+
+@pytest.hookimpl(hookwrapper=True)
+def pytest_runtest_makereport(item, call):
+    outcome = yield
+    if fixture_durations:
+        # Sent to the master along with the report, with xdist
+        outcome.get_result().fixture_durations = fixture_durations[:]
+        fixture_durations.clear()
+
+def pytest_runtest_logreport(report):
+    config = PytestConf.config
+    # With xdist, the reports of the workers are also sent to the master
+    if is_master(config) and hasattr(config, 'test_durations'):
+        config.test_durations.add(report)
+
+@pytest.hookimpl(optionalhook=True)
+def pytest_xdist_make_scheduler(config, log):
+    dist = config.getoption('dist')
+    if dist == 'loadfile':
+        from scheduling import DurationFileScheduling
+        return DurationFileScheduling(config, config.test_durations, log)
+    if dist == 'loadscope':
+        from scheduling import DurationClassScheduling
+        return DurationClassScheduling(config, config.test_durations, log)
+
 @pytest.hookimpl(optionalhook=True)
 def pytest_configure_node(node):
     if is_help_option_present(node.config):
@@ -266,11 +375,26 @@ def pytest_configure_node(node):
     # Pytest has removed the global pytest.config
     node.slaveinput["hge-url"] = node.config.hge_url_list.pop()
     node.slaveinput["pg-url"] = node.config.pg_url_list.pop()
+    node.slaveinput["test-info-dir"] = node.config.test_info_dir
+
+def pytest_collection_modifyitems(config, items):
+    # Let the scheduler of the master know which tests use fixtures on fixed
+    # ports, or module scoped fixtures of their own (see scheduling.py)
+    if not is_master(config) and 'test-info-dir' in config.slaveinput:
+        from scheduling import write_test_info
+        worker = os.environ.get('PYTEST_XDIST_WORKER')
+        write_test_info(os.path.join(config.slaveinput['test-info-dir'], worker + '.json'), items)
 
 def pytest_unconfigure(config):
+    yaml_cache.save()
     if is_help_option_present(config):
         return
+    if is_master(config):
+        config.test_durations.save()
+        shutil.rmtree(config.test_info_dir, ignore_errors=True)
     config.hge_ctx_gql_server.teardown()
+    if getattr(config, 'provisioner', None):
+        config.provisioner.teardown()
 
 @pytest.fixture(scope='module')
 def hge_ctx(request):
@@ -296,8 +420,6 @@ def hge_ctx(request):
     yield hge_ctx  # provide the fixture value
     print("teardown hge_ctx")
     hge_ctx.teardown()
-    # TODO why do we sleep here?
-    time.sleep(1)
 
 @pytest.fixture(scope='class')
 def evts_webhook(request):
@@ -402,7 +524,13 @@ def per_method_tests_db_state(request, hge_ctx):
     Has a function level scope, since metadata operations may change both the schema and data
     Class method/variable requirements are similar to that of per_class_tests_db_state fixture
     """
-    yield from db_state_context(request, hge_ctx)
+    if db_state_snapshots_enabled(request, hge_ctx):
+        yield from db_snapshot_context(
+            request, hge_ctx, 'tests_db_state',
+            lambda: db_state_context(request, hge_ctx)
+        )
+    else:
+        yield from db_state_context(request, hge_ctx)
 
 @pytest.fixture(scope='class')
 def per_class_db_schema_for_mutation_tests(request, hge_ctx):
@@ -427,11 +555,27 @@ def per_method_db_data_for_mutation_tests(request, hge_ctx, per_class_db_schema_
     The class may provide `values_setup_files` variables which contains the list of data setup files,
     Or the `values_teardown_files` variable which provides the list of data teardown files.
     """
-    yield from db_context_common(
-        request, hge_ctx, 'values_setup_files', 'values_setup.yaml',
-        'values_teardown_files', 'values_teardown.yaml',
-        False, False, False
-    )
+    def values_context():
+        return db_context_common(
+            request, hge_ctx, 'values_setup_files', 'values_setup.yaml',
+            'values_teardown_files', 'values_teardown.yaml',
+            False, False, False
+        )
+    if db_state_snapshots_enabled(request, hge_ctx):
+        yield from db_snapshot_context(request, hge_ctx, 'db_data_for_mutation_tests', values_context)
+    else:
+        yield from values_context()
+
+@pytest.fixture(scope='class')
+def db_state_snapshots(request, hge_ctx):
+    """
+    The database state snapshots of a class (see --db-state-snapshots), by the
+    name of the fixture using them. The states are torn down after the class.
+    """
+    snapshots = OrderedDict()
+    yield snapshots
+    for snapshot in reversed(list(snapshots.values())):
+        snapshot.teardown()
 
 @pytest.fixture(scope='function')
 def backend():
@@ -452,6 +596,25 @@ def per_backend_tests(hge_ctx, backend):
         )
         return
 
+def db_state_snapshots_enabled(request, hge_ctx):
+    # The snapshots are of the Postgres database of hge_ctx
+    return request.config.getoption('--db-state-snapshots') \
+        and hge_ctx.is_default_backend \
+        and request.cls is not None
+
+def db_snapshot_context(request, hge_ctx, name, mk_db_context):
+    """
+    Set up the database state with the db context made by mk_db_context for the
+    first test of the class, and restore it after each test (see DBStateSnapshot)
+    """
+    snapshots = request.getfixturevalue('db_state_snapshots')
+    if name not in snapshots:
+        snapshots[name] = DBStateSnapshot(hge_ctx, mk_db_context)
+    snapshot = snapshots[name]
+    snapshot.setup()
+    yield
+    snapshot.restore()
+
 def db_state_context(request, hge_ctx):
     # Non-default (Postgres) backend tests expect separate setup and schema_setup
     # files for v1/metadata and v2/query requests, respectively.
@@ -597,6 +760,9 @@ def is_help_option_present(config):
         for x in ['--fixtures','--help', '--collect-only']
     ])
 
+def is_provisioning(config):
+    return bool(config.getoption('--provision-hge-bin') or config.getoption('--provision-hge-docker-image'))
+
 def is_master(config):
     """True if the code running the given pytest.config object is running in a xdist master
     node or not running xdist at all.
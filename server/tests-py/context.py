@@ -16,12 +16,12 @@ import random
 import os
 import re
 
-import ruamel.yaml as yaml
 import requests
 import websocket
 from sqlalchemy import create_engine
 from sqlalchemy.schema import MetaData
 import graphql_server
+from yaml_cache import load_yaml
 import graphql
 
 # pytest has removed the global pytest.config
@@ -374,13 +374,15 @@ class EvtsWebhookHandler(http.server.BaseHTTPRequestHandler):
         # This is like a sleep endpoint above, but allowing us to decide
         # externally when the webhook can return, with unblock()
         elif req_path == "/block":
-            if not self.server.unblocked:
-                self.server.blocked_count += 1
-                with self.server.unblocked_wait:
+            with self.server.unblocked_wait:
+                if not self.server.unblocked:
+                    self.server.blocked_count += 1
+                    # Wake up the tests waiting for requests to be blocked
+                    self.server.unblocked_wait.notify_all()
                     # We expect this timeout never to be reached, but if
                     # something goes wrong the main thread will block forever:
-                    self.server.unblocked_wait.wait(timeout=60)
-                self.server.blocked_count -= 1
+                    self.server.unblocked_wait.wait_for(lambda: self.server.unblocked, timeout=60)
+                    self.server.blocked_count -= 1
             self.send_response(HTTPStatus.NO_CONTENT)
             self.end_headers()
         else:
@@ -405,18 +407,17 @@ class EvtsWebhookServer(ThreadedHTTPServer):
         # We use these two vars to coordinate unblocking in the /block route
         self.unblocked = False
         self.unblocked_wait = threading.Condition()
-        # ...and this for bookkeeping open blocked requests; this becomes
-        # meaningless after the first call to unblock()
+        # ...and this for bookkeeping open blocked requests (notifying
+        # unblocked_wait when it grows); this becomes meaningless after the
+        # first call to unblock()
         self.blocked_count = 0
 
         super().__init__(server_address, EvtsWebhookHandler)
 
     # Unblock all webhook requests to /block. Idempotent.
     def unblock(self):
-        self.unblocked = True
         with self.unblocked_wait:
-            # NOTE: this only affects currently wait()-ing threads, future
-            # wait()s will block again (hence the simple self.unblocked flag)
+            self.unblocked = True
             self.unblocked_wait.notify_all()
 
     def server_bind(self):
@@ -589,19 +590,15 @@ class HGECtx:
         return self.execute_query(q, "/v1/query", headers)
 
     def v1q_f(self, fn):
-        with open(fn) as f:
-            # NOTE: preserve ordering with ruamel
-            yml = yaml.YAML()
-            return self.v1q(yml.load(f))
+        # NOTE: preserves ordering, as with the ruamel round-trip loader
+        return self.v1q(load_yaml(fn))
 
     def v2q(self, q, headers = {}):
         return self.execute_query(q, "/v2/query", headers)
 
     def v2q_f(self, fn):
-        with open(fn) as f:
-            # NOTE: preserve ordering with ruamel
-            yml = yaml.YAML()
-            return self.v2q(yml.load(f))
+        # NOTE: preserves ordering, as with the ruamel round-trip loader
+        return self.v2q(load_yaml(fn))
 
     def backend_suffix(self, filename):
         if self.is_default_backend:
@@ -613,10 +610,8 @@ class HGECtx:
         return self.execute_query(q, "/v1/metadata", headers)
 
     def v1metadataq_f(self, fn):
-        with open(fn) as f:
-            # NOTE: preserve ordering with ruamel
-            yml = yaml.YAML()
-            return self.v1metadataq(yml.load(f))
+        # NOTE: preserves ordering, as with the ruamel round-trip loader
+        return self.v1metadataq(load_yaml(fn))
 
     def teardown(self):
         self.http.close()
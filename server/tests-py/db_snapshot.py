@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+
+import io
+
+# Schemas of Postgres and graphql-engine, which are not part of the state of the tests
+SYSTEM_SCHEMAS_FILTER = """
+  n.nspname NOT IN ('information_schema', 'pg_catalog', 'pg_toast')
+  AND n.nspname NOT LIKE 'pg\\_temp\\_%' AND n.nspname NOT LIKE 'pg\\_toast\\_temp\\_%'
+  AND n.nspname NOT LIKE 'hdb\\_%'
+"""
+
+# A digest of the definitions of the relations, columns, constraints, indexes,
+# functions, triggers, views and enums in the user schemas
+SCHEMA_FINGERPRINT_SQL = """
+SELECT md5(coalesce(string_agg(def, E'\\n' ORDER BY def), '')) AS fingerprint FROM (
+  SELECT format('schema %s', n.nspname) AS def
+  FROM pg_namespace n WHERE {filter}
+  UNION ALL
+  SELECT format('relation %s.%s %s', n.nspname, c.relname, c.relkind)
+  FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace WHERE {filter}
+  UNION ALL
+  SELECT format('column %s.%s.%s %s %s %s', n.nspname, c.relname, a.attname,
+                format_type(a.atttypid, a.atttypmod), a.attnotnull, pg_get_expr(d.adbin, d.adrelid))
+  FROM pg_attribute a
+  JOIN pg_class c ON c.oid = a.attrelid
+  JOIN pg_namespace n ON n.oid = c.relnamespace
+  LEFT JOIN pg_attrdef d ON d.adrelid = a.attrelid AND d.adnum = a.attnum
+  WHERE a.attnum > 0 AND NOT a.attisdropped AND {filter}
+  UNION ALL
+  SELECT format('constraint %s.%s %s', n.nspname, co.conname, pg_get_constraintdef(co.oid))
+  FROM pg_constraint co JOIN pg_namespace n ON n.oid = co.connamespace WHERE {filter}
+  UNION ALL
+  SELECT format('index %s', pg_get_indexdef(i.indexrelid))
+  FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+  JOIN pg_namespace n ON n.oid = c.relnamespace WHERE {filter}
+  UNION ALL
+  SELECT format('function %s %s %s', p.oid::regprocedure, md5(p.prosrc), p.provolatile)
+  FROM pg_proc p JOIN pg_namespace n ON n.oid = p.pronamespace WHERE {filter}
+  UNION ALL
+  SELECT format('trigger %s', pg_get_triggerdef(t.oid))
+  FROM pg_trigger t JOIN pg_class c ON c.oid = t.tgrelid
+  JOIN pg_namespace n ON n.oid = c.relnamespace WHERE NOT t.tgisinternal AND {filter}
+  UNION ALL
+  SELECT format('view %s.%s %s', n.nspname, c.relname, pg_get_viewdef(c.oid))
+  FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+  WHERE c.relkind IN ('v', 'm') AND {filter}
+  UNION ALL
+  SELECT format('enum %s %s %s', t.typname, e.enumsortorder, e.enumlabel)
+  FROM pg_enum e JOIN pg_type t ON t.oid = e.enumtypid
+  JOIN pg_namespace n ON n.oid = t.typnamespace WHERE {filter}
+) defs
+""".format(filter=SYSTEM_SCHEMAS_FILTER)
+
+TABLES_SQL = """
+SELECT quote_ident(n.nspname) || '.' || quote_ident(c.relname) AS name
+FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+WHERE c.relkind = 'r' AND {filter}
+ORDER BY 1
+""".format(filter=SYSTEM_SCHEMAS_FILTER)
+
+SEQUENCES_SQL = """
+SELECT quote_ident(n.nspname) || '.' || quote_ident(c.relname) AS name
+FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+WHERE c.relkind = 'S' AND {filter}
+ORDER BY 1
+""".format(filter=SYSTEM_SCHEMAS_FILTER)
+
+class DBStateSnapshotError(Exception):
+    pass
+
+class DBStateSnapshot:
+    """
+    Keeps the database state set up for a test class, instead of setting it up
+    and tearing it down around each test method. The state is set up (by
+    running the setup part of the given db context generator, as used by the
+    fixtures in conftest.py) before the first method, and a snapshot is taken
+    of the data of the user tables (with COPY), the values of the sequences,
+    the exported metadata and a fingerprint of the schema. After each method:
+      - if the schema is unchanged, the data is restored with TRUNCATE and
+        COPY, and the metadata is replaced only if it changed
+      - otherwise, the state is torn down (by running the rest of the db
+        context generator), and set up again before the next method.
+    The data is restored with session_replication_role set to replica, so that
+    the triggers (like those of event triggers) don't fire, which requires the
+    Postgres user to be a superuser.
+    """
+
+    def __init__(self, hge_ctx, mk_db_context):
+        self.hge_ctx = hge_ctx
+        self.mk_db_context = mk_db_context
+        self.db_context = None
+        self.fingerprint = None
+        self.metadata = None
+        self.tables = {}
+        self.sequences = {}
+
+    def setup(self):
+        """Set up the state before a test method, unless already set up"""
+        if self.db_context:
+            return
+        self.db_context = self.mk_db_context()
+        next(self.db_context)
+        # The setup is the same each time, so is the snapshot
+        if self.fingerprint is None:
+            self.take()
+
+    def teardown(self):
+        """Tear down the state, if set up"""
+        if not self.db_context:
+            return
+        db_context = self.db_context
+        self.db_context = None
+        next(db_context, None)
+
+    def restore(self):
+        """Restore the state after a test method"""
+        if not self.db_context:
+            return
+        if self.schema_fingerprint() != self.fingerprint or not self.restore_metadata():
+            self.teardown()
+            return
+        self.restore_data()
+
+    def take(self):
+        self.fingerprint = self.schema_fingerprint()
+        self.metadata = self.export_metadata()
+        with self.cursor() as cursor:
+            cursor.execute(TABLES_SQL)
+            tables = [row[0] for row in cursor.fetchall()]
+            for table in tables:
+                buf = io.StringIO()
+                cursor.copy_expert('COPY {} TO STDOUT'.format(table), buf)
+                self.tables[table] = buf.getvalue()
+            cursor.execute(SEQUENCES_SQL)
+            sequences = [row[0] for row in cursor.fetchall()]
+            for sequence in sequences:
+                cursor.execute('SELECT last_value, is_called FROM {}'.format(sequence))
+                self.sequences[sequence] = cursor.fetchone()
+
+    def restore_data(self):
+        with self.cursor() as cursor:
+            cursor.execute('SET LOCAL session_replication_role = replica')
+            if self.tables:
+                cursor.execute('TRUNCATE {}'.format(', '.join(self.tables)))
+            for (table, data) in self.tables.items():
+                if data:
+                    cursor.copy_expert('COPY {} FROM STDIN'.format(table), io.StringIO(data))
+            for (sequence, (last_value, is_called)) in self.sequences.items():
+                cursor.execute('SELECT setval(%s, %s, %s)', (sequence, last_value, is_called))
+
+    def restore_metadata(self):
+        """Replace the metadata with the one in the snapshot if it changed, returning whether it succeeded"""
+        if self.export_metadata() == self.metadata:
+            return True
+        st_code, _ = self.hge_ctx.v1q({'type': 'replace_metadata', 'args': self.metadata})
+        return st_code == 200
+
+    def export_metadata(self):
+        st_code, resp = self.hge_ctx.v1q({'type': 'export_metadata', 'args': {}})
+        if st_code != 200:
+            raise DBStateSnapshotError('export_metadata failed: ' + str(resp))
+        return resp
+
+    def schema_fingerprint(self):
+        with self.cursor() as cursor:
+            cursor.execute(SCHEMA_FINGERPRINT_SQL)
+            return cursor.fetchone()[0]
+
+    def cursor(self):
+        return SnapshotCursor(self.hge_ctx.engine)
+
+class SnapshotCursor:
+    """A cursor in a transaction of its own, committed on exit (unless there's an error)"""
+
+    def __init__(self, engine):
+        self.engine = engine
+
+    def __enter__(self):
+        self.conn = self.engine.raw_connection()
+        self.cur = self.conn.cursor()
+        return self.cur
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            self.cur.close()
+            if exc_type is None:
+                self.conn.commit()
+            else:
+                self.conn.rollback()
+        finally:
+            self.conn.close()
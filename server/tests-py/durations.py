@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import statistics
+import tempfile
+
+def test_parents(nodeid):
+    """
+    The node ids of the module and classes of a test, which are the nodes the
+    module and class scoped fixtures are set up for
+    """
+    parts = nodeid.split('[', 1)[0].split('::')
+    return ['::'.join(parts[:i]) for i in range(1, len(parts))]
+
+class DurationsStore:
+    """
+    Durations of the tests in previous runs, stored as JSON:
+      - the duration of each test (of its setup, call and teardown), without
+        the setup of the module and class scoped fixtures
+      - the durations of the setup of the module and class scoped fixtures
+        (like per_class_tests_db_state), for each module or class, which
+        happens once for all the tests of the module or class which run on the
+        same worker
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.tests = {}
+        self.fixtures = {}
+        # Durations recorded in this session
+        self.session_tests = {}
+        self.session_fixtures = {}
+        if path and os.path.isfile(path):
+            try:
+                with open(path) as f:
+                    durations = json.load(f)
+                self.tests = durations.get('tests', {})
+                self.fixtures = durations.get('fixtures', {})
+            except (OSError, ValueError):
+                # Just rebuilt by the next run
+                self.tests = {}
+                self.fixtures = {}
+
+    def add(self, report):
+        """Add the duration of a phase of a test, from its report"""
+        fixture_durations = getattr(report, 'fixture_durations', None) or {}
+        duration = report.duration - sum(d for (_, _, d) in fixture_durations)
+        self.session_tests[report.nodeid] = self.session_tests.get(report.nodeid, 0) + max(duration, 0)
+        for (node, fixture, d) in fixture_durations:
+            self.session_fixtures.setdefault(node, {})[fixture] = d
+
+    def test_duration(self, nodeid):
+        return self.tests.get(nodeid)
+
+    def default_test_duration(self):
+        """The duration assumed for tests without any recorded duration"""
+        return statistics.median(self.tests.values()) if self.tests else 0
+
+    def fixtures_duration(self, node):
+        """The duration of the setup of the module or class scoped fixtures of a module or class"""
+        return sum(self.fixtures.get(node, {}).values())
+
+    def estimate(self, nodeids):
+        """The duration of running the given tests on a single worker"""
+        default = self.default_test_duration()
+        duration = 0
+        nodes = set()
+        for nodeid in nodeids:
+            test_duration = self.test_duration(nodeid)
+            duration += default if test_duration is None else test_duration
+            nodes.update(test_parents(nodeid))
+        return duration + sum(self.fixtures_duration(node) for node in nodes)
+
+    def save(self):
+        if not self.path or not (self.session_tests or self.session_fixtures):
+            return
+        self.tests.update(self.session_tests)
+        for (node, fixtures) in self.session_fixtures.items():
+            self.fixtures.setdefault(node, {}).update(fixtures)
+        fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)), suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'tests': self.tests, 'fixtures': self.fixtures}, f, indent=2, sort_keys=True)
+        os.replace(tmp_file, self.path)
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+
+import os
+import shlex
+import subprocess
+import sys
+import threading
+import psycopg2
+import requests
+from utils import wait_until
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bench-wrk'))
+from port_allocator import PortAllocator
+
+# The environment the tests expect graphql-engine to be run with (as in `scripts/dev.sh test`)
+TEST_ENV = {
+    'HASURA_GRAPHQL_EVENTS_HTTP_POOL_SIZE': '8',
+    'EVENT_WEBHOOK_HEADER': 'MyEnvValue',
+    'WEBHOOK_FROM_ENV': 'http://127.0.0.1:5592',
+    'SCHEDULED_TRIGGERS_WEBHOOK_DOMAIN': 'http://127.0.0.1:5594',
+    'REMOTE_SCHEMAS_WEBHOOK_DOMAIN': 'http://127.0.0.1:5000'
+}
+
+# Variables which would point the provisioned graphql-engines at a shared
+# database, so they are not inherited from the environment of the tests
+EXCLUDED_ENV = ['HASURA_GRAPHQL_DATABASE_URL', 'HASURA_GRAPHQL_METADATA_DATABASE_URL']
+
+class ProvisionError(Exception):
+    pass
+
+class PostgresInstance:
+    """A Postgres docker container, configured like the one of `scripts/dev.sh test`"""
+
+    password = 'postgres'
+
+    def __init__(self, port, docker_image):
+        self.port = port
+        self.docker_image = docker_image
+        self.container_name = 'hasura-test-postgres-{}'.format(port)
+        self.url = 'postgres://postgres:{}@127.0.0.1:{}/postgres'.format(self.password, port)
+        self.started = False
+
+    def start(self):
+        subprocess.run([
+            'docker', 'run', '--name', self.container_name,
+            '-p', '127.0.0.1:{0}:{0}'.format(self.port), '--expose={}'.format(self.port),
+            '-e', 'POSTGRES_PASSWORD=' + self.password,
+            '-d', self.docker_image,
+            '-c', 'port={}'.format(self.port), '-c', 'log_hostname=off'
+        ], check=True, stdout=subprocess.DEVNULL)
+        self.started = True
+
+    def is_ready(self):
+        try:
+            psycopg2.connect(self.url, connect_timeout=1).close()
+            return True
+        except psycopg2.OperationalError:
+            return False
+
+    def wait(self, timeout=60):
+        wait_until(self.is_ready, timeout, description='Postgres at ' + self.url)
+
+    def teardown(self):
+        if self.started:
+            subprocess.run(['docker', 'rm', '-f', '-v', self.container_name],
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            self.started = False
+
+class HGEInstance:
+    """graphql-engine run from a binary or a docker image, with the given Postgres as its metadata database and default source"""
+
+    def __init__(self, port, pg, hge_bin=None, docker_image=None, args=[], log_dir='/tmp'):
+        self.port = port
+        self.pg = pg
+        self.hge_bin = hge_bin
+        self.docker_image = docker_image
+        self.args = args
+        self.url = 'http://127.0.0.1:{}'.format(port)
+        self.container_name = 'hasura-test-hge-{}'.format(port)
+        self.log_file = os.path.join(log_dir, 'hasura-test-hge-{}.log'.format(port))
+        self.proc = None
+        self.container_started = False
+
+    def env(self):
+        return {
+            **TEST_ENV,
+            **{k: v for (k, v) in os.environ.items() if k not in EXCLUDED_ENV},
+            'HASURA_GRAPHQL_SERVER_PORT': str(self.port),
+            'HASURA_GRAPHQL_PG_SOURCE_URL_1': self.pg.url,
+            'HASURA_GRAPHQL_PG_SOURCE_URL_2': self.pg.url
+        }
+
+    def process_args(self):
+        return ['--metadata-database-url', self.pg.url, 'serve', '--stringify-numeric-types', *self.args]
+
+    def start(self):
+        if self.docker_image:
+            env_args = []
+            for (k, v) in self.env().items():
+                if k.startswith('HASURA_GRAPHQL_') or k in TEST_ENV:
+                    env_args += ['-e', '{}={}'.format(k, v)]
+            subprocess.run([
+                'docker', 'run', '--name', self.container_name, '--network', 'host',
+                *env_args, '-d', self.docker_image, 'graphql-engine', *self.process_args()
+            ], check=True, stdout=subprocess.DEVNULL)
+            self.container_started = True
+        else:
+            with open(self.log_file, 'w') as log:
+                self.proc = subprocess.Popen(
+                    [self.hge_bin, *self.process_args()], env=self.env(),
+                    stdout=log, stderr=subprocess.STDOUT, start_new_session=True
+                )
+
+    def check_if_running(self):
+        if self.proc and self.proc.poll() is not None:
+            raise ProvisionError('graphql-engine on port {} exited, see {}'.format(self.port, self.log_file))
+
+    def is_ready(self):
+        try:
+            return requests.get(self.url + '/healthz', timeout=1).status_code == 200
+        except requests.exceptions.RequestException:
+            return False
+
+    def wait(self, timeout=120):
+        wait_until(self.is_ready, timeout, description='graphql-engine at ' + self.url,
+                   on_retry=self.check_if_running)
+
+    def metadata_q(self, q):
+        headers = {}
+        admin_secret = self.env().get('HASURA_GRAPHQL_ADMIN_SECRET')
+        if admin_secret:
+            headers['X-Hasura-Admin-Secret'] = admin_secret
+        return requests.post(self.url + '/v1/metadata', json=q, headers=headers)
+
+    def add_default_source(self):
+        resp = self.metadata_q({
+            'type': 'pg_add_source',
+            'args': {
+                'name': 'default',
+                'configuration': {'connection_info': {'database_url': self.pg.url}}
+            }
+        })
+        if resp.status_code == 200:
+            return
+        if 'already exists' not in resp.text:
+            raise ProvisionError('Adding the default source failed: ' + resp.text)
+        # Make sure the existing default source is this instance's Postgres
+        resp = self.metadata_q({'type': 'export_metadata', 'args': {}})
+        if resp.status_code != 200:
+            raise ProvisionError('Exporting the metadata failed: ' + resp.text)
+        sources = {source['name']: source for source in resp.json().get('sources', [])}
+        database_url = sources['default']['configuration']['connection_info']['database_url']
+        if database_url != self.pg.url:
+            raise ProvisionError('The default source of graphql-engine on port {} is not its Postgres ({}), but {}'.format(
+                self.port, self.pg.url, database_url))
+
+    def teardown(self):
+        if self.proc:
+            self.proc.terminate()
+            try:
+                self.proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+            self.proc = None
+        if self.container_started:
+            subprocess.run(['docker', 'rm', '-f', self.container_name],
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            self.container_started = False
+
+class Provisioner:
+    """
+    Launches pairs of Postgres (in docker) and graphql-engine (from a binary
+    or a docker image) on unused ports, one for each xdist worker
+    """
+
+    def __init__(self, count, hge_bin=None, hge_docker_image=None,
+                 pg_docker_image='circleci/postgres:11.5-alpine-postgis', hge_args=''):
+        if not (hge_bin or hge_docker_image):
+            raise ProvisionError('Either a graphql-engine binary or docker image is required')
+        self.port_allocator = PortAllocator()
+        self.pgs = []
+        self.hges = []
+        for _ in range(count):
+            pg = PostgresInstance(self.port_allocator.allocate_port(35432), pg_docker_image)
+            hge = HGEInstance(
+                self.port_allocator.allocate_port(8088), pg, hge_bin=hge_bin,
+                docker_image=hge_docker_image, args=shlex.split(hge_args or '')
+            )
+            self.pgs.append(pg)
+            self.hges.append(hge)
+
+    def start(self):
+        """Start all the instances, in parallel"""
+        print('Provisioning {} graphql-engine and Postgres pairs'.format(len(self.hges)))
+        errors = []
+        def start_pair(pg, hge):
+            try:
+                pg.start()
+                pg.wait()
+                hge.start()
+                hge.wait()
+                hge.add_default_source()
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=start_pair, args=pair) for pair in zip(self.pgs, self.hges)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            self.teardown()
+            raise ProvisionError('Provisioning failed: ' + '; '.join(str(e) for e in errors))
+
+    @property
+    def hge_urls(self):
+        return [hge.url for hge in self.hges]
+
+    @property
+    def pg_urls(self):
+        return [pg.url for pg in self.pgs]
+
+    def teardown(self):
+        for res in self.hges + self.pgs:
+            res.teardown()
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+
+import glob
+import json
+import os
+from collections import OrderedDict
+from xdist.scheduler import LoadFileScheduling, LoadScopeScheduling
+
+# Fixtures which run servers on fixed ports, so that the tests using the same
+# port can't run concurrently on different workers. A fixture binding a fixed
+# port has to be added here (like query_echo_webhook of
+# test_webhook_request_context.py), or its tests may fail with the port in use
+FIXED_PORT_FIXTURES = {
+    'evts_webhook': 5592,
+    'actions_fixture': 5593,
+    'scheduled_triggers_evts_webhook': 5594,
+    'query_echo_webhook': 5594,
+    'gql_server': 5991
+}
+
+def item_test_info(item):
+    """
+    The fixed ports used by the fixtures of a test, and whether it uses module
+    scoped fixtures of its own (rather than of conftest.py, like hge_ctx)
+    """
+    fixturedefs = item._fixtureinfo.name2fixturedefs
+    return {
+        'ports': sorted({FIXED_PORT_FIXTURES[f] for f in item.fixturenames if f in FIXED_PORT_FIXTURES}),
+        'module_fixtures': any(
+            d.scope == 'module' and d.baseid
+            for defs in fixturedefs.values() for d in defs
+        )
+    }
+
+def write_test_info(path, items):
+    """Write the test info of the collected tests, for the scheduler (all the workers collect the same tests)"""
+    test_info = {}
+    for item in items:
+        info = item_test_info(item)
+        if info['ports'] or info['module_fixtures']:
+            test_info[item.nodeid] = info
+    tmp_file = path + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(test_info, f)
+    os.replace(tmp_file, path)
+
+def read_test_info(test_info_dir):
+    if not test_info_dir:
+        return {}
+    for path in glob.glob(os.path.join(test_info_dir, '*.json')):
+        with open(path) as f:
+            return json.load(f)
+    return {}
+
+class LongestFirstQueue(OrderedDict):
+    """A work queue of xdist scopes, from which the scope with the longest duration is taken first"""
+
+    def __init__(self, scope_duration):
+        super().__init__()
+        self.scope_duration = scope_duration
+        self.durations = {}
+
+    def duration(self, scope):
+        if scope not in self.durations:
+            self.durations[scope] = self.scope_duration(self[scope])
+        return self.durations[scope]
+
+    def popitem(self, last=True):
+        if last:
+            return super().popitem(last=True)
+        # max picks the first of the longest scopes, in collection order
+        scope = max(self, key=self.duration)
+        return scope, self.pop(scope)
+
+class DurationScheduling:
+    """
+    Hands out the xdist scopes with the longest recorded durations first (so
+    that the slowest ones don't end up on the last worker), and keeps the
+    scopes with tests using the same fixed port on the same worker
+    """
+
+    def __init__(self, config, durations, log=None):
+        super().__init__(config, log)
+        self.config = config
+        self.durations = durations
+        self.test_info = None
+        # The fixed port group of the scopes using fixed ports
+        self.port_groups = {}
+        self.reported = False
+        self.workqueue = LongestFirstQueue(self.scope_duration)
+
+    def schedule(self):
+        if self.test_info is None:
+            self.test_info = read_test_info(getattr(self.config, 'test_info_dir', None))
+            self.group_fixed_port_scopes()
+        super().schedule()
+
+    def _assign_work_unit(self, node):
+        # Before the first work unit is taken from the full work queue
+        if not self.reported:
+            self.report_port_groups()
+            self.reported = True
+        super()._assign_work_unit(node)
+
+    def group_fixed_port_scopes(self):
+        """Group the scopes using fixed ports, with the other scopes using any of their ports"""
+        # Union-find of the scopes and the ports
+        parents = {}
+        def find(x):
+            while parents.setdefault(x, x) != x:
+                x = parents[x]
+            return x
+        for (nodeid, info) in self.test_info.items():
+            scope = self.base_scope(nodeid)
+            for port in info['ports']:
+                parents[find(scope)] = find(port)
+        groups = {}
+        for x in parents:
+            if isinstance(x, int):
+                groups.setdefault(find(x), []).append(x)
+        for x in parents:
+            if not isinstance(x, int):
+                self.port_groups[x] = 'fixed port ' + ', '.join(str(p) for p in sorted(groups[find(x)]))
+
+    def report_port_groups(self):
+        terminal = self.config.pluginmanager.getplugin('terminalreporter')
+        total = sum(self.workqueue.duration(scope) for scope in self.workqueue)
+        for group in sorted(set(self.port_groups.values())):
+            if group not in self.workqueue:
+                continue
+            line = 'Tests using {}: {} tests on a single worker, estimated {:.0f}s of {:.0f}s in total'.format(
+                group, len(self.workqueue[group]), self.workqueue.duration(group), total)
+            if terminal:
+                terminal.write_line(line)
+            else:
+                print(line)
+
+    def file_has_module_fixtures(self, path):
+        return any(info['module_fixtures'] for (nodeid, info) in self.test_info.items()
+                   if nodeid.split('::', 1)[0] == path)
+
+    def _split_scope(self, nodeid):
+        scope = self.base_scope(nodeid)
+        return self.port_groups.get(scope, scope)
+
+    def scope_duration(self, work_unit):
+        return self.durations.estimate(work_unit.keys())
+
+class DurationFileScheduling(DurationScheduling, LoadFileScheduling):
+    """--dist=loadfile, with the longest files first"""
+
+    def base_scope(self, nodeid):
+        return nodeid.split('::', 1)[0]
+
+class DurationClassScheduling(DurationScheduling, LoadScopeScheduling):
+    """
+    --dist=loadscope (to be given explicitly), with the longest classes first.
+    The tests of a class run on the same worker, so that its class scoped
+    fixtures (like per_class_tests_db_state) are set up once, as are the
+    tests of the files with module scoped fixtures of their own. The classes
+    of different files are interleaved on the workers though, which then set
+    up the module scoped fixtures of conftest.py (like hge_ctx) again for each
+    file they switch to.
+    """
+
+    def __init__(self, config, durations, log=None):
+        super().__init__(config, durations, log)
+        self.module_fixture_files = {}
+
+    def base_scope(self, nodeid):
+        path = nodeid.split('::', 1)[0]
+        if path not in self.module_fixture_files:
+            self.module_fixture_files[path] = self.file_has_module_fixtures(path)
+        if self.module_fixture_files[path]:
+            return path
+        # The class of the test, or its file for tests outside classes
+        return nodeid.split('[', 1)[0].rsplit('::', 1)[0]
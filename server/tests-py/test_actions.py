@@ -1,8 +1,8 @@
 #!/usr/bin/env python3
 
 import pytest
-import time
 import subprocess
+import utils
 
 from validate import check_query_f, check_query, get_conf_f
 from remote_server import NodeGraphQL
@@ -453,17 +453,7 @@ class TestActionsAsync:
         check_query_timeout(hge_ctx, conf_user_1, add_auth = False, timeout = 10)
 
 def check_query_timeout(hge_ctx, conf, add_auth, timeout):
-    wait_until = time.time() + timeout
-    while True:
-        time.sleep(2)
-        try:
-            check_query(hge_ctx, conf, add_auth = add_auth)
-        except AssertionError:
-            if time.time() > wait_until:
-                raise
-            else:
-                continue
-        break
+    utils.until_asserts_pass(lambda: check_query(hge_ctx, conf, add_auth = add_auth), timeout = timeout)
 
 @pytest.mark.usefixtures('per_class_tests_db_state')
 class TestSetCustomTypes:
@@ -563,11 +553,13 @@ class TestActionTimeout:
             'status': 200,
         }
         # Since, the above is an async action, we don't wait for the execution of the webhook.
-        # We need this sleep of 4 seconds here because only after 3 seconds (sleep duration in the handler)
-        # we will be getting the result, otherwise the following asserts will fail because the
-        # response will be empty. This 4 seconds sleep will be concurrent with the sleep duration
-        # of the handler's execution. So, total time taken for this test will be 4 seconds.
-        time.sleep(4)
-        response, _ = check_query(hge_ctx, conf)
+        # The response will be empty until the handler times out, after 3 seconds (the sleep
+        # duration in the handler), so poll until we get the result.
+        def check_errors():
+            response, _ = check_query(hge_ctx, conf)
+            assert response['data']['create_user'] is not None, response
+            assert response['data']['create_user'].get('errors') is not None, response
+            return response
+        response = utils.until_asserts_pass(check_errors, timeout = 10)
         assert 'errors' in response['data']['create_user']
         assert 'ResponseTimeout' == response['data']['create_user']['errors']['internal']['error']['message']
@@ -135,10 +135,21 @@ class TestEventFlood(object):
             #  - 100 being processed right now (but blocked on HTTP_POOL capacity)
             assert resp['result'][1] == ['200', '1000']
 
-        # Rather than sleep arbitrarily, loop until assertions pass:
-        utils.until_asserts_pass(30, check_backpressure)
-        # ...then make sure we're truly stable:
-        time.sleep(3)
+        # Rather than sleep arbitrarily, wait for the webhook requests to be
+        # blocked, then loop until assertions pass:
+        deadline = utils.Deadline(30)
+        utils.wait_on_condition(evts_webhook.unblocked_wait,
+                                lambda: evts_webhook.blocked_count >= 8,
+                                deadline=deadline, description='blocked webhook requests')
+        utils.until_asserts_pass(check_backpressure, deadline=deadline)
+        # ...then make sure we're truly stable. This checks that nothing
+        # changes for a while, so it can't end as soon as a condition holds:
+        # keep checking for a fixed 3 seconds, which also catches a transient
+        # overshoot between the checks
+        stable_until = utils.Deadline(3)
+        while not stable_until.expired():
+            check_backpressure()
+            stable_until.sleep(0.5)
         check_backpressure()
 
         # unblock open and future requests to /block; check all events processed
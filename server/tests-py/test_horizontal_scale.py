@@ -1,7 +1,7 @@
 import pytest
 import ruamel.yaml as yaml
-import time
 import jsondiff
+import utils
 from context import PytestConf
 
 
@@ -36,23 +36,25 @@ class TestHorizantalScaleBasic():
             resp = response.json()
             assert st_code == 200, resp
 
-            # wait for 20 sec
-            time.sleep(20)
-            # validate data
-            response = hge_ctx.http.post(
-                self.servers[step['validate']['server']] + "/v1alpha1/graphql",
-                json=step['validate']['query']
-            )
-            st_code = response.status_code
-            resp = response.json()
-            assert st_code == 200, resp
+            # Poll the other server until the change is propagated to it
+            # (via the metadata of the shared database)
+            utils.until_asserts_pass(lambda: self.validate(hge_ctx, step['validate']), timeout=30)
+
+    def validate(self, hge_ctx, validate):
+        response = hge_ctx.http.post(
+            self.servers[validate['server']] + "/v1alpha1/graphql",
+            json=validate['query']
+        )
+        st_code = response.status_code
+        resp = response.json()
+        assert st_code == 200, resp
 
-            if 'response' in step['validate']:
-                assert resp == step['validate']['response'], yaml.dump({
-                    'response': resp,
-                    'expected': step['validate']['response'],
-                    'diff': jsondiff.diff(step['validate']['response'], resp)
-                })
+        if 'response' in validate:
+            assert resp == validate['response'], yaml.dump({
+                'response': resp,
+                'expected': validate['response'],
+                'diff': jsondiff.diff(validate['response'], resp)
+            })
 
     @classmethod
     def dir(cls):
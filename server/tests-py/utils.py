@@ -2,18 +2,84 @@
 
 import time
 
-# Loop a function 'tries' times, until all assertions pass. With a 0.3 second
-# pause after each. This re-raises AssertionError in case we run out of tries
-def until_asserts_pass(tries, func):
-    for x in range(0, tries):
-        print(x)
-        if x == tries-1:
-            # last time; raise any assertions in caller:
-            func()
-        else:
-            try:
-                func()
-                break
-            except AssertionError:
-                time.sleep(0.3)
-                pass
+class WaitTimeoutError(Exception):
+    pass
+
+# A point in time by which a wait has to be over. Passed down to the nested
+# waits (e.g. of each step of a test), so that they don't outlive the outer one
+class Deadline:
+
+    def __init__(self, timeout):
+        self.expires_at = time.monotonic() + timeout
+
+    # Either the given deadline, or a new one in 'timeout' seconds
+    @classmethod
+    def of(cls, timeout=None, deadline=None):
+        if deadline is not None:
+            return deadline if timeout is None else deadline.within(timeout)
+        assert timeout is not None, "Either a timeout or a deadline is required"
+        return cls(timeout)
+
+    # A deadline in 'timeout' seconds, but no later than this one
+    def within(self, timeout):
+        deadline = Deadline(timeout)
+        deadline.expires_at = min(deadline.expires_at, self.expires_at)
+        return deadline
+
+    def remaining(self):
+        return max(self.expires_at - time.monotonic(), 0)
+
+    def expired(self):
+        return time.monotonic() >= self.expires_at
+
+    # Sleep for 'delay' seconds, or until the deadline if that's sooner
+    def sleep(self, delay):
+        time.sleep(min(delay, self.remaining()))
+
+# Delays between the tries of a wait: exponentially increasing from 'initial',
+# up to 'maximum' seconds
+def backoff(initial=0.05, maximum=1, factor=2):
+    delay = initial
+    while True:
+        yield delay
+        delay = min(delay * factor, maximum)
+
+# Poll 'condition' until it returns a truthy value, which is returned, backing
+# off between the tries. 'on_retry' is called (and may raise, to stop waiting)
+# before each retry. Raises WaitTimeoutError on reaching the deadline
+def wait_until(condition, timeout=None, deadline=None, description=None,
+               initial_delay=0.05, max_delay=1, on_retry=None):
+    deadline = Deadline.of(timeout, deadline)
+    for delay in backoff(initial_delay, max_delay):
+        result = condition()
+        if result:
+            return result
+        if deadline.expired():
+            raise WaitTimeoutError('Timeout waiting for ' + (description or str(condition)))
+        if on_retry:
+            on_retry()
+        deadline.sleep(delay)
+
+# Call 'func' until all its assertions pass, returning its result, backing off
+# between the tries. This re-raises the last AssertionError on reaching the
+# deadline
+def until_asserts_pass(func, timeout=None, deadline=None, initial_delay=0.05, max_delay=1):
+    deadline = Deadline.of(timeout, deadline)
+    for delay in backoff(initial_delay, max_delay):
+        try:
+            return func()
+        except AssertionError:
+            if deadline.expired():
+                raise
+        deadline.sleep(delay)
+
+# Wait on a threading.Condition (notified by e.g. a webhook server's thread)
+# until 'predicate' holds, returning its result. Raises WaitTimeoutError on
+# reaching the deadline
+def wait_on_condition(condition, predicate, timeout=None, deadline=None, description=None):
+    deadline = Deadline.of(timeout, deadline)
+    with condition:
+        result = condition.wait_for(predicate, timeout=deadline.remaining())
+    if not result:
+        raise WaitTimeoutError('Timeout waiting for ' + (description or str(predicate)))
+    return result
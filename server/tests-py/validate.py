@@ -16,6 +16,7 @@ import warnings
 import pytest
 
 from context import GQLWsClient, PytestConf
+from yaml_cache import load_yaml
 
 def check_keys(keys, obj):
     for k in keys:
@@ -399,13 +400,27 @@ def equal_CommentedMap(m1, m2):
 
 # Parse test case YAML file
 def get_conf_f(f):
-    with open(f, 'r+') as c:
-        return yaml.YAML().load(c)
+    return load_yaml(f)
 
 def check_query_f(hge_ctx, f, transport='http', add_auth=True):
     print("Test file: " + f)
     hge_ctx.may_skip_test_teardown = False
     print ("transport="+transport)
+    if PytestConf.config.getoption("--accept"):
+        check_query_f_accept(hge_ctx, f, transport, add_auth)
+        return
+    # The ordering of keys is preserved, so that we can test the JSON ordering
+    # property conforms to YAML spec
+    conf = load_yaml(f)
+    if isinstance(conf, list):
+        for sconf in conf:
+            check_query(hge_ctx, sconf, transport, add_auth)
+    else:
+        if conf['status'] != 200:
+            hge_ctx.may_skip_test_teardown = True
+        check_query(hge_ctx, conf, transport, add_auth)
+
+def check_query_f_accept(hge_ctx, f, transport='http', add_auth=True):
     with open(f, 'r+') as c:
         # For `--accept`:
         should_write_back = False
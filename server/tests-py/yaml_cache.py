@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+import os
+import pickle
+import tempfile
+import threading
+import ruamel.yaml as yaml
+from ruamel.yaml.comments import CommentedMap
+
+class YAMLCache:
+    """
+    Process-wide cache of parsed YAML test case files, keyed by path and
+    modification time. The files are parsed with the (much faster) safe loader,
+    and each load returns a fresh copy with the mappings as CommentedMaps,
+    which preserves the key ordering checks of validate.equal_CommentedMap.
+    Round-trip loading (which keeps comments, for writing back the files with
+    `--accept`) is not cached.
+
+    The cache may be backed by a pickle file (see `--yaml-cache-file`), so that
+    the files unchanged since the previous run are not parsed again.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # path -> (mtime_ns, size, parsed contents)
+        self.entries = {}
+        self.cache_file = None
+        self.dirty = False
+
+    def configure(self, cache_file):
+        self.cache_file = cache_file
+        if cache_file and os.path.isfile(cache_file):
+            self.entries.update(self.read_cache_file())
+
+    def read_cache_file(self):
+        try:
+            with open(self.cache_file, 'rb') as f:
+                entries = pickle.load(f)
+            return entries if isinstance(entries, dict) else {}
+        except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+            # A corrupt or outdated cache is just rebuilt
+            return {}
+
+    def save(self):
+        """Write the cache file, merging with the entries saved meanwhile by other (xdist) workers"""
+        if not self.cache_file or not self.dirty:
+            return
+        with self.lock:
+            entries = self.read_cache_file()
+            entries.update(self.entries)
+            cache_dir = os.path.dirname(os.path.abspath(self.cache_file))
+            fd, tmp_file = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(entries, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_file, self.cache_file)
+            self.dirty = False
+
+    def load(self, path):
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        with self.lock:
+            entry = self.entries.get(path)
+        if entry and entry[:2] == (st.st_mtime_ns, st.st_size):
+            contents = entry[2]
+        else:
+            with open(path) as f:
+                text = f.read()
+            if '<<' in text:
+                # The round-trip loader orders the keys of merged mappings
+                # differently, and the expected key orders follow it
+                contents = to_plain(yaml.YAML().load(text))
+            else:
+                contents = yaml.YAML(typ='safe', pure=True).load(text)
+            with self.lock:
+                self.entries[path] = (st.st_mtime_ns, st.st_size, contents)
+                self.dirty = True
+        return to_commented(contents)
+
+def to_plain(x):
+    """A copy of the YAML loaded by the round-trip loader, without the ruamel types (which can't be pickled)"""
+    if isinstance(x, dict):
+        return {k: to_plain(v) for k, v in x.items()}
+    elif isinstance(x, list):
+        return [to_plain(v) for v in x]
+    elif isinstance(x, bool):
+        return x
+    elif isinstance(x, str):
+        return str(x)
+    elif isinstance(x, int):
+        return int(x)
+    elif isinstance(x, float):
+        return float(x)
+    else:
+        return x
+
+def to_commented(x):
+    """A copy of the parsed YAML, with the mappings as CommentedMaps (as loaded by the round-trip loader)"""
+    if isinstance(x, dict):
+        m = CommentedMap()
+        for k, v in x.items():
+            m[k] = to_commented(v)
+        return m
+    elif isinstance(x, list):
+        return [to_commented(v) for v in x]
+    else:
+        return x
+
+yaml_cache = YAMLCache()
+
+def load_yaml(path):
+    """Load the YAML file from the process-wide cache"""
+    return yaml_cache.load(path)